@@ -2,27 +2,38 @@
 from datetime import datetime, timedelta
 import platform
 import pickle
+import gc
+import sys
 
 import CSNSettings
+import CSNMetrics
+import CSNReplay
+from CSNMetrics import Stage, Staged
+from CSNPipeline import Pipeline, Tick
 from classes.BubbleExpansion import BubbleExpansion
 from classes.Presense import Presence
 from classes.System import System
 from classes.State import State, Phase
 from classes.Message import Message, Overide
 from classes.ExpansionTarget import ExpansionTarget
-from providers.EDSM import GetSystemsFromEDSM
+from classes.FactionConfig import FactionConfig
+from providers.EDSM import GetSystemsFromEDSM, RefreshPopulatedDump, ReduceToFaction, ClearWarm
+from providers.Spansh import GetSystemsFromSpansh, Fresher, ClearSpanshWarm
 from providers.EliteBGS import RefreshFaction
 from providers.DiscordLink import WriteDiscord
 from providers.Canonn import getfleetcarrier
 from providers.DCOH import dcohsummary
 from providers.GoogleSheets import CSNOverRideRead, CSNFleetCarrierRead, CSNPatrolWrite
-from providers.ShortTermMemory import STM, SaveSTM
+from providers.ShortTermMemory import Memory, SaveSTM, LoadSTM, STMFile
+from providers.InfluenceHistory import InfluenceStore, RecordInfluence
 
 
 myBubble: BubbleExpansion = None  # type: ignore
 
 SAFE_GAP = 15  # Urgent message if below...
 IGNORE_GAP = 29  # Ignore any gap over...
+TREND_GAP = 1.0  # Warn if a gap is shrinking faster than this % a day...
+TREND_DAYS = 7  # over this many days of Influence History
 
 
 def WritePatrol(messages: list[Message]):
@@ -33,7 +44,7 @@ def WritePatrol(messages: list[Message]):
         if message.isPatrol:
             system = myBubble.getsystem(message.systemname)
             patrol.append((message.systemname, system.x if system else 0, system.y if system else 0,
-                          system.z if system else 0, 0, 'Canonn', message.text, message.emoji))
+                          system.z if system else 0, 0, CSNSettings.FACTION, message.text, message.emoji))
     print('Google Patrol...')
     CSNPatrolWrite(patrol)
 
@@ -45,6 +56,7 @@ def ExpandMessage(message: Message, expandto: str, inf: float, gap: float, happy
     return message
 
 
+@Staged('OverrideMessages')
 def OverrideMessages() -> list[Message]:
     """ Gets all Manual Missions or Overrides (from Google) and expands any embeded variables """
     faction: Presence
@@ -75,6 +87,7 @@ def OverrideMessages() -> list[Message]:
     return messages
 
 
+@Staged('StaleDataMessages')
 def StaleDataMessages(mySystems: list[System]) -> list[Message]:
     """ Checks Last Updated DateTime and Prompts Mission if Stales"""
     messages: list[Message] = []
@@ -88,6 +101,7 @@ def StaleDataMessages(mySystems: list[System]) -> list[Message]:
     return messages
 
 
+@Staged('DCOHThargoidMessages')
 def DCOHThargoidMessages(mySystems: list[System]) -> list[Message]:
     """ Gets Thargoid Threat Messages"""
     dhoc = dcohsummary()
@@ -102,6 +116,7 @@ def DCOHThargoidMessages(mySystems: list[System]) -> list[Message]:
     return messages
 
 
+@Staged('RetreatMessages')
 def RetreatMessages(mySystems: list[System], myfaction: str = CSNSettings.FACTION) -> list[Message]:
     """ Prevent Retreat of Full Systems to prevent normal Expansion """
     messages: list[Message] = []
@@ -125,6 +140,7 @@ def RetreatMessages(mySystems: list[System], myfaction: str = CSNSettings.FACTIO
     return messages
 
 
+@Staged('InvasionMessages')
 def InvasionMessages(systems: list[System], mySystems: list[System], max_cycles: int = 5, paranoia_level: float = CSNSettings.PARANOIA_LEVEL, myfaction: str = CSNSettings.FACTION, all_factions=False) -> list[Message]:
     """ Turns Invasion Data calulated earlier into relevent Messages """
     """ Only bothered with Non-Ignored PF unless all_factions is TRUE"""
@@ -142,6 +158,7 @@ def InvasionMessages(systems: list[System], mySystems: list[System], max_cycles:
     return messages
 
 
+@Staged('FleetCarrierMessages')
 def FleetCarrierMessages() -> list[Message]:
     """ Location of Noted Fleet Carriers """
     messages: list[Message] = []
@@ -163,6 +180,7 @@ def FleetCarrierMessages() -> list[Message]:
     return messages
 
 
+@Staged('FillInMessages')
 def FillInMessages(mySystems: list[System], count: int = 3) -> list[Message]:
     """ 3 Systems with the lowest non urgent gaps """
     messages: list[Message] = []
@@ -178,10 +196,32 @@ def FillInMessages(mySystems: list[System], count: int = 3) -> list[Message]:
     return messages
 
 
+@Staged('TrendMessages')
+def TrendMessages(mySystems: list[System]) -> list[Message]:
+    """ Systems we control where another Faction has been closing the gap faster than TREND_GAP a day, before it gets below SAFE_GAP """
+    messages: list[Message] = []
+    ours = list(_ for _ in mySystems if _.controllingFaction == CSNSettings.FACTION and len(_.factions) > 1 and
+                _.influence-_.factions[1].influence > SAFE_GAP)
+    trends = InfluenceStore().Trends(set(_.name for _ in ours), TREND_DAYS)
+    for system in ours:
+        if (mine := trends.get((system.name, CSNSettings.FACTION))) is None:
+            continue
+        closing = list((mine-trends[(system.name, _.name)], _) for _ in system.factions
+                       if _.name != CSNSettings.FACTION and (system.name, _.name) in trends)
+        if closing and (worst := min(closing, key=lambda x: x[0]))[0] <= -TREND_GAP:
+            rate, faction = worst
+            gap = system.influence-faction.influence
+            messages.append(Message(system.name, 4, f"Required: {CSNSettings.FACTION} Missions etc : {faction.name} is closing the gap by {-rate:.1f}% a day, gap is {gap:.1f}% (below {SAFE_GAP}% in {(gap-SAFE_GAP)/-rate:.0f} days)",
+                                    CSNSettings.ICONS['mininf']))
+    return messages
+
+
+@Staged('LightHouseExpansion')
 def LightHouseExpansion() -> list[Message]:
     """ Check Lighthouse System and create live Expansion Message """
     global myBubble
     messages: list[Message] = []
+    STM = Memory()
     if CSNSettings.LIGHTHOUSE and (system := myBubble.getsystem(CSNSettings.LIGHTHOUSE)):
         state: State = next(
             (x for x in system.controllingdetails.states if x.state.lower() == 'expansion'), State('None'))
@@ -210,43 +250,11 @@ def LightHouseExpansion() -> list[Message]:
     return messages
 
 
-def GetSystemsWithLive(faction: str = CSNSettings.FACTION, range=40) -> list[System]:
-    answer: list[System] = []
-    answer = GetSystemsFromEDSM(faction, range)
-    answer = RefreshFaction(answer, faction)
-    return answer
-
-
-def GenerateMissions(uselivedata=True, DiscordFullReport=True, DiscordUpdateReport=False):
-    """ Generates all Messages for the Faction and outputs to Discord/Google"""
-    global myBubble
-    print(f"CSN Analysis on {platform.node()}")
-    if uselivedata:
-        myBubble = BubbleExpansion(GetSystemsWithLive())
-    else:
-        myBubble = BubbleExpansion(GetSystemsFromEDSM())
-
-    mySystems = myBubble.faction_presence(CSNSettings.FACTION)
-
-    messages: list[Message] = []
-    # Manually Specified Messages
-    messages.extend(OverrideMessages())
-    # General Additional Messages
-    messages.extend(StaleDataMessages(mySystems))
-    messages.extend(DCOHThargoidMessages(mySystems))
-    messages.extend(RetreatMessages(mySystems))
-    messages.extend(InvasionMessages(myBubble.systems, mySystems))
-    # messages.extend(FleetCarrierMessages())
-    messages.extend(FillInMessages(mySystems, count=3))
-    messages.extend(LightHouseExpansion())
-
-    # Probably wont implement. Low value.
-    # TODO Tritium Refinary Low Price Active/Pending
-    # TODO GOLDRUSH
-    # messages.extend(MarketMessages())
-
-    # System Status Message
+@Staged('SystemMessages')
+def SystemMessages(mySystems: list[System], messages: list[Message]) -> list[Message]:
+    """ Conflict, Control and Gap Messages for each of the Factions Systems, unless Overridden in messages """
     CSNSettings.CSNLog.info('System Messages')
+    answer: list[Message] = []
     system: System
     for system in mySystems:
         # Precalculations
@@ -273,9 +281,9 @@ def GenerateMissions(uselivedata=True, DiscordFullReport=True, DiscordUpdateRepo
             if conflictstate.phase == Phase.RECOVERING:  # Conflict is over, so turn into information
                 myMessage.priority = 21
                 myMessage.emoji = CSNSettings.ICONS['info']
-                messages.append(myMessage)
+                answer.append(myMessage)
             else:
-                messages.append(myMessage)
+                answer.append(myMessage)
                 # TODO ? Could delete Peacetime Message, but it is not normally required as Peacetimes are normally Discord silent
                 continue  # No More Internal Messages
 
@@ -291,47 +299,249 @@ def GenerateMissions(uselivedata=True, DiscordFullReport=True, DiscordUpdateRepo
         if system.controllingFaction != CSNSettings.FACTION:
             myMessage: Message = Message(
                 system.name, 3, f"Urgent: {CSNSettings.FACTION} Missions etc to gain system control (gap {gapfromtop:.1f}%)", CSNSettings.ICONS['push'])
-            messages.append(myMessage)
+            answer.append(myMessage)
             continue
 
         # Gap Warning
         if gap <= SAFE_GAP:
             myMessage: Message = Message(
                 system.name, 4, f"Required: {CSNSettings.FACTION} Missions etc : {system.factions[1].name} is threatening, gap is only {gap:.1f}%", CSNSettings.ICONS['infgap'])
-            messages.append(myMessage)
+            answer.append(myMessage)
             continue  # Does not need the continue but might add another condition in the future
 
+    return answer
+
+
+def GetSystems(faction: str | list[str], range=40, warm: bool = False, dumpdate: datetime = None) -> list[System]:
+    """ Systems from the EDSM dump, or from Spansh's where it is fresher if SPANSH is set """
+    systems = GetSystemsFromEDSM(faction, range, warm=warm, dumpdate=dumpdate)
+    if CSNSettings.SPANSH:
+        systems = Fresher(systems, GetSystemsFromSpansh(
+            faction, range, warm=warm))
+    return systems
+
+
+def GetSystemsWithLive(faction: str = CSNSettings.FACTION, range=40, warm: bool = False) -> list[System]:
+    answer: list[System] = []
+    answer = GetSystems(faction, range, warm=warm)
+    answer = RefreshFaction(answer, faction)
+    return answer
+
+
+def RefreshFactions(systems: list[System], factions: list[str]) -> list[System]:
+    """ EBGS refresh of each Faction's stale Systems in turn, on the one list """
+    for faction in factions:
+        systems = RefreshFaction(systems, faction)
+    return systems
+
+
+def UseFaction(config: FactionConfig = None) -> None:
+    """ Switch the settings and Short Term Memory to config's Faction, or back to .env's """
+    CSNSettings.UseFaction(config)
+    LoadSTM(STMFile('' if CSNSettings.FACTION ==
+            CSNSettings.ENVFACTION.name else CSNSettings.FACTION))
+
+
+def ColdStart() -> None:
+    """ Drop the Bubble and Systems kept warm between runs, so the next run starts from scratch """
+    global myBubble
+    myBubble = None
+    ClearWarm()
+    ClearSpanshWarm()
+    gc.collect()
+
+
+def Expand(systems: list[System], keepwarm: bool = False, pipeline: Pipeline = None,
+           members: dict[str, set[str]] = None, extendedfactions: set[str] = None) -> BubbleExpansion:
+    """ Bubble with all Expansions calculated.\n
+        Only the Expansions around Systems that have changed are recalculated, on the warm Bubble or the last one the pipeline saved.\n
+        members and extendedfactions are for a Bubble shared by several Factions, see BubbleExpansion
+    """
+    bubble = myBubble if keepwarm else None
+    if not bubble and pipeline:
+        bubble = pipeline.Last('Expansions')
+    if bubble and bubble.empire == CSNSettings.FACTION:
+        bubble.members, bubble.extendedfactions = members, extendedfactions
+        bubble.Update(systems)
+        return bubble
+    return BubbleExpansion(systems, CSNSettings.FACTION, members=members, extendedfactions=extendedfactions)
+
+
+def Messages(mySystems: list[System]) -> list[Message]:
+    """ All Messages for the Faction's Systems, in priority order """
+    messages: list[Message] = []
+    # Manually Specified Messages
+    messages.extend(OverrideMessages())
+    # General Additional Messages
+    messages.extend(StaleDataMessages(mySystems))
+    messages.extend(DCOHThargoidMessages(mySystems))
+    messages.extend(RetreatMessages(mySystems, CSNSettings.FACTION))
+    messages.extend(InvasionMessages(myBubble.systems, mySystems,
+                    paranoia_level=CSNSettings.PARANOIA_LEVEL, myfaction=CSNSettings.FACTION))
+    # messages.extend(FleetCarrierMessages())
+    messages.extend(FillInMessages(mySystems, count=3))
+    messages.extend(TrendMessages(mySystems))
+    messages.extend(LightHouseExpansion())
+
+    # Probably wont implement. Low value.
+    # TODO Tritium Refinary Low Price Active/Pending
+    # TODO GOLDRUSH
+    # messages.extend(MarketMessages())
+
+    # System Status Message
+    messages.extend(SystemMessages(mySystems, messages))
+
     # End of system loop
     messages.sort(key=lambda x: x.priority)
+    return messages
 
+
+def Deliver(pipeline: Pipeline, tick: str, delivery: str, messages: list[Message], DiscordFullReport=True, DiscordUpdateReport=False) -> None:
+    """ Send the Faction's Messages to Discord and the Patrol sheet, and save them for the next update """
     # Output
     # Discord Full
     if DiscordFullReport:
-        WriteDiscord(Full=True, messages=messages[:])
+        pipeline.Run('Discord Full', (tick, delivery), WriteDiscord,
+                     Full=True, messages=messages[:])
     # Discourd Update
     if DiscordUpdateReport:
-        WriteDiscord(Full=False, messages=messages[:])
+        pipeline.Run('Discord Update', (tick, delivery), WriteDiscord,
+                     Full=False, messages=messages[:])
 
     # Write Patrol to Google Sheet
-    WritePatrol(messages[:])
+    pipeline.Run('Patrol', (tick, delivery), WritePatrol, messages[:])
 
     # Save Messages for update comparison
-    with open(f'data\\{CSNSettings.FACTION}CSNMessages.pickle', 'wb') as io:
-        pickle.dump(messages, io)
+    with Stage('Messages Save', items=len(messages)):
+        with open(f'data\\{CSNSettings.FACTION}CSNMessages.pickle', 'wb') as io:
+            pickle.dump(messages, io)
+
 
+def GenerateMissions(uselivedata=True, DiscordFullReport=True, DiscordUpdateReport=False, keepwarm=False, resume=True):
+    """ Generates all Messages for the Faction and outputs to Discord/Google\n
+        keepwarm reuses the Bubble from the previous call, only recalculating what has changed\n
+        resume skips any Stage that has already completed with the same inputs, so a failed run picks up where it stopped.
+        Live data (EBGS, Google, DCOH) and deliveries are only reused within the same Tick
+    """
+    global myBubble
+    print(f"CSN Analysis on {platform.node()}")
+    CSNMetrics.NewRun()
+    pipeline = Pipeline(CSNSettings.FACTION,
+                        force=not resume or CSNReplay.Replaying())
+    tick = Tick()
+    faction = CSNSettings.FACTION
+    if not keepwarm:
+        myBubble = None
+
+    dumpdate, dump = pipeline.Run('Dump', (tick,), RefreshPopulatedDump)
+    systems, bubble = pipeline.Run('Bubble', (faction, 40, dump), GetSystems,
+                                   faction, 40, warm=keepwarm, dumpdate=dumpdate)
+    refreshed = bubble
+    if uselivedata:
+        systems, refreshed = pipeline.Run(
+            'Refreshed', (faction, tick, bubble), RefreshFaction, systems, faction)
+    pipeline.Run('Influence', (refreshed,), RecordInfluence, systems)
+    myBubble, expansions = pipeline.Run(
+        'Expansions', (refreshed,), Expand, systems, keepwarm, pipeline)
+
+    mySystems = myBubble.faction_presence(faction)
+    messages, delivery = pipeline.Run(
+        'Messages', (tick, expansions), Messages, mySystems)
+
+    Deliver(pipeline, tick, delivery, messages,
+            DiscordFullReport, DiscordUpdateReport)
+
+    Complete(pipeline.skipped)
+
+
+def Complete(skipped: list[str]) -> None:
+    """ Metrics, recordings and the summary at the end of a run """
+    summary = CSNMetrics.Summary()+'\n'+CSNMetrics.HTTPSummary()
+    if skipped:
+        summary += f"\nResumed, reused {', '.join(skipped)}\n"
+    CSNMetrics.WritePrometheus()
+    CSNReplay.Save()
+    CSNReplay.SaveWrites()
+    print(summary)
     print(f"Complete : EBGS Requests {CSNSettings.GLOBALS['nRequests']}")
     CSNSettings.CSNLog.info(
-        f"Complete : EBGS Requests {CSNSettings.GLOBALS['nRequests']}\n")
+        f"Complete : EBGS Requests {CSNSettings.GLOBALS['nRequests']}\n{summary}\n")
+
+
+def GenerateAllMissions(configs: list[FactionConfig], uselivedata=True, DiscordFullReport=True, DiscordUpdateReport=False,
+                        keepwarm=False, resume=True):
+    """ GenerateMissions for several Factions from one Bubble.\n
+        The dump is read, refreshed and expanded once for all of them, then each Faction's Messages are made and sent with its own
+        settings. History, Messages, Patrol, Short Term Memory and resumable Stages are kept per Faction.
+        A Faction that fails does not stop the others, the first failure is raised at the end so the run can be resumed
+    """
+    global myBubble
+    print(f"CSN Analysis of {len(configs)} Factions on {platform.node()}")
+    CSNMetrics.NewRun()
+    force = not resume or CSNReplay.Replaying()
+    shared = Pipeline('Shared', force=force)
+    tick = Tick()
+    factions = list(_.name for _ in configs)
+    extended = set(_.name for _ in configs if _.extendedphase)
+    if not keepwarm:
+        myBubble = None
+
+    UseFaction(configs[0])
+    dumpdate, dump = shared.Run('Dump', (tick,), RefreshPopulatedDump)
+    systems, bubble = shared.Run('Bubble', (factions, 40, dump), GetSystems,
+                                 factions, 40, warm=keepwarm, dumpdate=dumpdate)
+    refreshed = bubble
+    if uselivedata:
+        systems, refreshed = shared.Run(
+            'Refreshed', (factions, tick, bubble), RefreshFactions, systems, factions)
+    shared.Run('Influence', (refreshed,), RecordInfluence, systems)
+    members = {faction: set(_.name for _ in ReduceToFaction(systems, faction, 40) or [])
+               for faction in factions}
+    myBubble, expansions = shared.Run('Expansions', (refreshed, factions, sorted(extended)), Expand,
+                                      systems, keepwarm, shared, members, extended)
+
+    skipped: list[str] = list(shared.skipped)
+    failed: Exception = None
+    for config in configs:
+        UseFaction(config)
+        try:
+            pipeline = Pipeline(config.name, force=force)
+            myBubble.saveExpansionJson()
+            myBubble.saveInvasionJson()
+            mySystems = myBubble.faction_presence(config.name)
+            messages, delivery = pipeline.Run(
+                'Messages', (tick, expansions, str(config)), Messages, mySystems)
+            Deliver(pipeline, tick, delivery, messages,
+                    DiscordFullReport, DiscordUpdateReport)
+            skipped.extend(f'{config.name} {_}' for _ in pipeline.skipped)
+        except Exception as e:
+            CSNSettings.CSNLog.info(f'{config.name} Failed : {e}')
+            print(f'!! {config.name} Failed : {e}')
+            failed = failed or e
+    UseFaction(None)
+
+    Complete(skipped)
+    if failed:
+        raise failed
 
 
 if __name__ == '__main__':
     """ 
         Tests and Examples of use
     """
-    # Default/Manual Usage
+    # Default/Manual Usage. --profile or --profile=Stage,Stage to Profile
+    # --record or --record=name to Record, --replay=name [--latency=seconds|recorded] to Replay offline
+    CSNMetrics.ProfileArgs(sys.argv)
+    CSNReplay.ReplayArgs(sys.argv)
     full = True
-    GenerateMissions(uselivedata=True,
-                     DiscordUpdateReport=not full, DiscordFullReport=full)
+    # --fresh to run every Stage again, even if it completed earlier in this Tick
+    # Every Faction in the factions file of .env if there is one, else just .env's
+    if configs := CSNSettings.Factions():
+        GenerateAllMissions(configs, uselivedata=True,
+                            DiscordUpdateReport=not full, DiscordFullReport=full, resume='--fresh' not in sys.argv)
+    else:
+        GenerateMissions(uselivedata=True,
+                         DiscordUpdateReport=not full, DiscordFullReport=full, resume='--fresh' not in sys.argv)
 
     # TODO Make CSN Functions generic to be used as a toolkit in ExpandTest
     # TODO Get rid of Bubble, just use Bubble Expansion - Beware may start circular references.
@@ -0,0 +1,184 @@
+# Benchmarks of the Expansion Engine and Message Generation against a Synthetic Bubble
+from datetime import datetime, timedelta
+import subprocess
+import platform
+import tempfile
+import random
+import gc
+import json
+import time
+import sys
+import os
+
+import CSNSettings
+import CSN
+from classes.BubbleExpansion import BubbleExpansion
+from providers.Synthetic import SyntheticBubble
+from providers.EDSM import ConvertEDSM, ReduceToFaction
+import providers.EDDBFactions as EDDBFactions
+
+SCALES = [1000, 5000, 20000]
+IMPORTBUDGET = 0.5  # Seconds for a fresh Python to import an entry point
+ENTRYPOINTS = ['CSNSchedule', 'CSNSettings', 'CSN']
+# Only imported when first used, never by importing an entry point
+HEAVY = ['googleapiclient', 'google_auth_oauthlib', 'numpy', 'zmq', 'simplejson']
+SAMPLE = 200  # Lookups to time for per call benchmarks
+BENCHDIR = os.path.abspath('data\\benchmarks')
+
+
+def Timed(func, *args, repeat: int = 1, **kwargs) -> tuple[float, object]:
+    """ Best wall time of repeat calls, and the result of the last """
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def BenchScale(n: int, seed: int = 42) -> dict:
+    """ Run all the benchmarks for one size of Bubble """
+    faction = CSNSettings.FACTION
+    print(f'\nSynthetic Bubble of {n} systems...')
+    records, factions = SyntheticBubble(n, seed=seed, empire=faction)
+    # Register Player Factions and Home Systems as the EDDB archive would
+    EDDBFactions.EDDBFACTIONS = {_.name.lower(): EDDBFactions.fdetails(
+        _.homesystem, _.isPlayer) for _ in factions}
+
+    result = {'systems': n}
+    result['convert'], systems = Timed(
+        ConvertEDSM, records, datetime.now()-timedelta(days=1))
+    result['reduce'], systems = Timed(ReduceToFaction, systems, faction)
+    result['bubble'] = len(systems)
+
+    history = {_.name: set(f.name for f in _.factions) for _ in systems}
+    start = time.perf_counter()
+    bubble = BubbleExpansion(systems, systemhistory=history, savejson=False)
+    result['bubbleexpansion'] = time.perf_counter() - start
+    result['expandall'], _ = Timed(bubble._ExpandAll)
+
+    rnd = random.Random(seed)
+    sample = rnd.sample(bubble.systems, min(SAMPLE, len(bubble.systems)))
+    t, _ = Timed(lambda: [bubble.getsystem(_.name) for _ in sample], repeat=3)
+    result['getsystem'] = t / len(sample)
+    t, _ = Timed(lambda: [bubble.cube_systems(_, 30) for _ in sample[:50]])
+    result['cube_systems'] = t / len(sample[:50])
+    stations = bubble.systems[0].stationindex
+    t, _ = Timed(lambda: [stations.Find(bubble, _, 20, ['Refinery'], ['Shipyard'])
+                          for _ in sample[:50]])
+    result['stationquery'] = t / len(sample[:50])
+
+    mySystems = bubble.faction_presence(faction)
+    result['mysystems'] = len(mySystems)
+    CSN.myBubble = bubble
+    result['invasionmessages'], _ = Timed(
+        CSN.InvasionMessages, bubble.systems, mySystems)
+    messages = []
+    start = time.perf_counter()
+    messages.extend(CSN.StaleDataMessages(mySystems))
+    messages.extend(CSN.RetreatMessages(mySystems))
+    messages.extend(CSN.InvasionMessages(bubble.systems, mySystems))
+    messages.extend(CSN.FillInMessages(mySystems, count=3))
+    messages.extend(CSN.SystemMessages(mySystems, messages))
+    result['messagepass'] = time.perf_counter() - start
+    result['messages'] = len(messages)
+
+    for k, v in result.items():
+        print(f"  {k:20} {v:12.6f}" if isinstance(
+            v, float) else f"  {k:20} {v:12}")
+    return result
+
+
+def Compare(results: list[dict], file: str) -> None:
+    """ Print the ratio of these results to a previous results file """
+    with open(file, 'r') as io:
+        previous = {_['systems']: _ for _ in json.load(io)['results']}
+    print(f'\nCompared to {file} (>1 is slower now)')
+    for result in results:
+        if old := previous.get(result['systems']):
+            print(f"  {result['systems']:>7} : "+', '.join(
+                f"{k} {v/old[k]:.2f}" for k, v in result.items() if isinstance(v, float) and old.get(k)))
+
+
+def Benchmark(scales: list[int] = SCALES, seed: int = 42, compare: str = '') -> str:
+    """ Run the benchmarks at each scale and save the results as json. Returns the results file """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    os.makedirs(BENCHDIR, exist_ok=True)
+    file = os.path.join(
+        BENCHDIR, f"{datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+    compare = os.path.abspath(compare) if compare else ''
+
+    # Expansion saves its json into data, so keep it away from the real thing
+    home = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    os.makedirs('data', exist_ok=True)
+    try:
+        results = list(BenchScale(n, seed) for n in scales)
+    finally:
+        os.chdir(home)
+
+    with open(file, 'w') as io:
+        json.dump({'date': datetime.now().isoformat(), 'node': platform.node(), 'python': platform.python_version(),
+                   'commit': commit, 'seed': seed, 'results': results}, io, indent=4)
+    print(f'\nResults saved to {file}')
+    if compare:
+        Compare(results, compare)
+    return file
+
+
+def ImportTimes(module: str) -> subprocess.CompletedProcess:
+    """ Import a module in a fresh Python, as a cold start does. -X importtime reports on stderr,
+        and stdout is the HEAVY modules it loaded
+    """
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           f'import sys, {module}; print(" ".join(_ for _ in {HEAVY!r} if _ in sys.modules))'],
+                          capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def ImportLines(run: subprocess.CompletedProcess) -> list[tuple[int, int, str]]:
+    """ (cumulative, self, module) of each -X importtime line, "import time: self [us] | cumulative | imported package", in us """
+    return list((int(_[1]), int(_[0].split(':')[1]), _[2].strip()) for _ in (
+        line.split('|') for line in run.stderr.splitlines() if line.startswith('import time:') and '[us]' not in line))
+
+
+def ImportBudget(modules: list[str] = ENTRYPOINTS, budget: float = IMPORTBUDGET, heaviest: int = 5) -> bool:
+    """ Time importing each entry point in a fresh Python, with the heaviest modules it pulls in.\n
+        Only CSN itself may go over budget, everything that starts without work to do must stay under.
+        None may load a HEAVY module. Returns True if they do
+    """
+    ok = True
+    for module in modules:
+        run = ImportTimes(module)
+        if run.returncode:
+            print(f'{module} failed to import\n{run.stderr.strip().splitlines()[-1]}')
+            ok = False
+            continue
+        times = ImportLines(run)
+        total = sum(self for _, self, _ in times)/1e6
+        over = total > budget and module != 'CSN'
+        heavy = run.stdout.strip()
+        ok = ok and not over and not heavy
+        print(f"{module:<12} {total:6.3f}s {'OVER BUDGET' if over else ''} {f'LOADED {heavy}' if heavy else ''}")
+        for cumulative, _, name in sorted(times, reverse=True)[:heaviest]:
+            print(f'    {cumulative/1e6:6.3f}s {name}')
+    CSNSettings.CSNLog.info(
+        f"Import Budget {'met' if ok else 'exceeded'} ({budget}s)")
+    return ok
+
+
+if __name__ == '__main__':
+    """
+        python CSNBenchmark.py [--scales=1000,5000,20000] [--seed=42] [--compare=data\\benchmarks\\previous.json]
+        python CSNBenchmark.py --imports [--budget=0.5]
+    """
+    args = dict(_[2:].split('=', 1) for _ in sys.argv[1:]
+                if _.startswith('--') and '=' in _)
+    if '--imports' in sys.argv:
+        sys.exit(0 if ImportBudget(budget=float(args.get('budget', IMPORTBUDGET))) else 1)
+    Benchmark(list(int(_) for _ in args['scales'].split(',')) if 'scales' in args else SCALES,
+              int(args.get('seed', 42)), args.get('compare', ''))
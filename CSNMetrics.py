@@ -0,0 +1,316 @@
+# Timing and resource use for each Stage of a CSN run, and HTTP/Cache metrics from all providers
+from dataclasses import dataclass, asdict
+from contextlib import contextmanager
+from functools import wraps
+from datetime import datetime
+import platform
+import os
+import json
+import time
+import sys
+import CSNSettings
+import CSNReplay
+
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
+
+STAGEFILE = 'data\\CSNStages.'+platform.node()+'.jsonl'
+PROFILEDIR = 'data\\profiles'
+
+
+@dataclass
+class Span:
+    """ Timing of a single Stage """
+    name: str
+    run: str = ''
+    started: str = ''
+    depth: int = 0
+    items: int = 0
+    wall: float = 0
+    cpu: float = 0
+    rss: int = 0  # Peak RSS increase in KB during the Stage
+    error: str = ''
+
+
+# Spans of the current run, in order of completion
+_RUN = {'run': datetime.now().strftime('%Y%m%d%H%M%S'), 'depth': 0, 'spans': []}
+# Stages to profile with cProfile, and to track allocations with tracemalloc. Empty is off
+_PROFILE = {'stages': set(), 'memory': set(), 'top': 25, 'active': False}
+
+
+def PeakRSS() -> int:
+    """ Peak Resident Set Size of the process so far in KB, 0 if unknown """
+    if resource:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak // 1024 if sys.platform == 'darwin' else peak
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset // 1024
+    except Exception:
+        return 0
+
+
+def NewRun() -> str:
+    """ Start a new run, forgetting the spans of any previous run """
+    _RUN['run'] = datetime.now().strftime('%Y%m%d%H%M%S')
+    _RUN['spans'] = []
+    _RUN['depth'] = 0
+    return _RUN['run']
+
+
+def Profile(stages: str = '*', memory: str = 'EDSM Delta,Expand All', top: int = 25) -> None:
+    """ Profile the named Stages (comma separated, * for all) and track allocations in the memory Stages.\n
+        Results go to PROFILEDIR. An empty stages turns profiling off
+    """
+    _PROFILE['stages'] = set(_.strip() for _ in stages.split(',') if _.strip())
+    _PROFILE['memory'] = set(_.strip() for _ in memory.split(
+        ',') if _.strip()) if _PROFILE['stages'] else set()
+    _PROFILE['top'] = top
+    if _PROFILE['stages']:
+        CSNSettings.CSNLog.info(f"Profiling {', '.join(_PROFILE['stages'])}")
+
+
+def ProfileArgs(argv: list[str]) -> None:
+    """ Turn on Profiling from a --profile or --profile=Stage,Stage command line option """
+    for arg in argv:
+        if arg == '--profile':
+            Profile()
+        elif arg.startswith('--profile='):
+            Profile(arg.split('=', 1)[1])
+
+
+class _Profiler:
+    """ cProfile and/or tracemalloc around a single Stage """
+
+    @staticmethod
+    def Wanted(name: str) -> bool:
+        return '*' in _PROFILE['stages'] or name in _PROFILE['stages'] or name in _PROFILE['memory']
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.cprofile = None
+        self.tracing = False
+        if not _PROFILE['active'] and ('*' in _PROFILE['stages'] or name in _PROFILE['stages']):
+            # Only one cProfile at a time, so nested Stages are part of the outer profile
+            import cProfile
+            _PROFILE['active'] = True
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        if name in _PROFILE['memory']:
+            import tracemalloc
+            self.tracing = not tracemalloc.is_tracing()
+            if self.tracing:
+                tracemalloc.start()
+
+    def Save(self) -> None:
+        # Stop measuring before doing anything else
+        if self.cprofile:
+            self.cprofile.disable()
+            _PROFILE['active'] = False
+        if self.tracing:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        from io import StringIO
+        stem = os.path.join(
+            PROFILEDIR, f"{_RUN['run']}_{self.name.replace(' ', '')}")
+        os.makedirs(PROFILEDIR, exist_ok=True)
+        summary = StringIO()
+        if self.cprofile:
+            import pstats
+            self.cprofile.dump_stats(stem+'.prof')
+            pstats.Stats(self.cprofile, stream=summary).sort_stats(
+                'cumulative').print_stats(_PROFILE['top'])
+        if self.tracing:
+            summary.write(
+                f"Allocations {self.name} : current {current//1024} KB, peak {peak//1024} KB\n")
+            for stat in snapshot.statistics('lineno')[:_PROFILE['top']]:
+                summary.write(f"{stat}\n")
+        with open(stem+'.txt', 'w') as io:
+            io.write(summary.getvalue())
+        print(f'Profile {self.name} saved to {stem}')
+
+
+@contextmanager
+def Stage(name: str, items: int = 0):
+    """ Time a Stage. Set items on the yielded Span to record how much work it did """
+    span = Span(name, run=_RUN['run'], started=datetime.now().isoformat(),
+                depth=_RUN['depth'], items=items)
+    _RUN['depth'] += 1
+    profiler = _Profiler(name) if _PROFILE['stages'] and _Profiler.Wanted(
+        name) else None
+    rss = PeakRSS()
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    try:
+        yield span
+    except BaseException as e:
+        span.error = repr(e)
+        raise
+    finally:
+        span.wall = round(time.perf_counter() - wall, 4)
+        span.cpu = round(time.process_time() - cpu, 4)
+        span.rss = PeakRSS() - rss
+        _RUN['depth'] -= 1
+        if profiler:
+            profiler.Save()
+        _RUN['spans'].append(span)
+        try:
+            with open(STAGEFILE, 'a') as io:
+                io.write(json.dumps(asdict(span))+'\n')
+        except OSError:
+            pass
+
+
+def Staged(name: str = ''):
+    """ Decorator to time a function as a Stage. Items is the length of the result if it has one """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with Stage(name or func.__name__) as span:
+                result = func(*args, **kwargs)
+                if hasattr(result, '__len__'):
+                    span.items = len(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def Summary() -> str:
+    """ Table of the Stages in the current run, nested in the order they started """
+    spans: list[Span] = sorted(_RUN['spans'], key=lambda x: x.started)
+    ans = f"{'Stage':40} {'Wall s':>9} {'CPU s':>9} {'RSS KB':>9} {'Items':>8}\n"
+    for span in spans:
+        ans += f"{'  '*span.depth+span.name:40} {span.wall:9.2f} {span.cpu:9.2f} {span.rss:9} {span.items:8}{' !'+span.error if span.error else ''}\n"
+    ans += f"{'Total':40} {sum(_.wall for _ in spans if _.depth == 0):9.2f} {sum(_.cpu for _ in spans if _.depth == 0):9.2f} {PeakRSS():9}"
+    return ans
+
+
+# HTTP and Cache Metrics that all providers report into
+
+PROMFILE = 'data\\CSN.'+platform.node()+'.prom'
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+
+@dataclass
+class Endpoint:
+    """ Counters for a single API Endpoint """
+    calls: int = 0
+    errors: int = 0
+    retries: int = 0
+    bytes: int = 0
+    seconds: float = 0
+    buckets: list = None  # Cumulative count of calls within each of BUCKETS
+
+    def __post_init__(self):
+        self.buckets = self.buckets or [0] * len(BUCKETS)
+
+
+_ENDPOINTS: dict[str, Endpoint] = {}
+_CACHES: dict[str, list[int]] = {}  # key is cache name, value is [hits, misses]
+
+
+def Observe(endpoint: str, seconds: float, size: int = 0, error: bool = False) -> None:
+    """ Record a call to an endpoint """
+    e = _ENDPOINTS.setdefault(endpoint, Endpoint())
+    e.calls += 1
+    e.errors += int(error)
+    e.bytes += size
+    e.seconds += seconds
+    for i, le in enumerate(BUCKETS):
+        if seconds <= le:
+            e.buckets[i] += 1
+
+
+def Retry(endpoint: str) -> None:
+    """ Record a retry of a call to an endpoint """
+    _ENDPOINTS.setdefault(endpoint, Endpoint()).retries += 1
+
+
+def CacheHit(cache: str, hit: bool) -> None:
+    """ Record a hit or a miss of a cache """
+    _CACHES.setdefault(cache, [0, 0])[0 if hit else 1] += 1
+
+
+@contextmanager
+def Call(endpoint: str):
+    """ Time a call to an endpoint that is not made through HTTP, e.g. a client library. Set bytes on the yielded dict """
+    call = {'bytes': 0}
+    start = time.perf_counter()
+    error = False
+    try:
+        yield call
+    except BaseException:
+        error = True
+        raise
+    finally:
+        Observe(endpoint, time.perf_counter()-start, call['bytes'], error)
+
+
+def HTTP(endpoint: str, method: str, url: str, **kwargs):
+    """ Make a request with requests, recording metrics against endpoint. Errors and HTTP error codes count as errors """
+    start = time.perf_counter()
+    try:
+        resp = CSNReplay.Request(endpoint, method, url, **kwargs)
+    except Exception:
+        Observe(endpoint, time.perf_counter()-start, 0, True)
+        raise
+    size = len(resp.content) if not kwargs.get('stream') else int(
+        resp.headers.get('Content-Length', 0))
+    Observe(endpoint, time.perf_counter()-start, size, resp.status_code >= 400)
+    return resp
+
+
+def WritePrometheus(file: str = PROMFILE) -> None:
+    """ Write all metrics in Prometheus text format, for the node_exporter textfile collector """
+    def label(name: str) -> str:
+        return name.replace('\\', '\\\\').replace('"', '\\"')
+
+    lines = ['# HELP csn_run_timestamp_seconds Time the metrics were written',
+             '# TYPE csn_run_timestamp_seconds gauge',
+             f'csn_run_timestamp_seconds {time.time():.0f}']
+    for metric, help, attr in (('csn_http_requests_total', 'Calls to each endpoint', 'calls'),
+                               ('csn_http_errors_total',
+                                'Failed calls to each endpoint', 'errors'),
+                               ('csn_http_retries_total',
+                                'Retried calls to each endpoint', 'retries'),
+                               ('csn_http_response_bytes_total', 'Bytes received from each endpoint', 'bytes')):
+        lines += [f'# HELP {metric} {help}', f'# TYPE {metric} counter']
+        lines += [f'{metric}{{endpoint="{label(n)}"}} {getattr(e, attr)}' for n,
+                  e in _ENDPOINTS.items()]
+    lines += ['# HELP csn_http_request_duration_seconds Latency of each endpoint',
+              '# TYPE csn_http_request_duration_seconds histogram']
+    for n, e in _ENDPOINTS.items():
+        lines += [f'csn_http_request_duration_seconds_bucket{{endpoint="{label(n)}",le="{"+Inf" if le == float("inf") else le}"}} {c}' for le,
+                  c in zip(BUCKETS, e.buckets)]
+        lines += [f'csn_http_request_duration_seconds_sum{{endpoint="{label(n)}"}} {e.seconds:.4f}',
+                  f'csn_http_request_duration_seconds_count{{endpoint="{label(n)}"}} {e.calls}']
+    for metric, help, i in (('csn_cache_hits_total', 'Cache hits', 0), ('csn_cache_misses_total', 'Cache misses', 1)):
+        lines += [f'# HELP {metric} {help}', f'# TYPE {metric} counter']
+        lines += [f'{metric}{{cache="{label(n)}"}} {c[i]}' for n,
+                  c in _CACHES.items()]
+    try:
+        with open(file+'.tmp', 'w') as io:
+            io.write('\n'.join(lines)+'\n')
+        os.replace(file+'.tmp', file)
+    except OSError as e:
+        CSNSettings.CSNLog.info(f'Metrics not written : {e}')
+
+
+def HTTPSummary() -> str:
+    """ Table of endpoint and cache metrics """
+    ans = f"{'Endpoint':40} {'Calls':>6} {'Errors':>6} {'Retry':>6} {'KB':>9} {'Mean s':>7}\n"
+    for n, e in sorted(_ENDPOINTS.items()):
+        ans += f"{n:40} {e.calls:6} {e.errors:6} {e.retries:6} {e.bytes//1024:9} {e.seconds/e.calls if e.calls else 0:7.2f}\n"
+    for n, (hits, misses) in sorted(_CACHES.items()):
+        ans += f"Cache {n:34} {hits} hits {misses} misses ({100*hits/(hits+misses) if hits+misses else 0:.0f}%)\n"
+    return ans
+
+
+# Profiling can also be left on in .env
+if CSNSettings.PROFILE:
+    Profile(CSNSettings.PROFILE)
@@ -0,0 +1,98 @@
+# Resumable Stages of a CSN run, each output kept on disk under the hash of its content
+from datetime import datetime
+import hashlib
+import pickle
+import json
+import os
+import CSNSettings
+from CSNMetrics import CacheHit
+
+PIPELINEDIR = 'data\\pipeline'
+
+
+def Tick(now: datetime = None) -> str:
+    """ The scheduled hour a run belongs to. Live data is reused within the same Tick """
+    return (now or datetime.utcnow()).strftime('%Y-%m-%d %H')
+
+
+def Hash(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+class Pipeline:
+    """ Runs the Stages of a run, skipping any whose inputs are unchanged since they last completed.\n
+        Each Stage's output is pickled to PIPELINEDIR under the hash of its content, which later Stages use as their input.
+        The manifest records the inputs and output of the last completed run of each Stage, so a failed run resumes where it stopped
+    """
+
+    def __init__(self, name: str = CSNSettings.FACTION, force: bool = False) -> None:
+        self.name = name
+        self.force = force  # Run every Stage regardless, still keeping the outputs for next time
+        self.manifestfile = os.path.join(PIPELINEDIR, f'{name}.json')
+        self.manifest: dict[str, dict] = {}
+        self.skipped: list[str] = []
+        try:
+            with open(self.manifestfile, 'r') as io:
+                self.manifest = json.load(io)
+        except (OSError, ValueError):
+            pass
+
+    def Run(self, stage: str, inputs: tuple, func, *args, **kwargs) -> tuple[object, str]:
+        """ Output of func(*args, **kwargs) and its hash, from disk if this Stage last completed with the same inputs """
+        key = Hash(stage, *inputs)
+        last = self.manifest.get(stage, {})
+        if not self.force and last.get('inputs') == key and os.path.exists(last.get('file', '')):
+            try:
+                with open(last['file'], 'rb') as io:
+                    value = pickle.load(io)
+                CacheHit('Pipeline', True)
+                self.skipped.append(stage)
+                print(f'Pipeline {stage} unchanged, reusing {last["output"]}')
+                CSNSettings.CSNLog.info(
+                    f'Pipeline {stage} unchanged, reusing {last["output"]}')
+                return value, last['output']
+            except Exception:
+                pass  # Unreadable, so run it again
+
+        CacheHit('Pipeline', False)
+        value = func(*args, **kwargs)
+        data = pickle.dumps(value)
+        output = hashlib.sha256(data).hexdigest()[:16]
+        file = os.path.join(
+            PIPELINEDIR, f"{self.name}.{stage.replace(' ', '')}.{output}.pickle")
+        os.makedirs(PIPELINEDIR, exist_ok=True)
+        if not os.path.exists(file):
+            with open(file+'.tmp', 'wb') as io:
+                io.write(data)
+            os.replace(file+'.tmp', file)
+        if last.get('file') and last['file'] != file and os.path.exists(last['file']):
+            os.remove(last['file'])
+        self.manifest[stage] = {'inputs': key, 'output': output,
+                                'file': file, 'completed': datetime.now().isoformat()}
+        self.Save()
+        return value, output
+
+    def Last(self, stage: str) -> object | None:
+        """ Output of the last completed run of a Stage whatever its inputs, to update rather than start again. None if forced """
+        last = self.manifest.get(stage, {})
+        if self.force or not os.path.exists(last.get('file', '')):
+            return None
+        try:
+            with open(last['file'], 'rb') as io:
+                return pickle.load(io)
+        except Exception:
+            return None
+
+    def Save(self) -> None:
+        os.makedirs(PIPELINEDIR, exist_ok=True)
+        with open(self.manifestfile+'.tmp', 'w') as io:
+            json.dump(self.manifest, io, indent=4)
+        os.replace(self.manifestfile+'.tmp', self.manifestfile)
+
+    def Clear(self) -> None:
+        """ Forget all Stages, so the next run starts from the EDSM dump """
+        for last in self.manifest.values():
+            if os.path.exists(last.get('file', '')):
+                os.remove(last['file'])
+        self.manifest = {}
+        self.Save()
@@ -0,0 +1,241 @@
+# Local HTTP/JSON Query Service over a warm BubbleExpansion
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+from math import floor
+import threading
+import json
+import sys
+
+import CSNSettings
+from classes.BubbleExpansion import BubbleExpansion
+from classes.System import System
+from classes.ExpansionTarget import ExpansionTarget
+from classes.WhatIf import WhatIfEdit
+from classes.State import State
+from providers.EDSM import GetSystemsFromEDSM
+from providers.EDDN import EDDNListener
+
+HOST = '127.0.0.1'
+PORT = 8765
+RELOAD_MINUTES = 15  # How often to look for new data
+CELL = 20  # Grid cell size in ly for neighbourhood lookups
+
+
+def TargetDict(target: ExpansionTarget, priority: int) -> dict:
+    """ JSON ready Expansion Target """
+    return {'priority': priority, 'system': target.systemname, 'description': target.description, 'faction': target.faction.name if target.faction else '',
+            'influence': target.faction.influence if target.faction else 0, 'extended': target.extended, 'score': round(target.score, 3)}
+
+
+def SystemDict(system: System) -> dict:
+    """ JSON ready System details """
+    return {'name': system.name, 'x': system.x, 'y': system.y, 'z': system.z, 'population': system.population,
+            'controllingFaction': system.controllingFaction, 'influence': system.influence, 'source': system.source, 'updated': system.updated.isoformat(),
+            'factions': list({'name': f.name, 'influence': f.influence, 'isPlayer': f.isPlayer, 'isNative': f.isNative, 'states': list(str(s) for s in f.states)} for f in system.factions),
+            'nextexpansion': str(system.nextexpansion) if system.nextexpansion else None}
+
+
+@dataclass(frozen=True)
+class QueryModel:
+    """ Read only snapshot of a BubbleExpansion, indexed for fast lookups.\n
+        Built away from the live Bubble and swapped in whole, so queries never see a half loaded model
+    """
+    loaded: str
+    systems: dict = field(default_factory=dict)   # lower name : SystemDict
+    targets: dict = field(default_factory=dict)   # lower name : [TargetDict]
+    threats: dict = field(default_factory=dict)   # lower target name : [threat]
+    factions: dict = field(default_factory=dict)  # lower faction name : [presence]
+    grid: dict = field(default_factory=dict)      # cell : [(name, x, y, z)]
+
+    @staticmethod
+    def Build(bubble: BubbleExpansion) -> "QueryModel":
+        model = QueryModel(datetime.now().isoformat())
+        system: System
+        for system in bubble.systems:
+            key = system.name.lower()
+            model.systems[key] = SystemDict(system)
+            model.targets[key] = list(TargetDict(t, i+1)
+                                      for i, t in enumerate(system.expansion_targets))
+            for f in system.factions:
+                model.factions.setdefault(f.name.lower(), []).append({'system': system.name, 'influence': f.influence,
+                                                                      'controlling': f.name == system.controllingFaction})
+            for i, t in enumerate(system.expansion_targets):
+                model.threats.setdefault(t.systemname.lower(), []).append({'source': system.name, 'attacker': system.controllingFaction,
+                                                                           'isPlayer': bool(system.controllingdetails and system.controllingdetails.isPlayer), 'sourceinfluence': system.influence, **TargetDict(t, i+1)})
+            if system.population > 0:
+                model.grid.setdefault(QueryModel.Cell(system.x, system.y, system.z), []).append(
+                    (system.name, system.x, system.y, system.z))
+        for presence in model.factions.values():
+            presence.sort(key=lambda x: x['influence'], reverse=True)
+        return model
+
+    @staticmethod
+    def Cell(x: float, y: float, z: float) -> tuple:
+        return (floor(x/CELL), floor(y/CELL), floor(z/CELL))
+
+    def Details(self, name: str) -> dict | None:
+        return self.systems.get(name.lower())
+
+    def Targets(self, name: str, n: int = 5) -> list | None:
+        return self.targets[name.lower()][:n] if name.lower() in self.targets else None
+
+    def Threats(self, name: str, cycles: int = 5, paranoia: float = CSNSettings.PARANOIA_LEVEL, all_factions: bool = False) -> list:
+        """ Systems whose next few Expansions land on this System, as InvasionMessages """
+        return list(_ for _ in self.threats.get(name.lower(), []) if _['priority'] <= cycles and _['sourceinfluence'] > paranoia and
+                    (all_factions or (_['isPlayer'] and not CSNSettings.isIgnored(_['attacker']))))
+
+    def Faction(self, name: str, above: float = 0, controlling: bool = False) -> list:
+        return list(_ for _ in self.factions.get(name.lower(), []) if _['influence'] > above and (_['controlling'] or not controlling))
+
+    def Cube(self, name: str, ly: float = 20) -> list | None:
+        """ Populated Systems within ly Cube, sorted by Distance """
+        if not (centre := self.Details(name)):
+            return None
+        x, y, z = centre['x'], centre['y'], centre['z']
+        lo, hi = self.Cell(x-ly, y-ly, z-ly), self.Cell(x+ly, y+ly, z+ly)
+        answer = []
+        for cx in range(lo[0], hi[0]+1):
+            for cy in range(lo[1], hi[1]+1):
+                for cz in range(lo[2], hi[2]+1):
+                    for s in self.grid.get((cx, cy, cz), []):
+                        if max(abs(s[1]-x), abs(s[2]-y), abs(s[3]-z)) < ly:
+                            answer.append({'name': s[0], 'distance': round(
+                                ((s[1]-x)**2+(s[2]-y)**2+(s[3]-z)**2)**0.5, 2)})
+        return sorted(answer, key=lambda x: x['distance'])
+
+
+class QueryService:
+    """ Holds the current QueryModel and reloads it in the background """
+
+    def __init__(self, faction: str = CSNSettings.FACTION, range: float = 40) -> None:
+        self.faction = faction
+        self.range = range
+        self.bubble: BubbleExpansion = None
+        self.model: QueryModel = None
+        self.listener: EDDNListener = None
+        self.lock = threading.RLock()  # One reload at a time, queries never wait on it
+
+    def Reload(self) -> bool:
+        """ Refresh the Bubble if EDSM has new data and swap in a new model """
+        with self.lock:
+            systems = GetSystemsFromEDSM(self.faction, self.range, warm=True)
+            if self.bubble is None:
+                self.bubble = BubbleExpansion(systems, self.faction, savejson=False)
+            elif not self.bubble.Update(systems) and self.model:
+                return False
+            if self.listener:
+                self.listener.Track(self.bubble.systems)
+                self.bubble.Update(self.bubble.systems)
+            self.model = QueryModel.Build(self.bubble)
+            CSNSettings.CSNLog.info(
+                f'Query Model Loaded {len(self.model.systems)} systems')
+            return True
+
+    def Live(self, changed: list[System]) -> None:
+        """ EDDN has updated some Systems, recalculate around them and swap in a new model """
+        with self.lock:
+            self.bubble.Update(self.bubble.systems)
+            self.model = QueryModel.Build(self.bubble)
+
+    def Listen(self) -> None:
+        """ Apply live EDDN updates as they arrive """
+        self.listener = EDDNListener(
+            self.bubble.systems, on_flush=self.Live, lock=self.lock)
+        self.listener.Start()
+
+    def Reloader(self, stop: threading.Event) -> None:
+        while not stop.wait(RELOAD_MINUTES*60):
+            try:
+                self.Reload()
+            except Exception as e:
+                CSNSettings.CSNLog.info(f'Query Reload Failed : {e}')
+                print(f'!! Query Reload Failed : {e}')
+
+    def Answer(self, path: str, query: dict) -> tuple[int, object]:
+        """ Route a request to the current model. Returns HTTP status and JSON ready answer """
+        model = self.model  # Hold this snapshot for the whole query
+        parts = list(unquote(_) for _ in path.strip('/').split('/', 1))
+
+        def arg(name, default, cast=str):
+            return cast(query[name][0]) if name in query else default
+
+        match parts:
+            case [''] | ['health']:
+                return 200, {'faction': self.faction, 'loaded': model.loaded, 'systems': len(model.systems),
+                             'eddn': {'received': self.listener.received, 'applied': self.listener.applied} if self.listener else None}
+            case ['reload']:
+                threading.Thread(target=self.Reload, daemon=True).start()
+                return 202, {'reload': 'started'}
+            case ['system', name]:
+                answer = model.Details(name)
+            case ['targets', name]:
+                answer = model.Targets(name, arg('n', 5, int))
+            case ['threats', name]:
+                answer = model.Threats(name, arg('cycles', 5, int), arg('paranoia', CSNSettings.PARANOIA_LEVEL, float),
+                                       arg('all', '0') in ('1', 'true', 'True'))
+            case ['faction', name]:
+                answer = model.Faction(name, arg('above', 0, float), arg(
+                    'controlling', '0') in ('1', 'true', 'True'))
+            case ['cube', name]:
+                answer = model.Cube(name, arg('range', 20, float))
+            case ['whatif', name]:
+                if not arg('faction', ''):
+                    return 400, {'error': 'whatif needs a faction'}
+                edit = WhatIfEdit(name, arg('faction', ''), arg('influence', None, float), arg('retreat', '0') in ('1', 'true', 'True'),
+                                  list(State(_) for _ in arg('states', '').split(',') if _) if 'states' in query else None,
+                                  arg('control', '0') in ('1', 'true', 'True'))
+                with self.lock:  # Not while a reload is changing the Bubble
+                    answer = asdict(self.bubble.WhatIf(
+                        [edit], arg('cycles', 5, int)))
+            case _:
+                return 404, {'error': f'Unknown query {path}'}
+        return (200, answer) if answer is not None else (404, {'error': f'Not Found {parts[-1]}'})
+
+
+def Serve(service: QueryService, host: str = HOST, port: int = PORT) -> None:
+    """ Serve queries until interrupted """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            try:
+                status, answer = service.Answer(url.path, parse_qs(url.query))
+            except (ValueError, KeyError) as e:
+                status, answer = 400, {'error': str(e)}
+            body = json.dumps(answer).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    stop = threading.Event()
+    threading.Thread(target=service.Reloader,
+                     args=(stop,), daemon=True).start()
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f'CSN Query Service on http://{host}:{port}/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    server.server_close()
+
+
+if __name__ == '__main__':
+    """
+        e.g. /system/Suhte  /targets/Suhte?n=10  /threats/Suhte?all=1&paranoia=60
+             /faction/Canonn?above=75&controlling=1  /cube/Suhte?range=30
+             /whatif/Suhte?faction=Canonn&influence=40  /whatif/Suhte?faction=X&retreat=1  /whatif/Suhte?faction=X&states=War
+    """
+    args = list(_ for _ in sys.argv[1:] if not _.startswith('--'))
+    service = QueryService(args[0] if args else CSNSettings.FACTION)
+    service.Reload()
+    if '--eddn' in sys.argv:
+        service.Listen()
+    Serve(service)
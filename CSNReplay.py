@@ -0,0 +1,261 @@
+# Record every provider response of a run, and Replay them later without touching the network
+from dataclasses import dataclass, field, asdict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from datetime import datetime
+import threading
+import hashlib
+import zipfile
+import atexit
+import json
+import time
+import os
+import CSNSettings
+
+REPLAYDIR = 'data\\replay'
+WRITES = ('POST', 'PUT', 'PATCH', 'DELETE')  # Methods that change something, never sent when replaying
+
+
+class ReplayMiss(Exception):
+    """ A request that was not recorded """
+    pass
+
+
+@dataclass
+class Exchange:
+    """ One recorded request and its response. The body is in the archive under its hash """
+    key: str
+    endpoint: str
+    method: str
+    url: str
+    status: int = 200
+    headers: dict = field(default_factory=dict)
+    body: str = ''  # sha256 of the response body
+    elapsed: float = 0
+
+
+# mode is '', 'record' or 'replay'. latency is seconds added to each replayed call, or 'recorded'.
+# base is the archive first recorded to, saved is how many exchanges the archive already has
+_REPLAY = {'mode': '', 'archive': '', 'base': '', 'latency': 0, 'exchanges': [], 'blobs': {},
+           'served': {}, 'writes': [], 'saved': 0, 'lock': threading.Lock()}
+GZIP = b'\x1f\x8b'  # Bodies starting with this are already compressed, so stored as they are
+
+
+def Key(method: str, url: str, params: dict = None, body=None) -> str:
+    """ Identity of a request, independent of the order of its parameters. Google API keys are not part of it """
+    parts = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query) + list((params or {}).items())
+                   if k != 'key')
+    url = urlunsplit((parts.scheme, parts.netloc,
+                     parts.path, urlencode(query), ''))
+    return hashlib.sha256(json.dumps([method.upper(), url, body], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def Loose(method: str, url: str) -> str:
+    """ Identity of a write, ignoring what was written """
+    return method.upper()+' '+url.split('?')[0]
+
+
+def Record(archive: str = '') -> str:
+    """ Record all provider responses until the process ends. Returns the archive file """
+    _Reset('record', archive or datetime.now().strftime('%Y%m%d%H%M%S'))
+    _REPLAY['base'] = _REPLAY['archive']
+    atexit.register(Save)
+    CSNSettings.CSNLog.info(f"Recording provider responses to {_REPLAY['archive']}")
+    return _REPLAY['archive']
+
+
+def Replay(archive: str, latency: float | str = 0) -> None:
+    """ Serve provider responses from archive. latency in seconds is added to every call, 'recorded' waits as long as the original did.\n
+        Writes to Discord and Google are captured to a writes file alongside the archive instead of being sent
+    """
+    _Reset('replay', archive, latency if latency == 'recorded' else float(latency or 0))
+    with zipfile.ZipFile(_REPLAY['archive'], 'r') as zip:
+        _REPLAY['exchanges'] = list(Exchange(**_)
+                                    for _ in json.loads(zip.read('index.json')))
+        _REPLAY['blobs'] = {name[6:]: zip.read(name) for name in zip.namelist()
+                            if name.startswith('blobs/')}
+    atexit.register(SaveWrites)
+    CSNSettings.CSNLog.info(
+        f"Replaying {len(_REPLAY['exchanges'])} provider responses from {_REPLAY['archive']}")
+
+
+def ReplayArgs(argv: list[str]) -> None:
+    """ Record or Replay from --record, --record=name, --replay=name and --latency=seconds|recorded command line options """
+    args = dict(_[2:].split('=', 1) if '=' in _ else (_[2:], '')
+                for _ in argv if _.startswith('--'))
+    if 'record' in args:
+        Record(args['record'])
+    elif args.get('replay'):
+        Replay(args['replay'], args.get('latency', 0))
+
+
+def NextRun() -> None:
+    """ Between the runs of the Daemon. A recording is saved and the next run records to its own archive, so none grows without limit.
+        A replay serves the next run from the start again
+    """
+    if Recording():
+        Save()
+        _Reset('record', _REPLAY['base'][:-4] +
+               datetime.now().strftime('.%Y%m%d%H%M%S')+'.zip')
+    elif Replaying():
+        SaveWrites()
+        with _REPLAY['lock']:
+            _REPLAY['served'] = {}
+
+
+def Recording() -> bool:
+    return _REPLAY['mode'] == 'record'
+
+
+def Replaying() -> bool:
+    return _REPLAY['mode'] == 'replay'
+
+
+def _Reset(mode: str, archive: str, latency: float | str = 0) -> None:
+    if not archive.endswith('.zip') and not os.path.dirname(archive):
+        archive = os.path.join(REPLAYDIR, archive+'.zip')
+    _REPLAY.update({'mode': mode, 'archive': archive, 'latency': latency, 'exchanges': [], 'blobs': {},
+                    'served': {}, 'writes': [], 'saved': 0})
+
+
+def _Keep(endpoint: str, method: str, url: str, key: str, status: int, headers: dict, body: bytes, elapsed: float) -> None:
+    """ Add an Exchange to the recording, storing each distinct body once """
+    digest = hashlib.sha256(body).hexdigest()
+    with _REPLAY['lock']:
+        _REPLAY['blobs'].setdefault(digest, body)
+        _REPLAY['exchanges'].append(Exchange(key, endpoint, method.upper(), url, status, dict(headers),
+                                             digest, round(elapsed, 4)))
+
+
+def _Find(key: str, method: str, url: str) -> Exchange:
+    """ The next recorded Exchange for a request. Repeated requests are served in the order they were recorded, then the last again.\n
+        A write that was not recorded as it was made is matched on where it was sent
+    """
+    with _REPLAY['lock']:
+        matches = list(_ for _ in _REPLAY['exchanges'] if _.key == key)
+        if not matches and method.upper() in WRITES:
+            loose = Loose(method, url)
+            matches = list(_ for _ in _REPLAY['exchanges']
+                           if Loose(_.method, _.url) == loose)
+        if not matches:
+            raise ReplayMiss(f'{method} {url}')
+        served = _REPLAY['served'].get(key, 0)
+        _REPLAY['served'][key] = served + 1
+    exchange = matches[min(served, len(matches)-1)]
+    _Wait(exchange)
+    return exchange
+
+
+def _Wait(exchange: Exchange) -> None:
+    latency = exchange.elapsed if _REPLAY['latency'] == 'recorded' else _REPLAY['latency']
+    if latency:
+        time.sleep(latency)
+
+
+def _Capture(endpoint: str, method: str, url: str, body) -> None:
+    with _REPLAY['lock']:
+        _REPLAY['writes'].append({'endpoint': endpoint, 'method': method.upper(), 'url': url.split('?')[0],
+                                  'body': body, 'at': datetime.now().isoformat()})
+
+
+def Request(endpoint: str, method: str, url: str, **kwargs):
+    """ requests.request, unless Recording or Replaying """
+    import requests
+
+    if not _REPLAY['mode']:
+        return requests.request(method, url, **kwargs)
+
+    body = kwargs.get('json', kwargs.get('data'))
+    key = Key(method, url, kwargs.get('params'), body)
+    if Recording():
+        start = time.perf_counter()
+        resp = requests.request(method, url, **kwargs)
+        _Keep(endpoint, method, url, key, resp.status_code, resp.headers, resp.content,
+              time.perf_counter()-start)
+        return resp
+
+    if method.upper() in WRITES:
+        _Capture(endpoint, method, url, body)
+    try:
+        exchange = _Find(key, method, url)
+    except ReplayMiss:
+        if method.upper() not in WRITES:
+            raise
+        exchange = Exchange(key, endpoint, method, url, 204)
+    resp = requests.Response()
+    resp.status_code = exchange.status
+    resp.headers = requests.structures.CaseInsensitiveDict(exchange.headers)
+    resp._content = _REPLAY['blobs'].get(exchange.body, b'')
+    resp._content_consumed = True
+    resp.url = url
+    resp.encoding = requests.utils.get_encoding_from_headers(resp.headers)
+    return resp
+
+
+def Execute(endpoint: str, request) -> dict:
+    """ Google API request.execute(), unless Recording or Replaying """
+    if not _REPLAY['mode']:
+        return request.execute()
+
+    body = json.loads(request.body) if request.body else None
+    key = Key(request.method, request.uri, body=body)
+    if Recording():
+        start = time.perf_counter()
+        result = request.execute()
+        _Keep(endpoint, request.method, request.uri, key, 200, {}, json.dumps(result).encode('utf-8'),
+              time.perf_counter()-start)
+        return result
+
+    if request.method.upper() in WRITES:
+        _Capture(endpoint, request.method, request.uri, body)
+    try:
+        exchange = _Find(key, request.method, request.uri)
+    except ReplayMiss:
+        if request.method.upper() not in WRITES:
+            raise
+        return {}
+    return json.loads(_REPLAY['blobs'][exchange.body])
+
+
+def Save() -> str:
+    """ Write the recording as a zip of an index and compressed, content addressed bodies.\n
+        Only if there is more since it was last saved, as both the end of a run and the end of the process save it
+    """
+    if not Recording() or len(_REPLAY['exchanges']) == _REPLAY['saved']:
+        return ''
+    os.makedirs(os.path.dirname(_REPLAY['archive']) or '.', exist_ok=True)
+    with _REPLAY['lock']:
+        temp = _REPLAY['archive']+'.tmp'
+        with zipfile.ZipFile(temp, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=9) as zip:
+            zip.writestr('index.json', json.dumps(
+                list(asdict(_) for _ in _REPLAY['exchanges']), indent=1))
+            for digest, body in _REPLAY['blobs'].items():
+                zip.writestr('blobs/'+digest, body,
+                             compress_type=zipfile.ZIP_STORED if body[:2] == GZIP else None)
+        os.replace(temp, _REPLAY['archive'])
+        _REPLAY['saved'] = len(_REPLAY['exchanges'])
+    CSNSettings.CSNLog.info(
+        f"Recorded {len(_REPLAY['exchanges'])} responses, {len(_REPLAY['blobs'])} distinct, to {_REPLAY['archive']}")
+    print(f"Recorded {len(_REPLAY['exchanges'])} responses to {_REPLAY['archive']}")
+    return _REPLAY['archive']
+
+
+def SaveWrites() -> str:
+    """ Write the captured Discord and Google writes of a replay as json lines """
+    if not Replaying() or not _REPLAY['writes']:
+        return ''
+    file = _REPLAY['archive'][:-4] + \
+        f".{datetime.now().strftime('%Y%m%d%H%M%S')}.writes.jsonl"
+    with _REPLAY['lock'], open(file, 'w') as io:
+        for write in _REPLAY['writes']:
+            io.write(json.dumps(write, default=str)+'\n')
+        _REPLAY['writes'] = []
+    print(f'Replay writes captured to {file}')
+    return file
+
+
+# Recording or Replaying can also be left on in .env
+if CSNSettings.RECORD:
+    Record(CSNSettings.RECORD)
+elif CSNSettings.REPLAY:
+    Replay(CSNSettings.REPLAY, CSNSettings.REPLAY_LATENCY)
@@ -1,11 +1,40 @@
-from CSN import GenerateMissions
 from providers.GoogleSheets import CSNSchedule
+from datetime import datetime
+import CSNSettings
+import CSNMetrics
+import CSNReplay
+import json
+import os
+import platform
+import signal
+import sys
+import time
+import traceback
 
+try:
+    import resource  # Not available on Windows
+except ImportError:
+    resource = None
 
-def Schedule():
+HEALTHFILE = 'data\\CSNDaemon.json'
+MAXRUNS = 48  # Start from scratch after this many runs, to keep memory bounded
+CHECKMINUTE = 5  # Minutes past the hour to check the schedule
+RETRYMINUTES = 10  # A failed run is retried after this long, resuming from the Stage that failed
+RETRIES = 3  # at most this many times in the same hour
+
+_STOP = False
+
+
+def ColdStart() -> None:
+    """ CSN.ColdStart, if any run has loaded CSN """
+    if CSN := sys.modules.get('CSN'):
+        CSN.ColdStart()
+
+
+def Schedule(now: int = None, keepwarm: bool = False) -> str | None:
     full: bool = False
     # Read Cannon Google Sheet
-    schedule: str = CSNSchedule()
+    schedule: str = CSNSchedule(now)
     if schedule:
         full = schedule.upper() == 'NEW'
         print(f"Scheduled : {schedule} = {'Full' if full else 'Update'}")
@@ -15,9 +44,88 @@ def Schedule():
 
     # full = True
 
-    GenerateMissions(uselivedata=True, DiscordFullReport=full,
-                     DiscordUpdateReport=not full)
+    # Only now there is something to do, as CSN brings in every provider and the Expansion engine
+    from CSN import GenerateMissions, GenerateAllMissions
+    if configs := CSNSettings.Factions():
+        GenerateAllMissions(configs, uselivedata=True, DiscordFullReport=full,
+                            DiscordUpdateReport=not full, keepwarm=keepwarm)
+    else:
+        GenerateMissions(uselivedata=True, DiscordFullReport=full,
+                         DiscordUpdateReport=not full, keepwarm=keepwarm)
+    return schedule
+
+
+def HealthSave(health: dict) -> None:
+    """ Write the Daemon's health for any monitor to read """
+    if resource:
+        health['maxrss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with open(HEALTHFILE+'.tmp', 'w') as io:
+        json.dump(health, io, indent=4)
+    os.replace(HEALTHFILE+'.tmp', HEALTHFILE)
+
+
+def Stop(signum, frame) -> None:
+    """ Finish any run in progress, then stop """
+    global _STOP
+    _STOP = True
+    print('Stopping...')
+    CSNSettings.CSNLog.info(f'Daemon Stop requested ({signum})')
+
+
+def Daemon() -> None:
+    """ Stay running and check the schedule once an hour, keeping the Bubble warm between runs """
+    signal.signal(signal.SIGINT, Stop)
+    signal.signal(signal.SIGTERM, Stop)
+    health = {'node': platform.node(), 'pid': os.getpid(), 'started': datetime.now().isoformat(),
+              'status': 'starting', 'checked': None, 'lastrun': None, 'schedule': None, 'runs': 0, 'error': None}
+    HealthSave(health)
+    CSNSettings.CSNLog.info('Daemon Started')
+    checked: tuple = None
+    retry: tuple = (None, 0, 0)  # hour, failures, when
+    while not _STOP:
+        now = datetime.utcnow()
+        if retry[0] == (now.date(), now.hour) and retry[1] <= RETRIES and time.monotonic() >= retry[2]:
+            checked = None
+            retry = (retry[0], retry[1], float('inf'))
+        if now.minute >= CHECKMINUTE and checked != (now.date(), now.hour):
+            checked = (now.date(), now.hour)
+            health['checked'] = datetime.now().isoformat()
+            health['status'] = 'running'
+            HealthSave(health)
+            ran = True
+            try:
+                if schedule := Schedule(now.hour, keepwarm=True):
+                    health['runs'] += 1
+                    health['lastrun'] = datetime.now().isoformat()
+                    health['schedule'] = schedule
+                    if health['runs'] % MAXRUNS == 0:
+                        ColdStart()
+                ran = bool(schedule)
+                health['error'] = None
+                retry = (None, 0, 0)
+            except Exception as e:
+                CSNSettings.CSNLog.info(
+                    f'Daemon Run Failed : {e}\n{traceback.format_exc()}')
+                print(f'!! Daemon Run Failed : {e}')
+                health['error'] = str(e)
+                ColdStart()
+                failures = retry[1]+1 if retry[0] == checked else 1
+                retry = (checked, failures, time.monotonic()+RETRYMINUTES*60)
+            if ran:  # Each run recorded or replayed on its own
+                CSNReplay.NextRun()
+            health['status'] = 'waiting'
+            HealthSave(health)
+        time.sleep(5)
+
+    health['status'] = 'stopped'
+    HealthSave(health)
+    CSNSettings.CSNLog.info('Daemon Stopped')
 
 
 if __name__ == '__main__':
-    Schedule()
+    CSNMetrics.ProfileArgs(sys.argv)
+    CSNReplay.ReplayArgs(sys.argv)
+    if '--daemon' in sys.argv:
+        Daemon()
+    else:
+        Schedule()
@@ -1,6 +1,7 @@
 import logging
 import platform
 from dotenv import dotenv_values
+from classes.FactionConfig import FactionConfig
 import json
 
 myEnv = dotenv_values('.env.'+platform.node())
@@ -25,12 +26,29 @@ _ALLIES = myEnv.get('allies').split(",")
 PARANOIA_LEVEL = float(myEnv.get('invasionparanoialevel'))
 LIGHTHOUSE = myEnv.get('lighthousesystem')
 
-# dIcons from json file
-try:
-    with open(f'resources\\DiscordIcons.json', 'r') as io:
-        ICONS = json.load(io)
-except:
-    ICONS = {}
+# Stages to Profile, see CSNMetrics.Profile. Normally blank
+PROFILE: str = myEnv.get('profile', '')
+# Record provider responses to, or Replay them from, an archive in data\replay, see CSNReplay. Normally blank
+RECORD: str = myEnv.get('record', '')
+REPLAY: str = myEnv.get('replay', '')
+REPLAY_LATENCY: str = myEnv.get('replaylatency', '0')
+# Also read Spansh's galaxy dump, using whichever of it and EDSM is fresher for each System. Normally False
+SPANSH: bool = myEnv.get('spansh', '')[:1].upper() in ['Y', 'T']
+# Json list of Faction settings to run together from one Bubble, see classes.FactionConfig. Normally blank
+FACTIONSFILE: str = myEnv.get('factions', '')
+
+
+def __getattr__(name: str):
+    """ dIcons from json file, read the first time ICONS is used """
+    global ICONS
+    if name != 'ICONS':
+        raise AttributeError(f"module 'CSNSettings' has no attribute '{name}'")
+    try:
+        with open(f'resources\\DiscordIcons.json', 'r') as io:
+            ICONS = json.load(io)
+    except:
+        ICONS = {}
+    return ICONS
 
 
 def isIgnored(faction: str) -> bool:
@@ -43,6 +61,36 @@ def isAlly(faction: str) -> bool:
     return faction in _ALLIES
 
 
+# The Faction from .env, which the settings above are for unless UseFaction has changed them
+ENVFACTION = FactionConfig(FACTION, _ALLIES, _IGNOREPF, PARANOIA_LEVEL, WEBHOOK_ID or '', WEBHOOK_TOKEN or '',
+                           OVERRIDE_WORKBOOK or '', EXTENDEDPHASE, LIGHTHOUSE or '')
+
+
+def Factions() -> list[FactionConfig]:
+    """ Faction settings for a multi faction run from FACTIONSFILE, empty for a normal run """
+    if not FACTIONSFILE:
+        return []
+    with open(FACTIONSFILE, 'r') as io:
+        return list(FactionConfig(**_) for _ in json.load(io))
+
+
+def UseFaction(config: FactionConfig = None) -> None:
+    """ Point the Faction settings at config, or back at .env's.\n
+        Everything that reads them at the time, messages, Discord, Google and the per Faction data files, then works for that Faction
+    """
+    global FACTION, _ALLIES, _IGNOREPF, PARANOIA_LEVEL, WEBHOOK_ID, WEBHOOK_TOKEN, OVERRIDE_WORKBOOK, EXTENDEDPHASE, LIGHTHOUSE
+    config = config or ENVFACTION
+    FACTION = config.name
+    _ALLIES = config.allies
+    _IGNOREPF = config.ignored
+    PARANOIA_LEVEL = config.paranoia
+    WEBHOOK_ID = config.webhook_id
+    WEBHOOK_TOKEN = config.webhook_token
+    OVERRIDE_WORKBOOK = config.sheet
+    EXTENDEDPHASE = config.extendedphase
+    LIGHTHOUSE = config.lighthouse
+
+
 # No orders to boost inf for system control etc. Leave it to the system owner. Not Used Yet.
 surrendered_systems = ['A List of System Names']
 
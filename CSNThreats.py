@@ -0,0 +1,60 @@
+# Invasion Threats between every Faction in the populated Bubble
+import sys
+import CSNSettings
+from CSNMetrics import Staged
+from classes.BubbleExpansion import BubbleExpansion
+from classes.ThreatMatrix import ThreatMatrix, THREATFILE
+from classes.ExpansionOdds import ExpansionOdds, SAMPLES, SPREAD, CYCLES
+from providers.EDSM import GetSystemsFromEDSM
+
+
+@Staged('Threat Matrix')
+def ThreatAnalysis(cycles: int = 5, warm: bool = False, file: str = THREATFILE) -> ThreatMatrix:
+    """ Expands every populated System in the EDSM dump and saves which Factions each one's next cycles Expansions land on """
+    systems = GetSystemsFromEDSM('', warm=warm)
+    bubble = BubbleExpansion(systems, '')  # No empire, so no History
+    matrix = ThreatMatrix.Build(bubble.systems, cycles)
+    matrix.Save(file)
+    print(
+        f'Threat Matrix {len(matrix)} threats between {len(matrix.factions)} factions')
+    CSNSettings.CSNLog.info(
+        f'Threat Matrix {len(matrix)} threats between {len(matrix.factions)} factions')
+    return matrix
+
+
+def OddsAnalysis(faction: str = CSNSettings.FACTION, samples: int = SAMPLES, spread: float = SPREAD,
+                 paranoia: float = CSNSettings.PARANOIA_LEVEL, warm: bool = False, cycles: int = CYCLES) -> ExpansionOdds:
+    """ Monte Carlo odds of the faction's next Expansions, and of the Invasions threatening it within cycles, from its Bubble """
+    bubble = BubbleExpansion(GetSystemsFromEDSM(faction, warm=warm), faction, savejson=False)
+    odds = ExpansionOdds.Estimate(bubble.systems, faction, samples, spread, paranoia, cycles=cycles)
+    print(
+        f'Expansion Odds {len(odds.sources)} sources, {len(odds.threats)} threats over {samples} samples')
+    CSNSettings.CSNLog.info(
+        f'Expansion Odds {len(odds.sources)} sources, {len(odds.threats)} threats over {samples} samples')
+    return odds
+
+
+if __name__ == '__main__':
+    # --defender=name or --attacker=name to query the last saved matrix, otherwise build a new one. --cycles=5 --paranoia=0
+    # --odds for Monte Carlo odds of our next Expansions and the threats to us, --samples=2000 --spread=3 (needs numpy)
+    args = dict(_[2:].split('=', 1) for _ in sys.argv if _.startswith('--') and '=' in _)
+    cycles = int(args.get('cycles', 5))
+    if '--odds' in sys.argv:
+        odds = OddsAnalysis(samples=int(args.get('samples', SAMPLES)), spread=float(args.get('spread', SPREAD)),
+                            paranoia=float(args.get('paranoia', CSNSettings.PARANOIA_LEVEL)), cycles=cycles)
+        for source, targets in odds.sources.items():
+            print(f"{source} : {', '.join(f'{t} {p:.0%}' for t, p in list(targets.items())[:3])}")
+        for threat in odds.threats:
+            print(f"{threat['probability']:.0%} {threat['attacker']} ({threat['influence']}%) {threat['source']} -> {threat['target']} {threat['description']}")
+        sys.exit()
+    if 'defender' in args or 'attacker' in args:
+        matrix = ThreatMatrix.Load()
+    else:
+        matrix = ThreatAnalysis(cycles)
+    paranoia = float(args.get('paranoia', 0))
+    if 'attacker' in args:
+        edges = matrix.Attacks(args['attacker'], cycles, paranoia)
+    else:
+        edges = matrix.Threats(args.get('defender', CSNSettings.FACTION), cycles, paranoia)
+    for edge in edges:
+        print(f"{edge['priority']} {edge['attacker']} ({edge['influence']}%) {edge['source']} -> {edge['target']} {edge['description']} of {edge['defender']}")
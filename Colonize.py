@@ -1,6 +1,110 @@
-from providers.EDSM import GetUnpopulated
+# Finds unpopulated Systems the faction could colonise, ranked by how close and how well placed they are
+from math import floor, sqrt
+import json
+import sys
+import CSNSettings
+from CSNMetrics import Staged
+from classes.Bubble import Bubble
+from classes.BubbleExpansion import BubbleExpansion
+from classes.ColonisationTarget import ColonisationTarget
+from providers.EDSM import GetSystemsFromEDSM, RefreshUnpopulatedTiles, UnpopulatedTiles
+from providers.EDSMTiles import TileStore, TileKey
 
-s = GetUnpopulated()
-for x in s:
-    if x.name == 'Khun':
-        print(x)
+COLONYRANGE = 15  # ly from an existing System a new colony can be claimed
+NEIGHBOURS = list((dx, dy, dz) for dx in (-1, 0, 1)
+                  for dy in (-1, 0, 1) for dz in (-1, 0, 1))
+
+
+def Cell(x: float, y: float, z: float, size: float) -> tuple[int, int, int]:
+    return (floor(x/size), floor(y/size), floor(z/size))
+
+
+def Near(sources: list[tuple], size: float) -> dict[tuple, list[tuple]]:
+    """ Sources in and around each cell of a grid, for every cell within one of a source """
+    grid: dict[tuple, list[tuple]] = {}
+    for source in sources:
+        grid.setdefault(Cell(*source[1:], size), []).append(source)
+    near: dict[tuple, list[tuple]] = {}
+    for (cx, cy, cz), inside in grid.items():
+        for dx, dy, dz in NEIGHBOURS:
+            near.setdefault((cx+dx, cy+dy, cz+dz), []).extend(inside)
+    return near
+
+
+@Staged('Colonisation Targets')
+def ColonisationTargets(bubble: Bubble, faction: str = CSNSettings.FACTION, range: float = COLONYRANGE,
+                        store: TileStore = None, rank: str = 'distance') -> list[ColonisationTarget]:
+    """ Every unpopulated System within range ly of a System the faction is present in.\n
+        Sorted by distance to the nearest of them, or with rank='reach' by how many of them would have it in expansion range.\n
+        The faction's Systems are bucketed into grids with cells the size of each range, so each candidate is only
+        compared with the few Systems in the cells around it. range should be no more than the 40ly the Bubble was read with,
+        as candidates are only known to be unpopulated if they are not in the Bubble
+    """
+    ours = list((s.name, s.x, s.y, s.z) for s in bubble.faction_presence(faction))
+    store = store or TileStore.Open(UnpopulatedTiles())
+    if not ours or not store:
+        return []
+    populated = set(s.id64 for s in bubble.systems)
+    expansion = BubbleExpansion.EXTENDEDRANGE
+    close, reaching = Near(ours, range), Near(ours, expansion)
+
+    # Candidates from one Region per tile our Systems are in, covering all of them
+    blocks: dict[tuple, list[tuple]] = {}
+    for source in ours:
+        blocks.setdefault(TileKey(*source[1:]), []).append(source)
+    candidates: dict[int, tuple] = {}
+    for sources in blocks.values():
+        lo = list(min(_[i] for _ in sources) for i in (1, 2, 3))
+        hi = list(max(_[i] for _ in sources) for i in (1, 2, 3))
+        centre = list((a+b)/2 for a, b in zip(lo, hi))
+        half = max((b-a)/2 for a, b in zip(lo, hi))
+        for found in store.Region(*centre, half+range):
+            candidates.setdefault(found[1], found)
+
+    targets: list[ColonisationTarget] = []
+    for name, id64, _, x, y, z in candidates.values():
+        if id64 in populated or not (sources := close.get(Cell(x, y, z, range))):
+            continue
+        best, nearest = range, None
+        for source, sx, sy, sz in sources:
+            if (d := sqrt((x-sx)**2+(y-sy)**2+(z-sz)**2)) <= best:
+                best, nearest = d, source
+        if nearest:
+            reach = sum(1 for _, sx, sy, sz in reaching[Cell(x, y, z, expansion)]
+                        if -expansion < x-sx < expansion and -expansion < y-sy < expansion and -expansion < z-sz < expansion)
+            targets.append(ColonisationTarget(
+                name, id64, x, y, z, round(best, 2), nearest, reach))
+
+    if rank == 'reach':
+        targets.sort(key=lambda _: (-_.reach, _.distance, _.systemname))
+    else:
+        targets.sort(key=lambda _: (_.distance, -_.reach, _.systemname))
+    print(f'Colonisation {len(targets)} targets from {len(candidates)} candidates')
+    CSNSettings.CSNLog.info(
+        f'Colonisation {len(targets)} targets from {len(candidates)} candidates')
+    return targets
+
+
+def SaveColonisationJson(targets: list[ColonisationTarget], faction: str = CSNSettings.FACTION) -> str:
+    """ Saves the targets as rows for the Patrol sheet, System, X, Y, Z, TI=0, Faction, Message, Icon, with the ranking alongside """
+    file = f'data\\{faction}ColonisationTargets.json'
+    rows = list({'system': t.systemname, 'x': t.x, 'y': t.y, 'z': t.z, 'ti': 0, 'faction': faction,
+                 'message': f'Colonisation Target {t.distance}ly from {t.nearest}, {t.reach} of our systems in expansion range',
+                 'icon': CSNSettings.ICONS['push'], 'id64': t.id64, 'distance': t.distance, 'nearest': t.nearest, 'reach': t.reach}
+                for t in targets)
+    with open(file, 'w') as io:  # Dump to file
+        json.dump(rows, io, indent=4)
+    return file
+
+
+if __name__ == '__main__':
+    # --range=15 ly from our Systems, --rank=distance|reach
+    args = dict(_[2:].split('=', 1) for _ in sys.argv if _.startswith('--') and '=' in _)
+    myFactionName = CSNSettings.FACTION
+    RefreshUnpopulatedTiles()
+    myBubble = Bubble(GetSystemsFromEDSM(myFactionName), myFactionName)
+    targets = ColonisationTargets(myBubble, myFactionName, float(args.get('range', COLONYRANGE)),
+                                  rank=args.get('rank', 'distance'))
+    for t in targets[:20]:
+        print(f'  {t}')
+    print(f'Saved to {SaveColonisationJson(targets, myFactionName)}')
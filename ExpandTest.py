@@ -1,7 +1,11 @@
 import CSNSettings
+import CSNMetrics
+import sys
 from classes.BubbleExpansion import BubbleExpansion
 from classes.System import System
 from classes.ExpansionTarget import ExpansionTarget
+from classes.ExpansionRoute import RoutePlanner
+from classes.WhatIf import WhatIfEdit
 import CSN
 
 
@@ -23,6 +27,8 @@ if __name__ == '__main__':
     # Defaults to settings, but can change it to spy on others. NB, data will not be as quite as good in regards to previous retreats.
     # DONT go fiddling with CSNSettings.FACTION, it will bugger up SystemHistory
     myFactionName = CSNSettings.FACTION
+    # --profile or --profile=Stage,Stage to Profile e.g. --profile="EDSM Delta,Expand All"
+    CSNMetrics.ProfileArgs(sys.argv)
 
     if True:
         myBubble: BubbleExpansion = BubbleExpansion(
@@ -43,6 +49,22 @@ if __name__ == '__main__':
             if targets := source_system.expansion_targets:
                 printexpansions(source_system.name, targets, length=3)
 
+    # Next 5 cycles of Expansions, each one changing where the next goes. sources=[...] to plan a managed Expansion
+    print(f"\nForecast {myFactionName}'s next Expansions")
+    for step in myBubble.Forecast(myFactionName, cycles=5):
+        print(f"  {step}")
+
+    # Managed Expansion Route between 2 Systems, with the Targets to deal with before each hop. extended=True for 30ly hops
+    planner = RoutePlanner(myBubble, myFactionName)
+    print(f"\nRoute from Varati to Suhte")
+    for hop in planner.Route('Varati', 'Suhte') or []:
+        print(f"  {hop}")
+
+    # What If. How next Expansions and threats change if a Faction retreats, gets pushed or goes to War
+    print(f"\nWhat if {myFactionName} retreats from {mySystems[-1].name}")
+    print(myBubble.WhatIf(
+        [WhatIfEdit(mySystems[-1].name, myFactionName, retreat=True)]))
+
     # TODO Invasion of Faction
 
     # System of Interest
@@ -53,6 +75,12 @@ if __name__ == '__main__':
     if targets := mySystem.expansion_targets:
         printexpansions(mySystem.name, targets, 20)
 
+    # Our Systems within 20ly with a Refinery economy and a Shipyard, from the Station Index built from the EDSM dump
+    if stations := mySystem.stationindex:
+        print(f"\nRefinery with Shipyard near {mySystemName}")
+        for system in stations.Find(myBubble, mySystem, 20, ['Refinery'], ['Shipyard'], faction=myFactionName):
+            print(f"  {system.name} {', '.join(_.name for _ in system.getstations())}")
+
     # TODO Single System Invasion Threats Regardless of Player Faction Status (change all_factions to FALSE for Player Factions only)
     threats_to_system = CSN.InvasionMessages(myBubble.systems,
                                              [mySystem], max_cycles=3, paranoia_level=60, myfaction=mySystem.controllingFaction, all_factions=True)
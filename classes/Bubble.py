@@ -1,8 +1,17 @@
 from dataclasses import dataclass, field
 from classes.System import System
-from math import sqrt
+from math import sqrt, floor
 import CSNSettings
 
+GRIDCELL = 20  # ly edge of the grid cells Systems are indexed by for cube_systems
+
+
+def GridCells(x: float, y: float, z: float, ly: float) -> list[tuple[int, int, int]]:
+    """ Grid cells overlapping a ly Cube """
+    lo = (floor((x-ly)/GRIDCELL), floor((y-ly)/GRIDCELL), floor((z-ly)/GRIDCELL))
+    hi = (floor((x+ly)/GRIDCELL), floor((y+ly)/GRIDCELL), floor((z+ly)/GRIDCELL))
+    return list((cx, cy, cz) for cx in range(lo[0], hi[0]+1) for cy in range(lo[1], hi[1]+1) for cz in range(lo[2], hi[2]+1))
+
 
 @dataclass
 class Bubble:
@@ -13,11 +22,29 @@ class Bubble:
     # key is system name, value is a set of all factions that have ever been present
     systemhistory: dict[str, set[str]] = field(
         default_factory=dict[str, set[str]])
+    # (systems, count, grid, names) indexes of the Systems, rebuilt when the list is replaced or grows. Not a field, nor pickled
+    _index = None
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.pop('_index', None)
+        return state
+
+    def index(self) -> tuple[dict[tuple, list[tuple[int, System]]], dict[str, System]]:
+        """ Systems with their position in the list by GRIDCELL cube, and Systems by lower case name """
+        if self._index is None or self._index[0] is not self.systems or self._index[1] != len(self.systems):
+            grid: dict[tuple, list[tuple[int, System]]] = {}
+            names: dict[str, System] = {}
+            for i, system in enumerate(self.systems):
+                grid.setdefault((floor(system.x/GRIDCELL), floor(system.y/GRIDCELL),
+                                floor(system.z/GRIDCELL)), []).append((i, system))
+                names.setdefault(system.name.lower(), system)
+            self._index = (self.systems, len(self.systems), grid, names)
+        return self._index[2], self._index[3]
 
     def getsystem(self, name: str) -> System | None:
         """ Returns a System object from it's name """
-        """ Yes, probably could be a dict of sometype but too much for v0"""
-        return next((x for x in self.systems if x.name.lower() == name.lower()), None)
+        return self.index()[1].get(name.lower())
 
     def distance(self, a: System, b: System) -> float:
         """ Direct Straight Line Distance between 2 systems """
@@ -33,8 +60,12 @@ class Bubble:
             Use Range of 20 for Simple Expansion, 30 for Extended\n
             Sorted by Distance
         """
+        grid = self.index()[0]
+        # Only the Systems in the grid cells around, in the order of the list
+        near = list(_[1] for _ in sorted(_ for cell in GridCells(system.x, system.y, system.z, range)
+                                         for _ in grid.get(cell, ())))
         ans = sorted(list(filter(lambda x: self.cube_distance(
-            system, x) < range and x.population > 0 and (exclude_presense == '' or not x.isfactionpresent(exclude_presense)), self.systems)), key=lambda x: self.distance(x, system))
+            system, x) < range and x.population > 0 and (exclude_presense == '' or not x.isfactionpresent(exclude_presense)), near)), key=lambda x: self.distance(x, system))
         return ans
 
     def faction_presence(self, factionname: str) -> list[System]:
@@ -3,8 +3,11 @@ from classes.Bubble import Bubble
 from classes.System import System
 from classes.Presense import Presence
 from classes.ExpansionTarget import ExpansionTarget
+from classes.ExpansionForecast import BubbleView, ForecastStep, EXPANSIONINFLUENCE
+from classes.WhatIf import WhatIfEdit, WhatIfDiff
 import CSNSettings
-import simplejson as json
+from CSNMetrics import Stage, Staged
+import json
 from providers.EliteBGS import EBGSPreviousVisitors
 import pickle
 import os
@@ -22,66 +25,196 @@ class BubbleExpansion(Bubble):
     """ Can calculate Extended on Demand """
     SIMPLERANGE: float = 20
     EXTENDEDRANGE: float = 30
+    # key is system name, value is the System.fingerprint when its expansions were last calculated
+    fingerprints: dict[str, tuple] = field(
+        default_factory=dict[str, tuple], repr=False)
+    # Factions sharing the Bubble in a multi faction run. key is faction name, value is the names of the Systems in its range,
+    # each Faction keeps the History of its own Systems. None for a normal run
+    members: dict[str, set[str]] = field(default=None, repr=False)
+    # Factions in their Extended Expansion phase. None for just the .env Faction if EXTENDEDPHASE
+    extendedfactions: set[str] = field(default=None, repr=False)
+    # Save the Expansion and Invasion json of your own faction's Bubble. Off for anything but the normal run, whose files they are
+    savejson: bool = field(default=True, repr=False)
 
     def __post_init__(self):
         self.systems = sorted(self.systems, key=lambda x: x.name)
-        if self.empire == CSNSettings.FACTION:  # Keep the History file for your own faction
+        if self.isOwn():  # Keep the History file for your own faction
             self.HistoryLoad()
         self._ExpandAll()
 
+    def isOwn(self) -> bool:
+        """ Is this the Bubble of your own faction, or of a multi faction run, rather than someone else's or nobody's.\n
+            Only those keep History, and save the Expansion and Invasion json the normal run reads unless savejson is off
+        """
+        return bool(self.members or self.empire == CSNSettings.FACTION)
+
+    @Staged('Expand All')
     def _ExpandAll(self) -> None:
         """ Calculate Simple Expansion for all Systems, or Extended as specified in .env """
         print('Calculating Expansion Targets...')
         CSNSettings.CSNLog.info('Calculating Expansion Targets...')
         system: System
         for system in self.systems:
-            system.expansion_targets = self.ExpandFromSystem(
-                system, extended=(system.controllingFaction and system.controllingFaction == CSNSettings.FACTION and CSNSettings.EXTENDEDPHASE))
-        self.saveExpansionJson()
-        self.saveInvasionJson()
+            self._ExpandSystem(system)
+        if self.savejson and self.isOwn():
+            self.saveExpansionJson()
+            self.saveInvasionJson()
+
+    def isExtended(self, faction: str) -> bool:
+        """ Is the Faction in its Extended Expansion phase """
+        if self.extendedfactions is not None:
+            return faction in self.extendedfactions
+        return bool(faction and faction == CSNSettings.FACTION and CSNSettings.EXTENDEDPHASE)
+
+    def _ExpandSystem(self, system: System) -> None:
+        """ Calculate Expansion Targets for a single System """
+        system.expansion_targets = self.ExpandFromSystem(
+            system, extended=self.isExtended(system.controllingFaction))
+        self.fingerprints[system.name] = system.fingerprint
+
+    @Staged('Bubble Update')
+    def Update(self, systems: list[System]) -> int:
+        """ Replace the Systems with a refreshed list, recalculating only the Expansions within range of a changed System.\n
+            Returns the number of Systems recalculated
+        """
+        old: dict[str, System] = {_.name: _ for _ in self.systems}
+        changed: list[System] = []
+        system: System
+        for system in systems:
+            was = old.pop(system.name, None)
+            if was is None or self.fingerprints.get(system.name) != system.fingerprint:
+                changed.append(system)
+            elif system is not was:
+                system.expansion_targets = was.expansion_targets
+        # Anything left in old has gone from the Bubble
+        changed.extend(old.values())
+        for name in old.keys():
+            self.fingerprints.pop(name, None)
+
+        self.systems = sorted(systems, key=lambda x: x.name)
+        if self.isOwn():
+            self.HistoryLoad()
+
+        recalc: list[System] = []
+        if changed:
+            recalc = list(_ for _ in self.systems if any(
+                self.cube_distance(_, c) < self.EXTENDEDRANGE for c in changed))
+        print(
+            f'Recalculating Expansion Targets for {len(recalc)}/{len(self.systems)}...')
+        CSNSettings.CSNLog.info(
+            f'Recalculating Expansion Targets for {len(recalc)} systems, {len(changed)} changed')
+        for system in recalc:
+            self._ExpandSystem(system)
+        if recalc and self.savejson and self.isOwn():
+            self.saveExpansionJson()
+            self.saveInvasionJson()
+        return len(recalc)
 
     def ExpandFromSystem(self, source_system: System, extended: bool = False) -> list:
         """ Calculate all expansion targets for a system"""
         targets: list[ExpansionTarget] = []
-        for target_system in self.cube_systems(source_system, exclude_presense=source_system.controllingFaction):
-            target_distance: float = source_system.distance(target_system)
-            target_cube_distance: float = source_system.cube_distance(
-                target_system)
-            target_retreated_bonus = 100 if (source_system.controllingFaction in self.systemhistory[
-                target_system.name]) else 0
-            if len(target_system.factions) > 7:
-                # Too many factions to invade
-                pass
-            elif not target_system.factions:
-                # No factions - dead system or prison
-                pass
-            elif len(target_system.factions) < 7:
-                # Expansion into a spare slot
-                expansion = ExpansionTarget(
-                    target_system.name, description='Expansion', score=target_retreated_bonus+target_distance/100, faction=target_system.factions[0])
-                if target_cube_distance < self.SIMPLERANGE:
-                    targets.append(expansion)
-                elif extended:
-                    expansion.extended = True
-                    targets.append(expansion)
-
-            else:
-                # Possible Invasion
-                current_faction: Presence
-                for current_faction in target_system.factions:
-                    # Must NOT be a Native or Controlling Faction, or in a conflict
-                    if not (current_faction.isNative or current_faction.name == target_system.controllingFaction or current_faction.activeconflict):
-                        expansion = ExpansionTarget(
-                            target_system.name, description='Invasion', faction=current_faction, score=target_retreated_bonus+current_faction.influence)
-                        if target_cube_distance < self.SIMPLERANGE:
-                            targets.append(expansion)
-                        elif extended:
-                            expansion.extended = True
-                            targets.append(expansion)
+        # Targets past SIMPLERANGE are only wanted for Extended
+        for target_system in self.cube_systems(source_system, self.EXTENDEDRANGE if extended else self.SIMPLERANGE,
+                                               exclude_presense=source_system.controllingFaction):
+            targets.extend(self.ExpandInto(
+                source_system, target_system, extended))
         if targets:
             targets = sorted(targets, key=lambda x: x.score)
         return targets
 
+    def ExpandInto(self, source_system: System, target_system: System, extended: bool = False) -> list[ExpansionTarget]:
+        """ Expansion targets in one System for a system, unsorted """
+        targets: list[ExpansionTarget] = []
+        target_distance: float = source_system.distance(target_system)
+        target_cube_distance: float = source_system.cube_distance(
+            target_system)
+        target_retreated_bonus = 100 if (source_system.controllingFaction in self.systemhistory.get(
+            target_system.name, ())) else 0
+        if len(target_system.factions) > 7:
+            # Too many factions to invade
+            pass
+        elif not target_system.factions:
+            # No factions - dead system or prison
+            pass
+        elif len(target_system.factions) < 7:
+            # Expansion into a spare slot
+            expansion = ExpansionTarget(
+                target_system.name, description='Expansion', score=target_retreated_bonus+target_distance/100, faction=target_system.factions[0])
+            if target_cube_distance < self.SIMPLERANGE:
+                targets.append(expansion)
+            elif extended:
+                expansion.extended = True
+                targets.append(expansion)
+
+        else:
+            # Possible Invasion
+            current_faction: Presence
+            for current_faction in target_system.factions:
+                # Must NOT be a Native or Controlling Faction, or in a conflict
+                if not (current_faction.isNative or current_faction.name == target_system.controllingFaction or current_faction.activeconflict):
+                    expansion = ExpansionTarget(
+                        target_system.name, description='Invasion', faction=current_faction, score=target_retreated_bonus+current_faction.influence)
+                    if target_cube_distance < self.SIMPLERANGE:
+                        targets.append(expansion)
+                    elif extended:
+                        expansion.extended = True
+                        targets.append(expansion)
+        return targets
+
+    @Staged('Expansion Forecast')
+    def Forecast(self, faction: str = None, cycles: int = 5, sources: list[str] = None,
+                 influence: float = EXPANSIONINFLUENCE) -> list[ForecastStep]:
+        """ Simulates the Faction's next cycles of Expansions, one per cycle, on a copy on write view of the Bubble.\n
+            Each cycle the controlled System with the highest influence over the influence given Expands to its next target,
+            unless sources names the System to Expand from that cycle, for a managed Expansion.
+            Only the Expansions within range of each simulated one are recalculated, and the Bubble is left as it was
+        """
+        faction = faction or self.empire
+        view = BubbleView(self)
+        controlled = sorted((_ for _ in self.systems if _.controllingFaction == faction),
+                            key=lambda x: x.influence, reverse=True)
+        steps: list[ForecastStep] = []
+        for cycle in range(1, cycles+1):
+            source: System = None
+            target: ExpansionTarget = None
+            if sources and cycle <= len(sources):
+                if not (source := view.getsystem(sources[cycle-1])):
+                    pass
+                elif source.controllingFaction != faction:  # Somewhere we have only just Expanded to
+                    target = view.Onward(faction, source, self.isExtended(faction))
+                elif targets := view.targets(source):
+                    target = targets[0]
+            else:
+                for system in controlled:
+                    if system.influence <= influence:
+                        break
+                    if targets := view.targets(view.getsystem(system.name)):
+                        source, target = system, targets[0]
+                        break
+            if target is None:
+                break  # Nothing left to Expand from, so nothing after it either
+            arrived = view.Expand(faction, target)
+            steps.append(ForecastStep(cycle, source.name, next((_.influence for _ in source.factions if _.name == faction), 0), target,
+                                      onward=view.Onward(
+                                          faction, arrived, self.isExtended(faction)),
+                                      full=len(arrived.factions) >= 7))
+        CSNSettings.CSNLog.info(
+            f'Forecast {faction} {len(steps)}/{cycles} cycles, {view.recalculated} systems recalculated')
+        return steps
+
+    @Staged('What If')
+    def WhatIf(self, edits: list[WhatIfEdit], cycles: int = 5) -> WhatIfDiff:
+        """ How the next Expansions and the threats of the next cycles would change with the edits applied.\n
+            The edits go on a copy on write view, so only the Systems in range of an edited one are updated and the Bubble is left as it was
+        """
+        view = BubbleView(self)
+        for edit in edits:
+            view.Edit(edit)
+        diff = view.Diff(cycles)
+        CSNSettings.CSNLog.info(
+            f'What If {len(edits)} edits, {diff.recalculated} systems updated, {len(diff.targets)} next Expansions and {len(diff.added)+len(diff.removed)} threats changed')
+        return diff
+
     def saveExpansionJson(self) -> None:
         """ Saves best expansion target for all myfactions systems\n"""
         """ Called from post_init so should already have been run """
@@ -117,23 +250,38 @@ class BubbleExpansion(Bubble):
             targets = json.load(io)
         return targets
 
+    @Staged('History Load')
     def HistoryLoad(self) -> None:
         """ Loads, refreshes and saves System History. This is a Dict of Systems with a set containing ALL factions that have ever been present """
         """ BEWARE Assumes Bubble has been reduced to a faction and Never Reduces"""
 
+        members = self.members or {self.empire: None}
+
+        def HistoryFile(faction: str) -> str:
+            return os.path.join(DATADIR, faction+'EBGS_SysHist.pickle')
+
         def HistorySave():
             os.makedirs(DATADIR, exist_ok=True)
-            with open(os.path.join(DATADIR, self.empire+'EBGS_SysHist.pickle'), 'wb') as io:
-                pickle.dump(self.systemhistory, io)
+            for faction, names in members.items():
+                if names is not None and not names & changed:
+                    continue
+                history = self.systemhistory if names is None else {
+                    k: v for k, v in self.systemhistory.items() if k in names}
+                with Stage('History Save', items=len(history)):
+                    with open(HistoryFile(faction), 'wb') as io:
+                        pickle.dump(history, io)
 
-        self.systemhistory = dict()
-        if os.path.exists(os.path.join(DATADIR, self.empire+'EBGS_SysHist.pickle')):
-            with open(os.path.join(DATADIR, self.empire+'EBGS_SysHist.pickle'), 'rb') as io:
-                self.systemhistory = pickle.load(io)
+        if not self.systemhistory:
+            for faction in members:
+                if os.path.exists(HistoryFile(faction)):
+                    with open(HistoryFile(faction), 'rb') as io:
+                        for name, factions in pickle.load(io).items():
+                            self.systemhistory.setdefault(
+                                name, set()).update(factions)
         print(
             f"Loading System History {len(self.systemhistory)}/{len(self.systems)}...")
         system: System
-        anychanges: bool = False
+        changed: set[str] = set()  # Names of Systems with new History
         for system in self.systems:
             # if system.name == 'Varati':
             #     bubble.systemhistory[system.name] = set()  # TEST
@@ -141,7 +289,7 @@ class BubbleExpansion(Bubble):
                 if not self.systemhistory.get(system.name, None):
                     self.systemhistory[system.name] = set(
                         EBGSPreviousVisitors(system.name))
-                    anychanges = True
+                    changed.add(system.name)
                     sleep(5)  # Be nice to EBGS
                 else:
                     faction: Presence
@@ -150,6 +298,6 @@ class BubbleExpansion(Bubble):
                             print(
                                 f" New Expansion Detected {system.name}, {faction.name}")
                             self.systemhistory[system.name].add(faction.name)
-                            anychanges = True
-        if anychanges:
+                            changed.add(system.name)
+        if changed:
             HistorySave()
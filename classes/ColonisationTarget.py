@@ -0,0 +1,17 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class ColonisationTarget():
+    """ An unpopulated System within colonisation range of the faction """
+    systemname: str
+    id64: int
+    x: float
+    y: float
+    z: float
+    distance: float  # to the nearest System the faction is present in
+    nearest: str = ''
+    reach: int = 0  # Systems the faction is present in with this one in expansion range
+
+    def __str__(self) -> str:
+        return f"{self.systemname} {self.distance}ly from {self.nearest}, {self.reach} in expansion range"
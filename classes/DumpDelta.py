@@ -0,0 +1,32 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+from classes.System import System
+
+
+@dataclass
+class DumpDelta:
+    """ Systems that have changed between two EDSM dumps """
+    updated: datetime
+    added: list[System] = field(default_factory=list)
+    modified: list[System] = field(default_factory=list)
+    removed: set[int] = field(default_factory=set)  # id64
+    unchanged: int = 0
+    # key is the hash of a System's record in the dump, value is its id64
+    hashes: dict[bytes, int] = field(default_factory=dict, repr=False)
+
+    def __len__(self) -> int:
+        return len(self.added)+len(self.modified)+len(self.removed)
+
+    def __str__(self) -> str:
+        return f"{len(self.added)} added, {len(self.modified)} modified, {len(self.removed)} removed, {self.unchanged} unchanged"
+
+    def Apply(self, systems: dict[int, System]) -> dict[int, System]:
+        """ Bring the Systems of the previous dump, keyed by id64, up to this one """
+        for system in systems.values():
+            if system.source == 'EDSM':
+                system.updated = self.updated
+        for id64 in self.removed:
+            systems.pop(id64, None)
+        for system in self.added + self.modified:
+            systems[system.id64] = system
+        return systems
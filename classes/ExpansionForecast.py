@@ -0,0 +1,158 @@
+from dataclasses import dataclass, replace
+from classes.System import System
+from classes.Presense import Presence
+from classes.ExpansionTarget import ExpansionTarget
+from classes.WhatIf import WhatIfEdit, WhatIfDiff
+
+EXPANSIONINFLUENCE = 75  # Influence of a controlled System that triggers an Expansion
+ARRIVALINFLUENCE = 5  # Influence of a Faction in the System it has just Expanded into
+
+
+@dataclass
+class ForecastStep:
+    """ One simulated Expansion of a Forecast """
+    cycle: int
+    source: str
+    influence: float
+    target: ExpansionTarget
+    onward: ExpansionTarget = None  # Where the Faction would Expand to next from the target
+    full: bool = False  # The target has no free slot left after the Expansion
+
+    def __str__(self) -> str:
+        return f"{self.cycle}: {self.source} ({self.influence:.2f}%) -> {self.target}{' Full' if self.full else ''}{f' then {self.onward}' if self.onward else ''}"
+
+
+class BubbleView:
+    """ Copy on Write view of a BubbleExpansion, for simulating Expansions and edits without touching the Bubble.\n
+        A System is only copied when it is changed or its Expansion Targets are updated, everything else is shared.
+        When a System changes, the Targets in it are replaced in the lists of the Systems it is in range of,
+        and its own Targets are recalculated when next asked for
+    """
+
+    def __init__(self, bubble: "BubbleExpansion") -> None:
+        self.bubble = bubble
+        self.SIMPLERANGE = bubble.SIMPLERANGE
+        self.EXTENDEDRANGE = bubble.EXTENDEDRANGE
+        self.systemhistory = bubble.systemhistory
+        self.overlay: dict[str, System] = {}  # Copies by name
+        self.stale: set[str] = set()  # Names of Systems whose Expansion Targets need recalculating
+        self.recalculated = 0
+
+    def getsystem(self, name: str) -> System | None:
+        if system := self.bubble.getsystem(name):
+            return self.overlay.get(system.name, system)
+        return None
+
+    def copy(self, system: System) -> System:
+        """ The view's own copy of a System, made on first write """
+        if (mine := self.overlay.get(system.name)) is None:
+            mine = self.overlay[system.name] = replace(system)
+        return mine
+
+    def cube_systems(self, system: System, range: float = 30, exclude_presense: str = '') -> list[System]:
+        """ As Bubble.cube_systems, with the view's copies in place of the originals """
+        near = (self.overlay.get(_.name, _) for _ in self.bubble.cube_systems(system, range))
+        return list(_ for _ in near if exclude_presense == '' or not _.isfactionpresent(exclude_presense))
+
+    def ExpandFromSystem(self, source_system: System, extended: bool = False) -> list[ExpansionTarget]:
+        """ BubbleExpansion.ExpandFromSystem, only reading the Bubble through the view """
+        return type(self.bubble).ExpandFromSystem(self, source_system, extended)
+
+    def ExpandInto(self, source_system: System, target_system: System, extended: bool = False) -> list[ExpansionTarget]:
+        return type(self.bubble).ExpandInto(self, source_system, target_system, extended)
+
+    def targets(self, system: System) -> list[ExpansionTarget]:
+        """ Expansion Targets of a System, recalculated if it has changed """
+        if system.name in self.stale:
+            self.stale.discard(system.name)
+            system = self.copy(system)
+            system.expansion_targets = self.ExpandFromSystem(
+                system, extended=self.bubble.isExtended(system.controllingFaction))
+            self.recalculated += 1
+        return system.expansion_targets
+
+    def Changed(self, system: System) -> None:
+        """ Replace the Targets in a changed System in the lists of every System it is in range of """
+        self.stale.add(system.name)
+        for near in self.bubble.cube_systems(system, self.EXTENDEDRANGE):
+            if near.name in self.stale:
+                continue
+            near = self.overlay.get(near.name, near)
+            extended = self.bubble.isExtended(near.controllingFaction)
+            if near.cube_distance(system) >= (self.EXTENDEDRANGE if extended else self.SIMPLERANGE):
+                continue
+            targets = list(
+                _ for _ in near.expansion_targets if _.systemname != system.name)
+            if system.population > 0 and (not near.controllingFaction or not system.isfactionpresent(near.controllingFaction)):
+                targets.extend(self.ExpandInto(near, system, extended))
+                # As ExpandFromSystem, by score then by distance then in the order of the Bubble
+                targets.sort(key=lambda x: (x.score, near.distance(
+                    self.getsystem(x.systemname)), x.systemname))
+            self.copy(near).expansion_targets = targets
+            self.recalculated += 1
+
+    def Expand(self, faction: str, target: ExpansionTarget) -> System:
+        """ Faction arrives in the target System, replacing the invaded Faction """
+        system = self.copy(self.getsystem(target.systemname))
+        system.factions = list(
+            _ for _ in system.factions if target.description != 'Invasion' or _.name != target.faction.name)
+        system.addfaction(Presence(0, faction, influence=ARRIVALINFLUENCE))
+        self.Changed(system)
+        return system
+
+    def Edit(self, edit: WhatIfEdit) -> System:
+        """ Apply a change to a Faction in a System """
+        if not edit.faction:
+            raise ValueError('No Faction to edit')
+        if not (system := self.getsystem(edit.system)):
+            raise ValueError(f'Unknown System {edit.system}')
+        was = next((_ for _ in system.factions if _.name == edit.faction), None)
+        if not was and (edit.retreat or (edit.influence is None and edit.states is None and not edit.control)):
+            raise ValueError(f'{edit.faction} not in {system.name}')
+        system = self.copy(system)
+        system.factions = list(
+            _ for _ in system.factions if _.name != edit.faction)
+        if not edit.retreat:
+            presence = replace(was) if was else Presence(
+                0, edit.faction, influence=ARRIVALINFLUENCE)
+            if edit.influence is not None:
+                presence.influence = edit.influence
+            if edit.states is not None:
+                presence.states = list(edit.states)
+            system.addfaction(presence)
+            if edit.control:
+                system.controllingFaction = edit.faction
+        elif system.controllingFaction == edit.faction:
+            system.controllingFaction = system.factions[0].name if system.factions else ''
+        self.Changed(system)
+        return system
+
+    def Onward(self, faction: str, system: System, extended: bool = False) -> ExpansionTarget | None:
+        """ Where the Faction would Expand to next if it controlled the System """
+        targets = self.ExpandFromSystem(
+            replace(system, controllingFaction=faction), extended)
+        return targets[0] if targets else None
+
+    @staticmethod
+    def Threats(system: System, cycles: int) -> set[tuple]:
+        """ As ThreatMatrix.Build, the System's next Expansions landing on another Faction """
+        return set((system.controllingFaction, t.faction.name, system.name, t.systemname, i+1, t.description, t.extended)
+                   for i, t in enumerate(system.expansion_targets[:cycles]) if system.controllingFaction and t.faction and t.faction.name != system.controllingFaction)
+
+    def Diff(self, cycles: int = 5) -> WhatIfDiff:
+        """ Next Expansions and threats that differ from the Bubble's """
+        for name in list(self.stale):
+            self.targets(self.getsystem(name))
+        diff = WhatIfDiff(recalculated=self.recalculated)
+        keys = ('attacker', 'defender', 'source', 'target',
+                'priority', 'description', 'extended')
+        for name, system in sorted(self.overlay.items()):
+            was = self.bubble.getsystem(name)
+            before, after = was.nextexpansion, system.nextexpansion
+            if str(before) != str(after):
+                diff.targets.append({'system': name, 'faction': system.controllingFaction,
+                                     'before': str(before) if before else None, 'after': str(after) if after else None})
+            old, new = self.Threats(was, cycles), self.Threats(system, cycles)
+            diff.added.extend(dict(zip(keys, _)) for _ in sorted(new-old))
+            diff.removed.extend(dict(zip(keys, _)) for _ in sorted(old-new))
+        return diff
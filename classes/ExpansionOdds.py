@@ -0,0 +1,145 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+import CSNSettings
+from CSNMetrics import Staged
+from classes.System import System
+
+SAMPLES = 2000
+SPREAD = 3.0  # Standard deviation of each Presence's influence by the Expansion tick, % points
+CYCLES = 5  # A threat is one of our Systems in a source's first this many Targets, as InvasionMessages' max_cycles
+CHUNK = 4000000  # Scores held at once, samples x candidate targets
+
+
+@dataclass
+class ExpansionOdds:
+    """ Monte Carlo estimate of where Expansions really go, as influence moves before the tick.\n
+        Every candidate Expansion Target of the Systems wanted is a column of scores, resampled for thousands of
+        influence perturbations at once, so a near tie between two Targets shows up as the coin flip it is
+    """
+    built: str = ''
+    faction: str = ''
+    samples: int = SAMPLES
+    spread: float = SPREAD
+    cycles: int = CYCLES
+    # key is source System name, the faction's and any that could Expand into it. Value is Expansion Target description : probability of being the next one
+    sources: dict[str, dict[str, float]] = field(default_factory=dict)
+    # The faction's Systems being the first of ours in a source's next cycles Expansions, with the source above paranoia,
+    # as InvasionMessages. source, attacker, target, description, influence, probability
+    threats: list[dict] = field(default_factory=list)
+
+    @staticmethod
+    @Staged('Expansion Odds')
+    def Estimate(systems: list[System], faction: str = CSNSettings.FACTION, samples: int = SAMPLES, spread: float = SPREAD,
+                 paranoia: float = CSNSettings.PARANOIA_LEVEL, seed: int = None, cycles: int = CYCLES) -> "ExpansionOdds":
+        """ Odds of the next Expansion of the faction's Systems, and of every System that could Expand into the faction, from Systems
+            whose Expansion Targets have been calculated, as in a BubbleExpansion.\n
+            Each Presence's influence is sampled around its current value. Expansion scores don't depend on influence,
+            Invasion scores are the retreat bonus plus the sampled influence of the Faction invaded.
+            A threat counts when one of the faction's Systems is within the source's first cycles Targets. Needs numpy
+        """
+        import numpy as np
+
+        odds = ExpansionOdds(datetime.now().isoformat(), faction, samples, spread, cycles)
+        sources = list(s for s in systems if s.expansion_targets and s.factions and (s.controllingFaction == faction or
+                       any(t.faction and t.faction.name == faction for t in s.expansion_targets)))
+        if not sources:
+            return odds
+
+        # One column per Presence, the last always 0 for Expansions, and one row per candidate Target
+        columns: dict[int, int] = {}
+        influences: list[float] = []
+
+        def column(presence) -> int:
+            if (n := columns.get(id(presence))) is None:
+                n = columns[id(presence)] = len(influences)
+                influences.append(presence.influence)
+            return n
+
+        starts, controllers, bases, cols, rows, ours = [], [], [], [], [], []
+        for j, system in enumerate(sources):
+            starts.append(len(rows))
+            controllers.append(column(system.factions[0]))
+            for target in system.expansion_targets:
+                if target.description == 'Invasion':
+                    bases.append(target.score-target.faction.influence)
+                    cols.append(column(target.faction))
+                else:
+                    bases.append(target.score)
+                    cols.append(-1)
+                rows.append((j, target))
+                ours.append(bool(target.faction and target.faction.name == faction and not system.isfactionpresent(faction)))
+        influences.append(0)
+        mean = np.array(influences)
+        base, col, start = np.array(bases), np.array(cols), np.array(starts)
+        controller = np.array(controllers)
+        segment = np.repeat(np.arange(len(sources)), np.diff(
+            np.append(start, len(rows))))
+        order = np.arange(len(rows))
+        # Each of our Targets paired with every Target of its source, so only ours are ranked. An Invasion score is
+        # between its base and base+100, so pairs no influence can reorder are settled once, and Targets always
+        # ranked cycles or worse are dropped
+        mine = np.flatnonzero(ours)
+        lengths = np.diff(np.append(start, len(rows)))[segment[mine]]
+        pair = np.repeat(np.arange(len(mine)), lengths)
+        pm = mine[pair]
+        pk = np.repeat(start[segment[mine]]-(np.cumsum(lengths)-lengths), lengths)+np.arange(lengths.sum())
+        lo, hi = base, base+100*(col >= 0)
+        always = (hi[pk] < lo[pm]) | ((hi[pk] <= lo[pm]) & (pk < pm))
+        never = (lo[pk] > hi[pm]) | ((lo[pk] >= hi[pm]) & (pk > pm)) | (pk == pm)
+        settled = np.bincount(pair, weights=always, minlength=len(mine)).astype(np.int64)
+        keep = settled < cycles
+        undecided = ~always & ~never & keep[pair]
+        mine, settled = mine[keep], settled[keep]
+        pair, pm, pk = (np.cumsum(keep)-1)[pair[undecided]], pm[undecided], pk[undecided]
+        counts = np.bincount(pair, minlength=len(mine))
+        pairstart, paired = np.cumsum(counts)-counts, counts > 0
+        # Our Targets grouped by source, as they are in row order
+        minestart = np.flatnonzero(np.r_[True, segment[mine][1:] != segment[mine][:-1]]) if len(mine) else mine
+        minesource = np.repeat(np.arange(len(minestart)), np.diff(np.append(minestart, len(mine))))
+        wins = np.zeros(len(rows), dtype=np.int64)
+        threatwins = np.zeros(len(rows), dtype=np.int64)
+
+        rng = np.random.default_rng(seed)
+        chunk = max(1, CHUNK//max(len(rows), len(pm)))
+        for done in range(0, samples, chunk):
+            n = min(chunk, samples-done)
+            sampled = np.clip(
+                mean+rng.normal(0, spread, (n, len(mean))), 0, 100)
+            sampled[:, -1] = 0
+            scores = base+sampled[:, col]
+            # Lowest score of each source, the first in the list on a tie as ExpandFromSystem's sort is stable
+            best = np.minimum.reduceat(scores, start, axis=1)
+            first = np.minimum.reduceat(np.where(
+                scores == best[:, segment], order, len(rows)), start, axis=1)
+            wins += np.bincount(first.ravel(), minlength=len(rows))
+            if not len(mine):
+                continue
+            # Rank of our Targets within their source, the Targets ahead by score then list order.
+            # The first of ours ranked under cycles is the threat
+            rank = np.tile(settled, (n, 1))
+            if len(pm):
+                sm, sk = scores[:, pm], scores[:, pk]
+                ahead = (sk < sm) | ((sk == sm) & (pk < pm))
+                rank[:, paired] += np.add.reduceat(ahead, pairstart[paired], axis=1)
+            rank = np.where(rank < cycles, rank, cycles)
+            threat = np.minimum.reduceat(rank, minestart, axis=1)
+            hit = (rank == threat[:, minesource]) & (rank < cycles)
+            hit &= (sampled[:, controller] > paranoia)[:, segment[mine]]
+            threatwins[mine] += hit.sum(axis=0)
+
+        for r, (j, target) in enumerate(rows):
+            system = sources[j]
+            if wins[r]:
+                odds.sources.setdefault(system.name, {})[
+                    str(target)] = round(int(wins[r])/samples, 4)
+            if threatwins[r]:
+                odds.threats.append({'source': system.name, 'attacker': system.controllingFaction, 'target': target.systemname,
+                                     'description': target.description, 'influence': round(system.influence, 2),
+                                     'probability': round(int(threatwins[r])/samples, 4)})
+        for name, targets in odds.sources.items():
+            odds.sources[name] = dict(
+                sorted(targets.items(), key=lambda x: x[1], reverse=True))
+        odds.threats.sort(key=lambda x: x['probability'], reverse=True)
+        CSNSettings.CSNLog.info(
+            f'Expansion Odds {faction} {len(sources)} sources, {len(rows)} targets, {samples} samples')
+        return odds
@@ -0,0 +1,94 @@
+from dataclasses import dataclass, field, replace
+from heapq import heappush, heappop
+import CSNSettings
+from CSNMetrics import Staged
+from classes.System import System
+from classes.ExpansionTarget import ExpansionTarget
+
+
+@dataclass
+class RouteHop:
+    """ One managed Expansion of a Route, and the Targets ahead of it that have to be dealt with first """
+    source: str
+    target: ExpansionTarget
+    blockers: list[ExpansionTarget] = field(default_factory=list)
+
+    def __str__(self) -> str:
+        ans = f"{self.source} -> {self.target}"
+        if self.blockers:
+            ans += f" after {', '.join(str(_) for _ in self.blockers)}"
+        return ans
+
+
+class RoutePlanner:
+    """ The Expansion graph of a Faction, for finding the chain of managed Expansions between two Systems.\n
+        Every populated System's Expansion Targets are calculated once, as if the Faction controlled it,
+        so a Route is an A* search over precalculated edges weighted by how many Targets are ahead of the one wanted
+    """
+
+    def __init__(self, bubble: "BubbleExpansion", faction: str = None, extended: bool = False) -> None:
+        self.faction = faction or bubble.empire
+        self.extended = extended
+        self.range = bubble.EXTENDEDRANGE if extended else bubble.SIMPLERANGE
+        self.systems: list[System] = list(
+            _ for _ in bubble.systems if _.population > 0)
+        self.numbers: dict[str, int] = {
+            _.name.lower(): i for i, _ in enumerate(self.systems)}
+        self.xs, self.ys, self.zs = (list(_.x for _ in self.systems), list(
+            _.y for _ in self.systems), list(_.z for _ in self.systems))
+        self.targets: list[list[ExpansionTarget]] = []
+        # edges[i] is (j, rank) for each System j the Faction could Expand to from i, rank is the Targets ahead of it
+        self.edges: list[list[tuple[int, int]]] = []
+        self.Build(bubble)
+
+    @Staged('Route Graph')
+    def Build(self, bubble: "BubbleExpansion") -> None:
+        for system in self.systems:
+            targets = bubble.ExpandFromSystem(
+                replace(system, controllingFaction=self.faction), self.extended)
+            edges: dict[int, int] = {}
+            for rank, target in enumerate(targets):
+                edges.setdefault(self.numbers[target.systemname.lower()], rank)
+            self.targets.append(targets)
+            self.edges.append(list(edges.items()))
+        CSNSettings.CSNLog.info(
+            f'Route Graph {self.faction} {len(self.systems)} systems, {sum(len(_) for _ in self.edges)} edges')
+
+    def Route(self, start: str, end: str) -> list[RouteHop] | None:
+        """ Cheapest chain of Expansions from start to end, each costing 1 plus the Targets ahead of it.\n
+            None if end can not be reached. Blockers are the Targets that have to be filled or pushed out first for each hop
+        """
+        if (a := self.numbers.get(start.lower())) is None or (b := self.numbers.get(end.lower())) is None:
+            return None
+        xs, ys, zs, edges, range = self.xs, self.ys, self.zs, self.edges, self.range
+        gx, gy, gz = xs[b], ys[b], zs[b]
+
+        best: dict[int, int] = {a: 0}
+        previous: dict[int, int] = {}
+        queue: list[tuple[float, int, int]] = [(0, 0, a)]
+        while queue:
+            _, cost, i = heappop(queue)
+            if i == b:
+                break
+            if cost > best[i]:
+                continue
+            for j, rank in edges[i]:
+                if (c := cost+1+rank) < best.get(j, c+1):
+                    best[j] = c
+                    previous[j] = i
+                    # Estimate of the cost still to go, as each hop moves less than range on every axis
+                    heappush(queue, (c+max(abs(xs[j]-gx), abs(ys[j]-gy), abs(zs[j]-gz))/range, c, j))
+        else:
+            return None
+
+        path = [b]
+        while path[-1] != a:
+            path.append(previous[path[-1]])
+        path.reverse()
+        hops: list[RouteHop] = []
+        for i, j in zip(path, path[1:]):
+            name = self.systems[j].name
+            rank = next(n for n, _ in enumerate(self.targets[i]) if _.systemname == name)
+            hops.append(RouteHop(self.systems[i].name, self.targets[i][rank],
+                                 list(_ for _ in self.targets[i][:rank] if _.systemname not in {h.target.systemname for h in hops})))
+        return hops
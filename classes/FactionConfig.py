@@ -0,0 +1,16 @@
+from dataclasses import dataclass, field
+
+
+@dataclass
+class FactionConfig:
+    """ Settings for one Faction of a multi faction run, as .env has for a single one """
+    name: str
+    allies: list[str] = field(default_factory=list)
+    # Player Factions to treat as NPCs
+    ignored: list[str] = field(default_factory=list)
+    paranoia: float = 70  # Inf % of expanding system to consider for mission message
+    webhook_id: str = ''  # Discord, blank for none
+    webhook_token: str = ''
+    sheet: str = ''  # Google override and patrol workbook, blank for none
+    extendedphase: bool = False
+    lighthouse: str = ''
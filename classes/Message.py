@@ -22,6 +22,11 @@ class Message:
     def __str__(self) -> str:
         return (f"{self.systemname} - {self.text}")
 
+    @property
+    def key(self) -> tuple:
+        """ Stable identity of a Message, for comparing between runs """
+        return (self.systemname, self.priority, self.text, self.emoji)
+
     @property
     def isDiscord(self) -> bool:
         return self.priority <= 10 or self.priority > 20
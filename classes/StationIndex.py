@@ -0,0 +1,189 @@
+from dataclasses import dataclass, field
+from array import array
+from classes.Station import Station
+
+FLAGS = ('Market', 'Shipyard', 'Outfitting')  # Services EDSM has as have flags rather than in otherServices
+
+
+@dataclass
+class StationIndex:
+    """ Every Station of the Systems from a dump, as columns rather than Station objects.\n
+        Each System has a bitset of the Economies and of the Services of all its Stations, so a filter is a mask test,
+        and its Stations are a run of rows in the Station table. Types, Factions, Economies and Services are stored once
+        and referred to by number. Station objects are only made when asked for
+    """
+    types: list[str] = field(default_factory=list)
+    factions: list[str] = field(default_factory=list)
+    economies: list[str] = field(default_factory=list)  # by bit
+    services: list[str] = field(default_factory=list)  # by bit
+    # Systems, key is id64, value is its row in the System columns
+    numbers: dict[int, int] = field(default_factory=dict)
+    economybits: array = field(default_factory=lambda: array('Q'))
+    servicebits: array = field(default_factory=lambda: array('Q'))
+    first: array = field(default_factory=lambda: array('I'))  # Station row of the System's first Station
+    count: array = field(default_factory=lambda: array('H'))
+    # Stations
+    ids: array = field(default_factory=lambda: array('Q'))  # EDSM's Station id, or the market id from Spansh
+    names: list[str] = field(default_factory=list)
+    kinds: array = field(default_factory=lambda: array('H'))
+    owners: array = field(default_factory=lambda: array('I'))
+    primary: array = field(default_factory=lambda: array('B'))  # Economy bit of the first Economy
+    stationeconomies: array = field(default_factory=lambda: array('Q'))
+    stationservices: array = field(default_factory=lambda: array('Q'))
+    garbage: int = 0  # Station rows of Systems since replaced or removed
+    # (number by name of types, factions, economies, services, decoded bitsets). Not a field, nor pickled
+    _index = None
+
+    def __len__(self) -> int:
+        return len(self.ids)-self.garbage
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.pop('_index', None)
+        return state
+
+    def index(self) -> tuple[dict, dict, dict, dict, dict]:
+        if self._index is None:
+            self._index = tuple({_: n for n, _ in enumerate(table)} for table in (
+                self.types, self.factions, self.economies, self.services)) + ({},)
+        return self._index
+
+    def number(self, table: int, name: str) -> int:
+        """ Number of a type, faction, economy or service, added if new """
+        lookup = self.index()[table]
+        if (n := lookup.get(name)) is None:
+            values = (self.types, self.factions,
+                      self.economies, self.services)[table]
+            if table >= 2 and len(values) == 64:
+                raise ValueError(f'More than 64 different {name}')
+            n = lookup[name] = len(values)
+            values.append(name)
+        return n
+
+    def Add(self, id64: int, stations: list[dict]) -> None:
+        """ A System's Stations as records from an EDSM dump, replacing any it had """
+        economies = services = 0
+        for station in stations:
+            primary = self.number(2, station['economy'])
+            economy = 1 << primary
+            if station['secondEconomy']:
+                economy |= 1 << self.number(2, station['secondEconomy'])
+            service = 0
+            for flag, have in zip(FLAGS, (station['haveMarket'], station['haveShipyard'], station['haveOutfitting'])):
+                if have:
+                    service |= 1 << self.number(3, flag)
+            for name in station['otherServices']:
+                service |= 1 << self.number(3, name)
+            owner = station['controllingFaction']['name'] if 'controllingFaction' in station.keys(
+            ) else station['type']
+            self.ids.append(station['id'])
+            self.names.append(station['name'])
+            self.kinds.append(self.number(0, station['type']))
+            self.owners.append(self.number(1, owner))
+            self.primary.append(primary)
+            self.stationeconomies.append(economy)
+            self.stationservices.append(service)
+            economies |= economy
+            services |= service
+
+        row = len(self.ids)-len(stations)
+        if (n := self.numbers.get(id64)) is None:
+            self.numbers[id64] = len(self.first)
+            self.economybits.append(economies)
+            self.servicebits.append(services)
+            self.first.append(row)
+            self.count.append(len(stations))
+            return
+        self.garbage += self.count[n]
+        self.economybits[n], self.servicebits[n] = economies, services
+        self.first[n], self.count[n] = row, len(stations)
+        if self.garbage > len(self.ids)//2:
+            self.Compact()
+
+    def Remove(self, id64: int) -> None:
+        """ A System that is no longer in the dump. Its row stays, with no Stations """
+        if (n := self.numbers.get(id64)) is not None:
+            self.garbage += self.count[n]
+            self.economybits[n] = self.servicebits[n] = self.count[n] = 0
+
+    def Compact(self) -> None:
+        """ Drop the Station rows no System refers to any more """
+        keep = array('I')
+        for n in range(len(self.first)):
+            start = self.first[n]
+            self.first[n] = len(keep)
+            keep.extend(range(start, start+self.count[n]))
+        for name in ('ids', 'kinds', 'owners', 'primary', 'stationeconomies', 'stationservices'):
+            column = getattr(self, name)
+            setattr(self, name, array(column.typecode, (column[_] for _ in keep)))
+        self.names = list(self.names[_] for _ in keep)
+        self.garbage = 0
+
+    def Mask(self, table: int, names: list[str]) -> int | None:
+        """ Bitset of economy or service names, None if any is not known so nothing can match """
+        lookup = self.index()[table]
+        mask = 0
+        for name in names:
+            if (n := lookup.get(name)) is None:
+                return None
+            mask |= 1 << n
+        return mask
+
+    def Names(self, table: int, bits: int) -> frozenset[str]:
+        """ Economy or service names of a bitset """
+        decoded = self.index()[4]
+        if (names := decoded.get((table, bits))) is None:
+            values = (self.economies, self.services)[table-2]
+            names = decoded[(table, bits)] = frozenset(
+                _ for n, _ in enumerate(values) if bits >> n & 1)
+        return names
+
+    def Economies(self, id64: int) -> frozenset[str]:
+        """ Economies of all of a System's Stations """
+        n = self.numbers.get(id64)
+        return self.Names(2, self.economybits[n]) if n is not None else frozenset()
+
+    def Services(self, id64: int) -> frozenset[str]:
+        """ Services of all of a System's Stations, including Market, Shipyard and Outfitting """
+        n = self.numbers.get(id64)
+        return self.Names(3, self.servicebits[n]) if n is not None else frozenset()
+
+    def Rows(self, id64: int) -> range:
+        if (n := self.numbers.get(id64)) is None:
+            return range(0)
+        return range(self.first[n], self.first[n]+self.count[n])
+
+    def Station(self, row: int) -> Station:
+        """ A Station object from its row """
+        first = self.economies[self.primary[row]]
+        economies = self.Names(2, self.stationeconomies[row])
+        services = self.Names(3, self.stationservices[row])
+        return Station(self.ids[row], self.types[self.kinds[row]], self.names[row], self.factions[self.owners[row]],
+                       first, next((_ for _ in economies if _ != first), ''),
+                       'Market' in services, 'Shipyard' in services, 'Outfitting' in services,
+                       list(_ for _ in self.services if _ in services and _ not in FLAGS))
+
+    def Stations(self, id64: int) -> list[Station]:
+        """ A System's Stations as objects """
+        return list(self.Station(_) for _ in self.Rows(id64))
+
+    def Match(self, id64: int, economies: int, services: int, samestation: bool = False) -> bool:
+        """ System has all the economies and services of the bitsets, with samestation in a single Station """
+        if (n := self.numbers.get(id64)) is None:
+            return False
+        if self.economybits[n] & economies != economies or self.servicebits[n] & services != services:
+            return False
+        return not samestation or any(self.stationeconomies[_] & economies == economies and
+                                      self.stationservices[_] & services == services for _ in self.Rows(id64))
+
+    def Find(self, bubble: "Bubble", centre: "System", range: float = 20, economies: list[str] = (), services: list[str] = (),
+             faction: str = '', samestation: bool = False) -> list["System"]:
+        """ Systems of the Bubble within a range ly Cube of centre with Stations having all the economies and services,
+            sorted by distance. Optionally only those the faction controls, or where one Station has them all
+        """
+        economymask, servicemask = self.Mask(
+            2, economies), self.Mask(3, services)
+        if economymask is None or servicemask is None:
+            return []
+        return list(_ for _ in bubble.cube_systems(centre, range) if (not faction or _.controllingFaction == faction) and
+                    self.Match(_.id64, economymask, servicemask, samestation))
@@ -28,9 +28,19 @@ class System:
     influence = 0
     factions: list = field(default_factory=list[Presence])
     stations: list = field(default_factory=list[Station])
+    # Where the Stations are instead when read from a dump, see classes.StationIndex
+    stationindex: "StationIndex" = field(default=None, repr=False, compare=False)
     # Only Pouplated in BubbleExpansion Sub-Class
     expansion_targets: list = field(default_factory=list[ExpansionTarget])
     updated: datetime = datetime.now()
+    # When the source last had news of the System itself, rather than when its dump was made. None if not known
+    recorded: datetime = None
+
+    def __getstate__(self) -> dict:
+        """ Pickled without the StationIndex, which is the whole dump's. Whoever reads the System back re-attaches the current one """
+        state = self.__dict__.copy()
+        state['stationindex'] = None
+        return state
 
     def __str__(self) -> str:
         ans = f"{self.name} : {self.controllingFaction} ({self.influence}%)"
@@ -79,6 +89,11 @@ class System:
             return self.expansion_targets[0]
         return None
 
+    @property
+    def fingerprint(self) -> tuple:
+        """ Everything about a System that Expansion calculations depend on, to detect changes between refreshes """
+        return (self.controllingFaction, self.population, tuple((f.name, f.influence, f.isNative, tuple(str(s) for s in f.states)) for f in self.factions))
+
     @property
     def influence(self) -> float:
         """ Controlling Faction Influence"""
@@ -87,10 +102,18 @@ class System:
     @property
     def economysavailable(self) -> {str}:
         """ Set of Economies of all Stations"""
+        if self.stationindex:
+            return self.stationindex.Economies(self.id64)
         ans = {x.economy1 for x in self.stations}.union(
             {x.economy2 for x in self.stations if x.economy2})
         return ans
 
+    def getstations(self) -> list[Station]:
+        """ The Stations, made from the StationIndex if they are in one """
+        if self.stationindex:
+            return self.stationindex.Stations(self.id64)
+        return self.stations
+
     @property
     def controllingdetails(self) -> Presence:
         """ Presence of Controlling Faction"""
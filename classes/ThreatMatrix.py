@@ -0,0 +1,123 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+from array import array
+import pickle
+from classes.System import System
+
+THREATFILE = 'data\\ThreatMatrix.pickle'
+INVASION, EXTENDED, PLAYER = 1, 2, 4  # Bits of an Edge's kind
+
+
+@dataclass
+class ThreatMatrix:
+    """ Every Faction's next Expansions that land on another Faction, as a sparse edge list.\n
+        Each Faction and System name is stored once, and each edge is a row of columns referring to them by number.
+        The edges of an attacker or defender are found through indexes built on first use
+    """
+    built: str = ''
+    cycles: int = 5  # Expansions of each System considered
+    factions: list[str] = field(default_factory=list)
+    systems: list[str] = field(default_factory=list)
+    attackers: array = field(default_factory=lambda: array('I'))
+    defenders: array = field(default_factory=lambda: array('I'))
+    sources: array = field(default_factory=lambda: array('I'))
+    targets: array = field(default_factory=lambda: array('I'))
+    priorities: array = field(default_factory=lambda: array('B'))  # 1 is the next Expansion
+    influences: array = field(default_factory=lambda: array('f'))  # of the attacker in the source System
+    kinds: array = field(default_factory=lambda: array('B'))
+    # (faction numbers by name, edges by attacker, edges by defender). Not a field, nor pickled
+    _index = None
+
+    def __len__(self) -> int:
+        return len(self.attackers)
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state.pop('_index', None)
+        return state
+
+    @staticmethod
+    def Build(systems: list[System], cycles: int = 5) -> "ThreatMatrix":
+        """ Edges from Systems whose Expansion Targets have been calculated, as in a BubbleExpansion """
+        matrix = ThreatMatrix(datetime.now().isoformat(), cycles)
+        factions: dict[str, int] = {}
+        names: dict[str, int] = {}
+
+        def number(table: dict, values: list, name: str) -> int:
+            if (n := table.get(name)) is None:
+                n = table[name] = len(values)
+                values.append(name)
+            return n
+
+        for system in systems:
+            attacker = system.controllingFaction
+            if not attacker:
+                continue
+            for i, target in enumerate(system.expansion_targets[:cycles]):
+                if not target.faction or target.faction.name == attacker:
+                    continue
+                matrix.attackers.append(
+                    number(factions, matrix.factions, attacker))
+                matrix.defenders.append(
+                    number(factions, matrix.factions, target.faction.name))
+                matrix.sources.append(
+                    number(names, matrix.systems, system.name))
+                matrix.targets.append(
+                    number(names, matrix.systems, target.systemname))
+                matrix.priorities.append(i+1)
+                matrix.influences.append(system.influence)
+                matrix.kinds.append((INVASION if target.description == 'Invasion' else 0) | (EXTENDED if target.extended else 0) |
+                                    (PLAYER if system.controllingdetails and system.controllingdetails.isPlayer else 0))
+        return matrix
+
+    def index(self) -> tuple[dict[str, int], dict[int, list[int]], dict[int, list[int]]]:
+        if self._index is None:
+            byattacker: dict[int, list[int]] = {}
+            bydefender: dict[int, list[int]] = {}
+            for i, (a, d) in enumerate(zip(self.attackers, self.defenders)):
+                byattacker.setdefault(a, []).append(i)
+                bydefender.setdefault(d, []).append(i)
+            self._index = ({_.lower(): n for n, _ in enumerate(self.factions)},
+                           byattacker, bydefender)
+        return self._index
+
+    def Edge(self, i: int) -> dict:
+        return {'attacker': self.factions[self.attackers[i]], 'defender': self.factions[self.defenders[i]],
+                'source': self.systems[self.sources[i]], 'target': self.systems[self.targets[i]],
+                'priority': self.priorities[i], 'influence': round(self.influences[i], 2),
+                'description': 'Invasion' if self.kinds[i] & INVASION else 'Expansion',
+                'extended': bool(self.kinds[i] & EXTENDED), 'isPlayer': bool(self.kinds[i] & PLAYER)}
+
+    def _Edges(self, edges: list[int], cycles: int, paranoia: float, players: bool) -> list[dict]:
+        return list(self.Edge(i) for i in sorted(edges, key=lambda i: (self.priorities[i], -self.influences[i]))
+                    if self.priorities[i] <= cycles and self.influences[i] > paranoia and (not players or self.kinds[i] & PLAYER))
+
+    def Threats(self, defender: str, cycles: int = 5, paranoia: float = 0, players: bool = False) -> list[dict]:
+        """ Expansions of other Factions landing on the defender's Systems, most imminent first.\n
+            As InvasionMessages, only those from a source above paranoia influence, and optionally only from Player Factions
+        """
+        names, _, bydefender = self.index()
+        return self._Edges(bydefender.get(names.get(defender.lower()), []), cycles, paranoia, players)
+
+    def Attacks(self, attacker: str, cycles: int = 5, paranoia: float = 0) -> list[dict]:
+        """ The attacker's Expansions landing on other Factions, most imminent first """
+        names, byattacker, _ = self.index()
+        return self._Edges(byattacker.get(names.get(attacker.lower()), []), cycles, paranoia, False)
+
+    def Pairs(self, cycles: int = 1) -> dict[tuple[str, str], int]:
+        """ The sparse matrix itself, number of Expansions by (attacker, defender) """
+        answer: dict[tuple[str, str], int] = {}
+        for a, d, p in zip(self.attackers, self.defenders, self.priorities):
+            if p <= cycles:
+                key = (self.factions[a], self.factions[d])
+                answer[key] = answer.get(key, 0) + 1
+        return answer
+
+    def Save(self, file: str = THREATFILE) -> None:
+        with open(file, 'wb') as io:
+            pickle.dump(self, io)
+
+    @staticmethod
+    def Load(file: str = THREATFILE) -> "ThreatMatrix":
+        with open(file, 'rb') as io:
+            return pickle.load(io)
@@ -0,0 +1,33 @@
+from dataclasses import dataclass, field
+from classes.State import State
+
+
+@dataclass
+class WhatIfEdit:
+    """ One change to a Faction in a System, for BubbleExpansion.WhatIf """
+    system: str
+    faction: str
+    influence: float = None  # New influence, adding the Faction if it is not present
+    retreat: bool = False  # Remove the Faction from the System
+    states: list[State] = None  # Replace the Faction's States, e.g. [State('War')] to protect it from Invasion
+    control: bool = False  # The Faction takes control of the System
+
+
+@dataclass
+class WhatIfDiff:
+    """ What a list of WhatIfEdits changes across the Bubble """
+    # Systems whose next Expansion changes. system, faction, before, after
+    targets: list[dict] = field(default_factory=list)
+    # Expansions of the next cycles landing on another Faction, as ThreatMatrix edges. attacker, defender, source, target, priority, description, extended
+    added: list[dict] = field(default_factory=list)
+    removed: list[dict] = field(default_factory=list)
+    recalculated: int = 0  # Systems whose Expansion Targets were recalculated or patched
+
+    def __str__(self) -> str:
+        ans = f"{len(self.targets)} next Expansions changed, {len(self.added)} threats added, {len(self.removed)} removed"
+        for t in self.targets:
+            ans += f"\n    {t['system']} ({t['faction']}) : {t['before']} -> {t['after']}"
+        for sign, threats in (('+', self.added), ('-', self.removed)):
+            for t in threats:
+                ans += f"\n  {sign} {t['priority']} {t['attacker']} {t['source']} -> {t['target']} {t['description']} of {t['defender']}"
+        return ans
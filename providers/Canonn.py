@@ -1,5 +1,5 @@
 # Canonn Research - Fleet Carrier Location
-import requests
+from CSNMetrics import HTTP
 import json
 
 _CANONN = 'https://us-central1-canonn-api-236217.cloudfunctions.net/query/'
@@ -11,7 +11,7 @@ def getfleetcarrier(fc_id):
         # url = f"{_CANONN}postFleetCarriers"
         # payload = {'serial': fc_id}
         url = f"{_CANONN}fleetCarrier/{fc_id}"
-        resp = requests.get(url)
+        resp = HTTP('Canonn fleetCarrier', 'GET', url)
         myload = json.loads(resp._content)[0]
     except:
         # CSNLog.info(f'Failed to find FC "{fc_id}"')
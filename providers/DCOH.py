@@ -1,7 +1,7 @@
 # Defence Council of Humanity provides Thargoid Activity
-import requests
 import json
 from CSNSettings import CSNLog
+from CSNMetrics import HTTP
 
 
 def dcohsummary():
@@ -12,7 +12,7 @@ def dcohsummary():
     url = f"https://dcoh.watch/api/v1/overwatch/systems"
     payload = {'ngsw-bypass': True}
     try:
-        resp = requests.get(url, params=payload)
+        resp = HTTP('DCOH overwatch', 'GET', url, params=payload)
         content = json.loads(resp._content)
         thargsystems = content["systems"]
         for sys in thargsystems:
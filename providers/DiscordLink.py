@@ -1,10 +1,96 @@
 # Sending to the registered Discord Channel
 from classes.Message import Message
 import CSNSettings
+from CSNMetrics import Staged, HTTP, Retry
 import pickle
-from discord import SyncWebhook
+import time
+from collections import deque
 
+_DISCORDURL = 'https://discord.com/api/webhooks/'
+MAXLENGTH = 2000  # Max len for a single hook
+MAXRETRIES = 5
 
+
+def UpdateMessages(messages: list[Message], oldmessages: list[Message]) -> list[Message]:
+    """ Changes since the last run. New or changed messages, plus old messages that have gone as Complete """
+    newkeys = set(_.key for _ in messages)
+    oldkeys = set(_.key for _ in oldmessages)
+
+    # Remove Unchanged Messages
+    answer: list[Message] = list(_ for _ in messages if _.key not in oldkeys)
+    systems = set(_.systemname for _ in answer)
+    for message in oldmessages:
+        if message.key not in newkeys and message.systemname not in systems and message.isDiscord:
+            # Add Old Message as Complete
+            message.complete = True
+            answer.append(message)
+            systems.add(message.systemname)
+    return answer
+
+
+def Posts(header: str, lines: list[str], continued: str) -> list[str]:
+    """ Split lines into as many posts as needed to stay within Discords limit.\n
+        A post always has a line after its header, one too long for any post is cut short
+    """
+    posts: list[str] = []
+    text: str = header
+    for line in lines:
+        if len(text) + len(line) > MAXLENGTH and text not in (header, continued):
+            posts.append(text)
+            text = continued
+        text += line[:MAXLENGTH-len(text)]
+    posts.append(text)
+    return posts
+
+
+def RateLimitWait(resp: "requests.Response") -> float:
+    """ Seconds to wait before the next request, from Discords rate limit headers """
+    if resp.status_code == 429:
+        return float(resp.headers.get('Retry-After', 1))
+    if resp.headers.get('X-RateLimit-Remaining') == '0':
+        return float(resp.headers.get('X-RateLimit-Reset-After', 0))
+    return 0
+
+
+def Retryable(e: Exception) -> bool:
+    """ Rate limited, a Discord server error, or the connection failed or timed out.\n
+        Any other 4xx, like a bad webhook, or any other error, like an invalid url from a blank webhook id, never succeeds
+    """
+    import requests
+
+    if (resp := getattr(e, 'response', None)) is not None:
+        return resp.status_code == 429 or resp.status_code >= 500
+    return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+
+def WebhookSend(posts: list[str]) -> int:
+    """ Send posts in order through a queue, waiting as Discords rate limit headers ask and retrying failures that may pass """
+    url = f"{_DISCORDURL}{CSNSettings.WEBHOOK_ID}/{CSNSettings.WEBHOOK_TOKEN}"
+    queue = deque((_, 0) for _ in posts)
+    sent: int = 0
+    while queue:
+        post, attempt = queue.popleft()
+        wait: float = 0
+        try:
+            resp = HTTP('Discord Webhook', 'POST', url, json={'content': post}, params={
+                        'wait': 'true'}, timeout=30)
+            wait = RateLimitWait(resp)
+            resp.raise_for_status()
+            sent += 1
+        except Exception as e:
+            if attempt + 1 < MAXRETRIES and Retryable(e):
+                Retry('Discord Webhook')
+                queue.appendleft((post, attempt + 1))
+                wait = max(wait, 2**attempt)
+            else:
+                CSNSettings.CSNLog.info(f"Discord Failed : {e}")
+                print(f"!! Discord Failed : {e}")
+        if queue and wait:
+            time.sleep(wait)
+    return sent
+
+
+@Staged('Discord')
 def WriteDiscord(Full: bool, messages: list[Message]) -> None:
     """ Write the messages to Discord Channel either a full report, or just the changes since last time """
     messages = list(filter(lambda _: _.isDiscord, messages))
@@ -18,43 +104,19 @@ def WriteDiscord(Full: bool, messages: list[Message]) -> None:
                 oldmessages = pickle.load(io)
         except:
             pass
-
-        for message in oldmessages:
-            if message in messages:
-                # Remove Unchanged Messages
-                messages.remove(message)
-            elif (message.systemname not in list(x.systemname for x in messages)) and message.isDiscord:
-                # Add Old Message as Complete
-                message.complete = True
-                messages.append(message)
+        messages = UpdateMessages(messages, oldmessages)
 
     print(f"Discord Webhook : {'Full' if Full else 'Update'}...")
     if CSNSettings.WEBHOOK_ID and messages:
-        webhook_text: str = ''
-        webhook_extra: str = ''
-        webhook = SyncWebhook.partial(
-            CSNSettings.WEBHOOK_ID, CSNSettings.WEBHOOK_TOKEN)
         message: Message
-        for message in messages:
-            thistext: str = f"{message.emoji}{message.systemname+' : ' if message.systemname else ''}{'~~' if message.complete else ''}{message.text}{'~~ : Mission Complete' if message.complete else ''}\n"
-            # Max len for a single hook is 2000 chars. A message can be approx 100 and there is the additional header text.
-            if len(webhook_text) < 1850:
-                webhook_text += thistext
-            else:
-                webhook_extra += thistext
-
-        if webhook_text != '':
-            print(webhook_text)
-            webhook.send(
-                f"{'**Full Report**' if Full else 'Latest News'} {CSNSettings.ICONS['csnicon']} \n{webhook_text}")
-            CSNSettings.CSNLog.info(f"Discord {len(webhook_text)} chars")
-
-        if webhook_extra != '':
-            print(webhook_extra)
-            webhook.send(
-                f"...continued {CSNSettings.ICONS['csnicon']} \n{webhook_extra}")
-            CSNSettings.CSNLog.info(
-                f"Discord extra {len(webhook_extra)} chars")
+        lines: list[str] = list(
+            f"{message.emoji}{message.systemname+' : ' if message.systemname else ''}{'~~' if message.complete else ''}{message.text}{'~~ : Mission Complete' if message.complete else ''}\n" for message in messages)
+        posts = Posts(f"{'**Full Report**' if Full else 'Latest News'} {CSNSettings.ICONS['csnicon']} \n", lines,
+                      f"...continued {CSNSettings.ICONS['csnicon']} \n")
+        print(''.join(lines))
+        sent = WebhookSend(posts)
+        CSNSettings.CSNLog.info(
+            f"Discord {sum(len(_) for _ in posts)} chars in {sent}/{len(posts)} posts")
     else:
         CSNSettings.CSNLog.info(f"Discord : Nothing to Report")
         print("...Nothing to Report to Discord")
@@ -1,6 +1,7 @@
 import pickle
 from dataclasses import dataclass
 from CSNSettings import CSNLog
+from CSNMetrics import Staged
 
 
 @dataclass
@@ -31,7 +32,8 @@ def isPlayer(factionname: str) -> bool:
     return answer
 
 
-def LoadEDDBFactions(location: str = 'resources\EDDBFactions.pickle') -> None:
+@Staged('EDDB Load')
+def LoadEDDBFactions(location: str = 'resources\EDDBFactions.pickle') -> dict:
     """ Loads Pickle, default to same folder loaction"""
     global EDDBFACTIONS
     eddbf: list = []
@@ -52,6 +54,7 @@ def LoadEDDBFactions(location: str = 'resources\EDDBFactions.pickle') -> None:
         EDDBFACTIONS = {'None': fdetails()}
     else:
         CSNLog.info("EDDBFactions Loaded")
+    return EDDBFACTIONS
 
 
 # Might be nice for it to be auto inited, but gets triggered before the start of the Logging. Looks odd
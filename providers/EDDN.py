@@ -0,0 +1,208 @@
+# Elite Dangerous Data Network - Live Journal events from Commanders as they jump
+import json
+import zlib
+import time
+import threading
+from datetime import datetime
+import CSNSettings
+from classes.System import System
+from classes.Presense import Presence
+from classes.State import State, Phase
+from providers.EDDBFactions import isPlayer
+
+EDDNRELAY = 'tcp://eddn.edcd.io:9500'
+JOURNALSCHEMA = 'https://eddn.edcd.io/schemas/journal/1'
+EVENTS = ('FSDJump', 'Location')
+BATCHSECONDS = 30  # Apply collected updates at least this often
+BATCHSIZE = 50  # or when this many systems are waiting
+
+
+def EDDNDecode(raw: bytes) -> dict | None:
+    """ Decompress an EDDN message and return the Journal message if it is a System event with Factions """
+    try:
+        envelope = json.loads(zlib.decompress(raw))
+    except Exception:
+        return None
+    if envelope.get('$schemaRef') != JOURNALSCHEMA:
+        return None
+    message: dict = envelope.get('message', {})
+    if message.get('event') not in EVENTS or not message.get('Factions') or 'timestamp' not in message:
+        return None
+    return message
+
+
+def EDDNDateTime(datestring: str) -> datetime:
+    """ Converts Journal timestamp to DateTime """
+    return datetime.strptime(datestring[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def EDDNSystem(message: dict, system: System) -> bool:
+    """ Apply a Journal FSDJump/Location to a System if it is newer. Returns True if the System changed """
+    updated = EDDNDateTime(message['timestamp'])
+    if updated <= system.updated:
+        return False
+
+    oldids = {_.name: _.id for _ in system.factions}
+    system.source = 'EDDN'
+    system.updated = system.recorded = updated
+    system.population = message.get('Population', system.population)
+    controlling = message.get('SystemFaction', system.controllingFaction)
+    system.controllingFaction = controlling['Name'] if isinstance(
+        controlling, dict) else controlling
+    system.factions = []
+    for f in message['Factions']:
+        if f.get('Influence', 0) <= 0:
+            continue
+        myPresence = Presence(oldids.get(f['Name'], 0), f['Name'], allegiance=f.get('Allegiance', ''), government=f.get('Government', ''),
+                              influence=100*f['Influence'], happiness=f.get('Happiness_Localised', ''), isPlayer=isPlayer(f['Name']))
+        for state in f.get('PendingStates', []):
+            myPresence.states.append(State(state['State'], phase=Phase.PENDING))
+        for state in f.get('ActiveStates', []):
+            myPresence.states.append(State(state['State'], phase=Phase.ACTIVE))
+        for state in f.get('RecoveringStates', []):
+            myPresence.states.append(
+                State(state['State'], phase=Phase.RECOVERING))
+        system.addfaction(myPresence)
+
+    for conflict in message.get('Conflicts', []):
+        f1 = conflict['Faction1']
+        f2 = conflict['Faction2']
+        for faction in system.factions:
+            us, them = (f1, f2) if faction.name == f1['Name'] else (
+                f2, f1) if faction.name == f2['Name'] else (None, None)
+            if us:
+                state: State
+                for state in faction.states:
+                    if state.isConflict:
+                        state.opponent = them['Name']
+                        state.atstake = us.get('Stake', '')
+                        state.dayswon = us.get('WonDays', 0)
+                        state.dayslost = them.get('WonDays', 0)
+                        state.gain = them.get('Stake', '')
+    return True
+
+
+class EDDNListener:
+    """ Subscribes to an EDDN relay and applies Journal updates to the Systems being tracked.\n
+        Updates are collected, latest per System, and applied in micro-batches.
+        on_flush is called with the changed Systems after each batch, holding lock if one is shared with the owner of the Systems
+    """
+
+    def __init__(self, systems: list[System], on_flush=None, relay: str = EDDNRELAY, lock: threading.RLock = None) -> None:
+        self.relay = relay
+        self.on_flush = on_flush
+        self.lock = lock or threading.RLock()
+        self.pending: dict[int, dict] = {}
+        self.latest: dict[int, dict] = {}  # Last applied message, bounded by the Systems tracked
+        self.stop = threading.Event()
+        self.received = 0
+        self.applied = 0
+        self.Track(systems)
+
+    def Track(self, systems: list[System]) -> None:
+        """ Replace the Systems being tracked, reapplying any newer updates already received """
+        with self.lock:
+            self.systems: dict[int, System] = {_.id64: _ for _ in systems}
+            self.names: dict[str, System] = {
+                _.name.lower(): _ for _ in systems}
+            self.latest = {k: v for k, v in self.latest.items()
+                           if k in self.systems}
+            for id64, message in self.latest.items():
+                EDDNSystem(message, self.systems[id64])
+
+    def Find(self, message: dict) -> System | None:
+        return self.systems.get(message.get('SystemAddress')) or self.names.get(message.get('StarSystem', '').lower())
+
+    def Receive(self, raw: bytes) -> bool:
+        """ Decode a raw EDDN message and hold it for the next batch if it is for a tracked System """
+        self.received += 1
+        if (message := EDDNDecode(raw)) and (system := self.Find(message)):
+            self.pending[system.id64] = message
+            return True
+        return False
+
+    def Flush(self) -> list[System]:
+        """ Apply all pending updates """
+        pending, self.pending = self.pending, {}
+        changed: list[System] = []
+        with self.lock:
+            for id64, message in pending.items():
+                if (system := self.systems.get(id64)) and EDDNSystem(message, system):
+                    self.latest[id64] = message
+                    changed.append(system)
+            if changed:
+                self.applied += len(changed)
+                CSNSettings.CSNLog.info(
+                    f'EDDN Updated {len(changed)} systems : {", ".join(_.name for _ in changed)}')
+                if self.on_flush:
+                    self.on_flush(changed)
+        return changed
+
+    def Run(self) -> None:
+        """ Listen until stopped. Needs pyzmq """
+        import zmq
+
+        context = zmq.Context.instance()
+        subscriber = context.socket(zmq.SUB)
+        subscriber.setsockopt(zmq.SUBSCRIBE, b'')
+        subscriber.setsockopt(zmq.RCVTIMEO, 1000)
+        subscriber.connect(self.relay)
+        print(f'EDDN Listening to {self.relay}...')
+        CSNSettings.CSNLog.info(f'EDDN Listening to {self.relay}')
+        flushed = time.monotonic()
+        try:
+            while not self.stop.is_set():
+                try:
+                    self.Receive(subscriber.recv())
+                except zmq.Again:
+                    pass
+                except zmq.ZMQError as e:
+                    CSNSettings.CSNLog.info(f'EDDN Error {e}')
+                    print(f'!! EDDN Error {e}')
+                    subscriber.disconnect(self.relay)
+                    time.sleep(5)
+                    subscriber.connect(self.relay)
+                if len(self.pending) >= BATCHSIZE or (self.pending and time.monotonic() - flushed > BATCHSECONDS):
+                    self.Flush()
+                    flushed = time.monotonic()
+        finally:
+            self.Flush()
+            subscriber.close()
+
+    def Start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.Run, daemon=True)
+        thread.start()
+        return thread
+
+
+def StandInPublisher(address: str = 'tcp://127.0.0.1:9500'):
+    """ Local stand in for the EDDN relay. Returns a function that publishes a Journal message dict """
+    import zmq
+
+    publisher = zmq.Context.instance().socket(zmq.PUB)
+    publisher.bind(address)
+
+    def publish(message: dict, schema: str = JOURNALSCHEMA) -> None:
+        publisher.send(zlib.compress(json.dumps(
+            {'$schemaRef': schema, 'header': {'uploaderID': 'CSN', 'softwareName': 'CSN StandIn'}, 'message': message}).encode('utf-8')))
+    return publish
+
+
+if __name__ == '__main__':
+    # Example against a local Stand In Relay
+    system = System('EDSM', 1, 1, 'Varati', 0, 0, 0,
+                    population=1, updated=datetime(2000, 1, 1))
+    listener = EDDNListener([system], on_flush=lambda changed: print(
+        '\n'.join(str(_) for _ in changed)), relay='tcp://127.0.0.1:9500')
+    publish = StandInPublisher('tcp://127.0.0.1:9500')
+    listener.Start()
+    time.sleep(1)  # Let the subscriber connect
+    publish({'event': 'FSDJump', 'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), 'StarSystem': 'Varati', 'SystemAddress': 1,
+             'SystemFaction': {'Name': 'Canonn'}, 'Population': 1,
+             'Factions': [{'Name': 'Canonn', 'Influence': 0.6, 'ActiveStates': [{'State': 'War'}]},
+                          {'Name': 'Varati Crimson Hand', 'Influence': 0.4, 'ActiveStates': [{'State': 'War'}]}],
+             'Conflicts': [{'WarType': 'war', 'Status': 'active', 'Faction1': {'Name': 'Canonn', 'Stake': 'A', 'WonDays': 2},
+                            'Faction2': {'Name': 'Varati Crimson Hand', 'Stake': 'B', 'WonDays': 1}}]})
+    time.sleep(2)
+    listener.stop.set()
+    time.sleep(2)
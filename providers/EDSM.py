@@ -1,180 +1,379 @@
 import CSNSettings
-from classes.Station import Station
+from classes.StationIndex import StationIndex
 from classes.State import State, Phase
 from classes.System import System
 from classes.Presense import Presence
 from classes.Bubble import Bubble
+from classes.DumpDelta import DumpDelta
+from providers.EDSMTiles import TileStore, BuildTiles
 from providers.EDDBFactions import isPlayer
+from CSNMetrics import Staged, HTTP, CacheHit, Retry
+from contextlib import closing
+from email.utils import formatdate
+from math import floor
 import os
 import datetime
 import json
-import requests
 import gzip
+import zlib
+import hashlib
+
+# Converted Systems kept between runs when warm, key is (faction, range), value is (dump date, systems)
+# and 'dump' is (dump date, record hashes, every System of the dump by id64, their StationIndex) so the next dump only converts what has changed
+_WARM: dict[tuple | str, tuple] = {}
+CHUNK = 1024*1024  # Download and verify in chunks this size
+EDSMCOORDINATES = "https://www.edsm.net/dump/systemsWithCoordinates.json.gz"
+
+
+def EDSMRecorded(rs: dict) -> datetime.datetime | None:
+    """ When EDSM last had news of a System record, the latest of its date and its Factions' lastUpdate, in UTC """
+    times = list(datetime.datetime.fromtimestamp(rf['lastUpdate'], datetime.timezone.utc).replace(tzinfo=None)
+                 for rf in rs.get('factions', []) if rf.get('lastUpdate'))
+    if rs.get('date'):
+        times.append(datetime.datetime.strptime(rs['date'][:19], '%Y-%m-%d %H:%M:%S'))
+    return max(times, default=None)
+
+
+def EDSMSystem(rs: dict, updated: datetime.datetime, stations: StationIndex) -> System:
+    """ Convert one System record from the EDSM dump into a System Object, its Stations going into the StationIndex """
+    system = System('EDSM', id=rs['id'], id64=rs['id64'], name=rs['name'],
+                    x=rs['coords']['x'], y=rs['coords']['y'], z=rs['coords']['z'], allegiance=rs['allegiance'], government=rs['government'], economy=rs[
+        'economy'], security=rs['security'], population=rs['population'], controllingFaction=rs['controllingFaction']['name'], updated=updated,
+        recorded=EDSMRecorded(rs)
+    )
+    # Add Faction Presences
+    if 'factions' in rs.keys():
+        for rf in rs['factions']:
+            if rf['influence'] > 0:
+                # EDSM seems to be a bad source for isPlayer, using EDDB Arcive
+                f = Presence(rf['id'], rf['name'], allegiance=rf['allegiance'], government=rf['government'],
+                             influence=100*rf['influence'], happiness=rf['happiness'], isPlayer=isPlayer(rf['name']))
+                # Add States of Faction. NB States have very little information in EDSM, for Conflict days won etc you need EBGS data
+                for rstate in rf.get('activeStates', []):
+                    f.states.append(
+                        State(rstate['state'], phase=Phase.ACTIVE))
+                for rstate in rf.get('pendingStates', []):
+                    f.states.append(
+                        State(rstate['state'], phase=Phase.PENDING))
+                for rstate in rf.get('recoveringStates'):
+                    f.states.append(
+                        State(rstate['state'], phase=Phase.RECOVERING))
+
+                system.addfaction(f)
+    stations.Add(system.id64, rs.get('stations', []))
+    system.stationindex = stations
+    return system
+
+
+@Staged('EDSM Convert')
+def ConvertEDSM(raw: list, updated: datetime.datetime, stations: StationIndex = None) -> list[System]:
+    """ Convert the EDSM dump into a list of System Objects """
+    stations = stations if stations is not None else StationIndex()
+    return list(EDSMSystem(rs, updated, stations) for rs in raw)
+
+
+def DumpLines(file: str):
+    """ Each record of a dump, as its line when EDSM puts one System per line so it need not be parsed yet, otherwise parsed """
+    with gzip.open(file, 'rb') as io:
+        if io.readline().strip() != b'[':
+            io.seek(0)
+            yield from json.load(io)
+            return
+        for line in io:
+            line = line.strip().rstrip(b',')
+            if line and line != b']':
+                yield line
+
+
+def DumpRecords(file: str):
+    """ Each record of a dump with the hash of the record. Yields (hash, line or record)\n
+        A line is hashed without parsing it. Any other layout is hashed record by record
+    """
+    for record in DumpLines(file):
+        if isinstance(record, bytes):
+            yield hashlib.blake2b(record, digest_size=8).digest(), record
+        else:
+            yield hashlib.blake2b(json.dumps(record, sort_keys=True).encode('utf-8'), digest_size=8).digest(), record
+
+
+@Staged('EDSM Delta')
+def DeltaEDSM(file: str, updated: datetime.datetime, previous: dict[bytes, int] = None, stations: StationIndex = None) -> DumpDelta:
+    """ Compare a dump with the record hashes of the previous one, only converting the Systems that have changed.\n
+        With no previous hashes every System is added. The Stations of those converted replace theirs in the StationIndex
+    """
+    stations = stations if stations is not None else StationIndex()
+    previous = previous or {}
+    known = set(previous.values())
+    seen: set[int] = set()
+    delta = DumpDelta(updated)
+    for key, record in DumpRecords(file):
+        if (id64 := previous.get(key)) is not None:
+            seen.add(id64)
+            delta.hashes[key] = id64
+            continue
+        system = EDSMSystem(json.loads(record) if isinstance(
+            record, bytes) else record, updated, stations)
+        delta.hashes[key] = system.id64
+        (delta.modified if system.id64 in known else delta.added).append(system)
+    delta.removed = known - seen - set(_.id64 for _ in delta.modified)
+    for id64 in delta.removed:
+        stations.Remove(id64)
+    delta.unchanged = len(seen)
+    return delta
+
+
+def ClearWarm() -> None:
+    """ Forget any Systems kept warm between runs """
+    _WARM.clear()
+
+
+def PopulatedCacheFile() -> str:
+    return os.environ.get('APPDATA')+"\CSN_EDSMPopulated.json"
+
+
+def DumpMeta(file: str) -> dict:
+    """ ETag, Last-Modified and size of a downloaded dump, or of a partial download """
+    try:
+        with open(file+'.meta', 'r') as io:
+            return json.load(io)
+    except (OSError, ValueError):
+        return {}
 
 
-def RefreshUnpopulatedDump(file, url):
-    """ Checks Dates of Cache and API Data and downloads if required """
-    cachedate: datetime.datetime = datetime.datetime.strptime(
-        '2000-01-01', '%Y-%m-%d')
-    basecoords = (0, 0, 0)
-    range = 1000
+def DumpMetaSave(file: str, meta: dict) -> None:
+    with open(file+'.meta.tmp', 'w') as io:
+        json.dump(meta, io)
+    os.replace(file+'.meta.tmp', file+'.meta')
 
-    # Get Modified Dates to check if it needs downloading again
-    if os.path.exists(file):
-        cachedate = datetime.datetime.fromtimestamp(
-            os.path.getmtime(file))
-        return cachedate  # !! No need to download again
 
+def DumpDate(file: str) -> datetime.datetime:
+    """ Date of a dump from its Last-Modified, or when it was written if that is not known """
     try:
-        resp = requests.head(url)
-        lastmoddt = datetime.datetime.strptime(
-            resp.headers._store['last-modified'][1], '%a, %d %b %Y %H:%M:%S %Z')
-        # Needs to download fresh data
-        if lastmoddt > cachedate:
-            print('EDSM Unpopulated Downloading...')
-            CSNSettings.CSNLog.info('EDSM Unpopulated Downloading...')
-
-            resp = requests.get(url).content
-            resp = json.loads(gzip.decompress(resp))
-
-            # Strip it down to a sensible size
-            small = []
-            for s in resp:
-                if abs(s['coords']['x']-basecoords[0]) < range and abs(s['coords']['y']-basecoords[1]) < range and abs(s['coords']['z']-basecoords[2]) < range:
-                    small.append(s)
-
-            print('EDSM Saving...')
-            CSNSettings.CSNLog.info('EDSM Unpopulated Saving...')
-            with gzip.open(file, "w") as f:
-                f.write(json.dumps(small).encode('utf-8'))
-    except:
-        CSNSettings.CSNLog.info('EDSM Offline !')
-        print(f"EDSM Offline !")
-    return cachedate
+        return datetime.datetime.strptime(DumpMeta(file)['last-modified'], '%a, %d %b %Y %H:%M:%S %Z')
+    except (KeyError, ValueError):
+        pass
+    if os.path.exists(file):
+        return datetime.datetime.fromtimestamp(os.path.getmtime(file))
+    return datetime.datetime(2000, 1, 1)
 
 
-def LoadCache(file) -> list:
-    print('EDSM Loading...')
-    with gzip.open(file, "r") as f:
-        raw = json.loads(f.read().decode('utf-8'))
-        CSNSettings.CSNLog.info('EDSM Loaded')
-    return raw
+def VerifyDump(file: str, size: int = 0) -> bool:
+    """ True if the dump is the expected size and a complete gzip, which checks the CRC and length of the content """
+    if size and os.path.getsize(file) != size:
+        return False
+    try:
+        with gzip.open(file, 'rb') as io:
+            while io.read(CHUNK):
+                pass
+        return True
+    except (OSError, EOFError, zlib.error):
+        return False
 
 
-def GetSystemsFromEDSM(faction: str, range=40) -> list[System]:
-    """ Reads latest daily download of populated systems from EDSM and creates a list of System Objects \n
-        If a Faction is supplied, the list is cut down to that Faction and others withing range ly Cube
+def DumpChunks(resp):
+    """ The dump as it was sent. iter_content would undo a Content-Encoding: gzip, leaving plain json where the gzip dump should be.
+        A recorded or replayed response only has its content, decoded, so that is gzipped again if it is not still the dump
     """
-    edsmcache = os.environ.get('APPDATA')+"\CSN_EDSMPopulated.json"
-
-    def RefreshCache(edsmcache) -> datetime:
-        """ Checks Dates of Cache and API Data and downloads if required """
-        EDSMPOPULATED = "https://www.edsm.net/dump/systemsPopulated.json.gz"
-        cachedate: datetime.datetime = datetime.datetime.strptime(
-            '2000-01-01', '%Y-%m-%d')
+    if not resp._content_consumed:
+        return resp.raw.stream(CHUNK, decode_content=False)
+    content = resp.content
+    if resp.headers.get('Content-Encoding') and content[:2] != b'\x1f\x8b':
+        content = gzip.compress(content)
+    return (content[_:_+CHUNK] for _ in range(0, len(content), CHUNK))
+
+
+def DownloadDump(endpoint: str, url: str, file: str, retries: int = 3) -> bool:
+    """ Conditional, streamed download of an EDSM, or Spansh, dump. Returns True if a new dump was downloaded\n
+        The ETag/Last-Modified of the copy we have are sent, so an unchanged dump is a 304 with no body.
+        A new dump streams to file.part, resuming with a Range request if interrupted, and is only renamed over file once verified
+    """
+    source = endpoint.split()[0]
+    meta = DumpMeta(file) if os.path.exists(file) else {}
+    part = file+'.part'
+    for attempt in range(retries):
+        if attempt:
+            Retry(endpoint)
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last-modified'):
+            headers['If-Modified-Since'] = meta['last-modified']
+        elif os.path.exists(file):
+            headers['If-Modified-Since'] = formatdate(
+                os.path.getmtime(file), usegmt=True)
+        partial = DumpMeta(part) if os.path.exists(part) else {}
+        if partial and (validator := partial.get('etag') or partial.get('last-modified')):
+            headers['Range'] = f'bytes={os.path.getsize(part)}-'
+            headers['If-Range'] = validator  # Server sends the whole dump if it has changed since
+        try:
+            with closing(HTTP(endpoint, 'GET', url, headers=headers, stream=True, timeout=60)) as resp:
+                if resp.status_code == 304:
+                    CacheHit(endpoint, True)
+                    return False
+                if resp.status_code != 416:  # 416 is when we already have it all, it just needs verifying
+                    resp.raise_for_status()
+                    if resp.status_code == 206:
+                        print(
+                            f'{source} Resuming Download at {os.path.getsize(part)//1024} KB...')
+                        mode = 'ab'
+                    else:
+                        CacheHit(endpoint, False)
+                        print(f'{source} Downloading...')
+                        CSNSettings.CSNLog.info(f'{source} Downloading...')
+                        partial = {'etag': resp.headers.get('ETag', ''), 'last-modified': resp.headers.get('Last-Modified', ''),
+                                   'size': 0 if resp.headers.get('Content-Encoding') else int(resp.headers.get('Content-Length', 0))}
+                        DumpMetaSave(part, partial)
+                        mode = 'wb'
+                    with open(part, mode) as io:
+                        for chunk in DumpChunks(resp):
+                            io.write(chunk)
+        except Exception as e:
+            CSNSettings.CSNLog.info(f'{source} Download interrupted : {e}')
+            print(f'{source} Download interrupted : {e}')
+            continue
+
+        if VerifyDump(part, partial.get('size', 0)):
+            os.replace(part, file)
+            DumpMetaSave(file, partial)
+            os.remove(part+'.meta')
+            CSNSettings.CSNLog.info(
+                f"{source} Downloaded {os.path.getsize(file)//1024} KB, {partial['last-modified']}")
+            return True
+        CSNSettings.CSNLog.info(f'{source} Download corrupt, starting again')
+        print(f'{source} Download corrupt, starting again')
+        os.remove(part)
+        os.remove(part+'.meta')
+    raise ConnectionError(f'{endpoint} failed after {retries} attempts')
+
+
+@Staged('EDSM Refresh')
+def RefreshPopulatedDump(edsmcache: str = '') -> datetime.datetime:
+    """ Downloads the dump if EDSM has a newer one. Returns the date of the dump we have """
+    edsmcache = edsmcache or PopulatedCacheFile()
+    EDSMPOPULATED = "https://www.edsm.net/dump/systemsPopulated.json.gz"
+    try:
+        DownloadDump('EDSM populated dump', EDSMPOPULATED, edsmcache)
+    except Exception as e:
+        CSNSettings.CSNLog.info(f'EDSM Offline ! {e}')
+        print(f"EDSM Offline !")
+    return DumpDate(edsmcache)
 
-        # Get Modified Dates to check if it needs downloading again
-        if os.path.exists(edsmcache):
-            cachedate = datetime.datetime.fromtimestamp(
-                os.path.getmtime(edsmcache))
 
-        try:
-            resp = requests.head(EDSMPOPULATED)
-            lastmoddt = datetime.datetime.strptime(
-                resp.headers._store['last-modified'][1], '%a, %d %b %Y %H:%M:%S %Z')
-            # Needs to download fresh data
-            if lastmoddt > cachedate:
-                print('EDSM Downloading...')
-                CSNSettings.CSNLog.info('EDSM Downloading...')
-
-                resp = requests.get(EDSMPOPULATED).content
-                resp = json.loads(gzip.decompress(resp))
-                print('EDSM Saving...')
-                CSNSettings.CSNLog.info('EDSM Saving...')
-                with gzip.open(edsmcache, "w") as f:
-                    f.write(json.dumps(resp).encode('utf-8'))
-        except:
-            CSNSettings.CSNLog.info('EDSM Offline !')
-            print(f"EDSM Offline !")
-        return lastmoddt
-
-    lastmoddt = RefreshCache(edsmcache)
-    raw = LoadCache(edsmcache)
+@Staged('EDSM Reduce')
+def ReduceToFaction(systems: list[System], faction: str | list[str], range: float = 40) -> list[System] | None:
+    """ Systems within range ly Cube of any System the Faction, or any of a list of Factions, is present in. None if it is in none.\n
+        The Faction's Systems are bucketed into cubes of range, so each System is only compared to those in the cubes around it
+    """
+    factions = [faction] if isinstance(faction, str) else faction
+    cells: dict[tuple, list[System]] = {}
+    for system in systems:
+        if any(system.isfactionpresent(_) for _ in factions):
+            cells.setdefault((floor(system.x/range), floor(system.y/range),
+                             floor(system.z/range)), []).append(system)
+    if not cells:
+        return None
+
+    def near(system: System) -> bool:
+        cx, cy, cz = floor(system.x/range), floor(system.y/range), floor(system.z/range)
+        return any(e.cube_distance(system) <= range for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+                   for e in cells.get((cx+dx, cy+dy, cz+dz), ()))
+    return list(filter(near, systems))
+
+
+def GetSystemsFromEDSM(faction: str | list[str], range=40, warm: bool = False, dumpdate: datetime.datetime = None) -> list[System]:
+    """ Reads latest daily download of populated systems from EDSM and creates a list of System Objects \n
+        If a Faction, or list of Factions, is supplied, the list is cut down to them and others withing range ly Cube\n
+        If warm, the Systems from the last call are reused until EDSM publishes a new dump\n
+        dumpdate skips the refresh, when the caller has just done it
+    """
+    edsmcache = PopulatedCacheFile()
+    lastmoddt = dumpdate or RefreshPopulatedDump(edsmcache)
+    if isinstance(faction, list):
+        faction = tuple(faction)
+    if warm and (faction, range) in _WARM and _WARM[(faction, range)][0] == lastmoddt:
+        print('EDSM Unchanged, using warm Systems')
+        CSNSettings.CSNLog.info('EDSM Unchanged, using warm Systems')
+        return list(_WARM[(faction, range)][1])
+    dump = _WARM.get('dump') if warm else None
+    _WARM.clear()
 
     print('EDSM Converting to DataClass...')
     CSNSettings.CSNLog.info('EDSM Converting to DataClass...')
-
-    systemlist: list[System] = []
-    for rs in raw:
-        system = System('EDSM', id=rs['id'], id64=rs['id64'], name=rs['name'],
-                        x=rs['coords']['x'], y=rs['coords']['y'], z=rs['coords']['z'], allegiance=rs['allegiance'], government=rs['government'], economy=rs[
-            'economy'], security=rs['security'], population=rs['population'], controllingFaction=rs['controllingFaction']['name'], updated=lastmoddt
-        )
-        # Add Faction Presences
-        if 'factions' in rs.keys():
-            for rf in rs['factions']:
-                if rf['influence'] > 0:
-                    # EDSM seems to be a bad source for isPlayer, using EDDB Arcive
-                    f = Presence(rf['id'], rf['name'], allegiance=rf['allegiance'], government=rf['government'],
-                                 influence=100*rf['influence'], happiness=rf['happiness'], isPlayer=isPlayer(rf['name']))
-                    # Add States of Faction. NB States have very little information in EDSM, for Conflict days won etc you need EBGS data
-                    for rstate in rf.get('activeStates', []):
-                        f.states.append(
-                            State(rstate['state'], phase=Phase.ACTIVE))
-                    for rstate in rf.get('pendingStates', []):
-                        f.states.append(
-                            State(rstate['state'], phase=Phase.PENDING))
-                    for rstate in rf.get('recoveringStates'):
-                        f.states.append(
-                            State(rstate['state'], phase=Phase.RECOVERING))
-
-                    system.addfaction(f)
-        if 'stations' in rs.keys():
-            myStation: Station
-            for station in rs['stations']:
-                fname = station['controllingFaction']['name'] if 'controllingFaction' in station.keys(
-                ) else station['type']
-                myStation = Station(
-                    station['id'], station['type'], station['name'], fname, station['economy'], station['secondEconomy'], station['haveMarket'], station['haveShipyard'], station['haveOutfitting'], station['otherServices'])
-                system.stations.append(myStation)
-        systemlist.append(system)
+    stations = dump[3] if dump else StationIndex()
+    delta = DeltaEDSM(edsmcache, lastmoddt,
+                      dump[1] if dump else None, stations)
+    systems = delta.Apply(dump[2] if dump else {})
+    if dump:
+        print(f'EDSM Changes {delta}')
+        CSNSettings.CSNLog.info(f'EDSM Changes {delta}')
+    systemlist: list[System] = list(systems.values())
+    if warm:
+        _WARM['dump'] = (lastmoddt, delta.hashes, systems, stations)
 
     # Reduce List to Empire and Systems within range (40 covers simple invasions, use 60 for extended invasions)
     if faction:
-        empire = list(
-            filter(lambda x: x.isfactionpresent(faction), systemlist))
-        if empire:
-            systemlist = list(filter(lambda x: min(
-                map(lambda e: e.cube_distance(x), empire)) <= range, systemlist))
+        if (reduced := ReduceToFaction(systemlist, faction, range)) is not None:
+            systemlist = reduced
         else:
             print('! Faction Not Found, you have the whole bubble !')
     print(f'EDSM Converted to include {len(systemlist)} systems')
     CSNSettings.CSNLog.info(
         f'EDSM Converted to DataClass : {len(systemlist)} systems')
+    if warm:
+        _WARM[(faction, range)] = (lastmoddt, systemlist)
+        systemlist = list(systemlist)
     return systemlist
 
 
-def GetUnpopulated() -> list[System]:
-    """ Reads latest daily download of unpopulated systems from EDSM and creates a list of System Objects """
-    edsmcache = os.environ.get('APPDATA')+"\CSN_EDSMUnpopulated.json"
-    EDSMUNPOPULATED = "https://www.edsm.net/dump/systemsWithCoordinates.json.gz"
+def UnpopulatedTiles() -> str:
+    return os.environ.get('APPDATA')+"\\CSN_EDSMTiles"
 
-    lastmoddt = RefreshUnpopulatedDump(edsmcache, EDSMUNPOPULATED)
 
-    print('EDSM Converting to DataClass...')
-    CSNSettings.CSNLog.info('EDSM Converting to DataClass...')
+@Staged('EDSM Unpopulated Refresh')
+def RefreshUnpopulatedTiles() -> TileStore | None:
+    """ Downloads the coordinates dump if EDSM has a newer one and rebuilds the tiles from it. None if there has never been a dump """
+    dump = os.environ.get('APPDATA')+"\\CSN_EDSMCoordinates.json.gz"
+    try:
+        DownloadDump('EDSM coordinates dump', EDSMCOORDINATES, dump)
+    except Exception as e:
+        CSNSettings.CSNLog.info(f'EDSM Offline ! {e}')
+        print(f"EDSM Offline !")
+    store = TileStore.Open(UnpopulatedTiles())
+    if os.path.exists(dump):
+        built = DumpDate(dump).isoformat()
+        if store is None or store.built != built:
+            print('EDSM Unpopulated Tiling...')
+            CSNSettings.CSNLog.info('EDSM Unpopulated Tiling...')
+            BuildTiles((json.loads(_) if isinstance(_, bytes) else _ for _ in DumpLines(dump)),
+                       UnpopulatedTiles(), built)
+            store = TileStore.Open(UnpopulatedTiles())
+    return store
+
+
+def UnpopulatedSystem(found: tuple, updated: datetime.datetime) -> System:
+    name, id64, id, x, y, z = found
+    return System('EDSM', id=id, id64=id64, name=name, x=x, y=y, z=z, updated=updated)
+
+
+def GetUnpopulated(centre: tuple = (0, 0, 0), range: float = 1000, refresh: bool = True) -> list[System]:
+    """ Systems with coordinates from EDSM within a range ly Cube of centre, reading only the tiles it covers """
+    store = RefreshUnpopulatedTiles() if refresh else TileStore.Open(UnpopulatedTiles())
+    if not store:
+        return []
+    updated = datetime.datetime.fromisoformat(store.built)
+    systemlist = list(UnpopulatedSystem(_, updated)
+                      for _ in store.Region(*centre, range))
+    print(f'EDSM Unpopulated {len(systemlist)} systems')
+    CSNSettings.CSNLog.info(f'EDSM Unpopulated {len(systemlist)} systems')
+    return systemlist
 
-    raw = LoadCache(edsmcache)
-    systemlist: list[System] = []
-    for rs in raw:
-        system = System('EDSM', id=rs['id'], id64=rs['id64'], name=rs['name'],
-                        x=rs['coords']['x'], y=rs['coords']['y'], z=rs['coords']['z'], updated=lastmoddt)
 
-        systemlist.append(system)
-    print(f'EDSM Converted to include {len(systemlist)} systems')
-    CSNSettings.CSNLog.info(
-        f'EDSM Converted to DataClass : {len(systemlist)} systems')
-    return systemlist
+def GetUnpopulatedSystem(name: str, refresh: bool = False) -> System | None:
+    """ A System with coordinates from EDSM by name, from the name index """
+    store = RefreshUnpopulatedTiles() if refresh else TileStore.Open(UnpopulatedTiles())
+    if not store or not (found := store.Find(name)):
+        return None
+    return UnpopulatedSystem(found, datetime.datetime.fromisoformat(store.built))
 
 
 if __name__ == '__main__':
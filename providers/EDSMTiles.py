@@ -0,0 +1,286 @@
+# Spatially Tiled store of coordinate only Systems, for the tens of millions in the EDSM systemsWithCoordinates dump
+from array import array
+from math import floor
+import hashlib
+import shutil
+import struct
+import json
+import sys
+import os
+import CSNSettings
+from CSNMetrics import Staged
+
+TILE = 320  # ly edge of the cube each tile file holds
+CELL = 20  # ly edge of the cells a tile is sorted into, so a Region only reads the cells it needs
+CELLS = TILE // CELL
+BUCKETS = 64  # Index partitions, each sorted in memory while building
+SPOOLHANDLES = 256  # Tile spool files kept open while building
+VERSION = 1
+
+HEADER = struct.Struct('<4sII')  # magic, version, count
+ENTRY = struct.Struct('<QII')  # key, tile, row
+SPOOL = struct.Struct('<fffQIH')  # x, y, z, id64, id, length of name
+# Tile layout after the header: cell offsets uint32 x CELLS**3+1, x y z float32 x 3n, id64 uint64 x n, id uint32 x n, name offsets uint32 x n+1, names
+BASE = HEADER.size + 4*(CELLS**3+1)
+
+
+def TileKey(x: float, y: float, z: float) -> tuple[int, int, int]:
+    return (floor(x/TILE), floor(y/TILE), floor(z/TILE))
+
+
+def CellIndex(x: float, y: float, z: float) -> int:
+    """ Cell of a position within its tile """
+    cx, cy, cz = (min(CELLS-1, floor((c % TILE)/CELL)) for c in (x, y, z))
+    return (cx*CELLS + cy)*CELLS + cz
+
+
+def NameKey(name: str) -> int:
+    return int.from_bytes(hashlib.blake2b(name.lower().encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def Bucket(key: int) -> int:
+    """ Index partition of a key. Mixed first, as id64s share their high bits """
+    return ((key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 58
+
+
+def Packed(typecode: str, data: bytes) -> array:
+    """ Little endian bytes from a tile as an array """
+    answer = array(typecode)
+    answer.frombytes(data)
+    if sys.byteorder != 'little':
+        answer.byteswap()
+    return answer
+
+
+class TileStore:
+    """ Coordinate only Systems in tile files of TILE ly cubes, with name and id64 indexes.\n
+        Region and Find read only the tiles, cells and index entries they need, so nothing is held in memory
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        with open(os.path.join(folder, 'tiles.json'), 'r') as io:
+            manifest = json.load(io)
+        self.built: str = manifest['built']
+        self.count: int = manifest['systems']
+        self.tiles: list[tuple] = list(tuple(_) for _ in manifest['tiles'])
+        self.numbers: dict[tuple, int] = {
+            _[:3]: i for i, _ in enumerate(self.tiles)}
+        self.cells: dict[int, array] = {}  # Cell offsets of tiles read so far
+        self.indexes: dict[str, list[int]] = {}  # Bucket offsets of each index
+
+    @staticmethod
+    def Open(folder: str) -> "TileStore | None":
+        """ The store in folder, or None if it has not been built """
+        try:
+            return TileStore(folder)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def TileFile(self, number: int) -> str:
+        tx, ty, tz, _ = self.tiles[number]
+        return os.path.join(self.folder, f'{tx}_{ty}_{tz}.tile')
+
+    def Cells(self, number: int, io) -> array:
+        if number not in self.cells:
+            io.seek(HEADER.size)
+            self.cells[number] = Packed('I', io.read(4*(CELLS**3+1)))
+        return self.cells[number]
+
+    def Rows(self, number: int, io, start: int, end: int) -> list[tuple]:
+        """ Rows start to end of a tile as (name, id64, id, x, y, z) """
+        if end <= start:
+            return []
+        n = self.tiles[number][3]
+        io.seek(BASE + 12*start)
+        coords = Packed('f', io.read(12*(end-start)))
+        io.seek(BASE + 12*n + 8*start)
+        id64s = Packed('Q', io.read(8*(end-start)))
+        io.seek(BASE + 20*n + 4*start)
+        ids = Packed('I', io.read(4*(end-start)))
+        io.seek(BASE + 24*n + 4*start)
+        offsets = Packed('I', io.read(4*(end-start+1)))
+        io.seek(BASE + 28*n + 4 + offsets[0])
+        names = io.read(offsets[-1]-offsets[0])
+        first = offsets[0]
+        return list((names[offsets[i]-first:offsets[i+1]-first].decode('utf-8'), id64s[i], ids[i],
+                     coords[3*i], coords[3*i+1], coords[3*i+2]) for i in range(end-start))
+
+    def Region(self, x: float, y: float, z: float, ly: float) -> list[tuple]:
+        """ Systems within a ly Cube of a position as (name, id64, id, x, y, z) """
+        answer = []
+        lo, hi = TileKey(x-ly, y-ly, z-ly), TileKey(x+ly, y+ly, z+ly)
+        for tx in range(lo[0], hi[0]+1):
+            for ty in range(lo[1], hi[1]+1):
+                for tz in range(lo[2], hi[2]+1):
+                    if (number := self.numbers.get((tx, ty, tz))) is not None:
+                        answer += self.TileRegion(number, x, y, z, ly)
+        return answer
+
+    def TileRegion(self, number: int, x: float, y: float, z: float, ly: float) -> list[tuple]:
+        tx, ty, tz, n = self.tiles[number]
+        origin = (tx*TILE, ty*TILE, tz*TILE)
+        cell_lo = list(max(0, floor((c-ly-o)/CELL))
+                       for c, o in zip((x, y, z), origin))
+        cell_hi = list(min(CELLS-1, floor((c+ly-o)/CELL))
+                       for c, o in zip((x, y, z), origin))
+        rows = []
+        with open(self.TileFile(number), 'rb') as io:
+            if cell_lo == [0, 0, 0] and cell_hi == [CELLS-1]*3:
+                rows = self.Rows(number, io, 0, n)
+            else:
+                cells = self.Cells(number, io)
+                for cx in range(cell_lo[0], cell_hi[0]+1):
+                    for cy in range(cell_lo[1], cell_hi[1]+1):
+                        first = (cx*CELLS + cy)*CELLS
+                        rows += self.Rows(number, io, cells[first+cell_lo[2]],
+                                          cells[first+cell_hi[2]+1])
+        return list(_ for _ in rows if abs(_[3]-x) <= ly and abs(_[4]-y) <= ly and abs(_[5]-z) <= ly)
+
+    def Lookup(self, index: str, key: int) -> list[tuple[int, int]]:
+        """ (tile, row) of every entry for key in an index, by binary search of its bucket """
+        file = os.path.join(self.folder, index+'.idx')
+        with open(file, 'rb') as io:
+            if index not in self.indexes:
+                self.indexes[index] = list(struct.unpack(
+                    f'<{BUCKETS+1}Q', io.read(8*(BUCKETS+1))))
+            offsets = self.indexes[index]
+            bucket = Bucket(key)
+            lo, hi = offsets[bucket], offsets[bucket+1]
+
+            def entry(i):
+                io.seek(8*(BUCKETS+1) + ENTRY.size*i)
+                return ENTRY.unpack(io.read(ENTRY.size))
+            while lo < hi:
+                mid = (lo+hi)//2
+                if entry(mid)[0] < key:
+                    lo = mid+1
+                else:
+                    hi = mid
+            answer = []
+            while lo < offsets[bucket+1] and (found := entry(lo))[0] == key:
+                answer.append(found[1:])
+                lo += 1
+        return answer
+
+    def Row(self, number: int, row: int) -> tuple:
+        with open(self.TileFile(number), 'rb') as io:
+            return self.Rows(number, io, row, row+1)[0]
+
+    def Find(self, name: str) -> tuple | None:
+        """ System by name as (name, id64, id, x, y, z) """
+        for number, row in self.Lookup('names', NameKey(name)):
+            if (found := self.Row(number, row))[0].lower() == name.lower():
+                return found
+        return None
+
+    def FindId64(self, id64: int) -> tuple | None:
+        """ System by id64 as (name, id64, id, x, y, z) """
+        for number, row in self.Lookup('id64', id64):
+            return self.Row(number, row)
+        return None
+
+
+@Staged('EDSM Tiles Build')
+def BuildTiles(records, folder: str, built: str = '') -> int:
+    """ Build a TileStore in one streaming pass over dump records, then swap it in for any existing one. Returns the number of Systems\n
+        Records are spooled to a file per tile as they arrive, then each tile and index bucket is sorted on its own,
+        so memory is bounded by the largest tile rather than the dump
+    """
+    work = folder+'.build'
+    spool = os.path.join(work, 'spool')
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(spool)
+
+    def spoolfile(key: tuple) -> str:
+        return os.path.join(spool, '{}_{}_{}.spool'.format(*key))
+
+    # Spool each record to its tile, keeping the most recently used tile files open
+    handles: dict[tuple, object] = {}
+    counts: dict[tuple, int] = {}
+    for rs in records:
+        x, y, z = rs['coords']['x'], rs['coords']['y'], rs['coords']['z']
+        key = TileKey(x, y, z)
+        io = handles.pop(key, None) or open(spoolfile(key), 'ab')
+        handles[key] = io
+        if len(handles) > SPOOLHANDLES:
+            handles.pop(next(iter(handles))).close()
+        name = rs['name'].encode('utf-8')
+        io.write(SPOOL.pack(x, y, z, rs['id64'], rs.get('id') or 0, len(name)) + name)
+        counts[key] = counts.get(key, 0) + 1
+    for io in handles.values():
+        io.close()
+    total = sum(counts.values())
+    print(f'EDSM Tiles spooled {total} systems into {len(counts)} tiles')
+    CSNSettings.CSNLog.info(
+        f'EDSM Tiles spooled {total} systems into {len(counts)} tiles')
+
+    # Sort each tile into cells and write it, spooling index entries into buckets
+    indexes = {'names': list(open(os.path.join(spool, f'names.{b}'), 'wb') for b in range(BUCKETS)),
+               'id64': list(open(os.path.join(spool, f'id64.{b}'), 'wb') for b in range(BUCKETS))}
+    tiles = sorted(counts)
+    for number, key in enumerate(tiles):
+        rows = []
+        with open(spoolfile(key), 'rb') as io:
+            data = io.read()
+        at = 0
+        while at < len(data):
+            x, y, z, id64, id, length = SPOOL.unpack_from(data, at)
+            at += SPOOL.size
+            rows.append((CellIndex(x, y, z), x, y, z, id64,
+                        id, data[at:at+length]))
+            at += length
+        os.remove(spoolfile(key))
+        rows.sort(key=lambda _: _[0])
+
+        cells = array('I', [0]*(CELLS**3+1))
+        for row in rows:
+            cells[row[0]+1] += 1
+        for i in range(CELLS**3):
+            cells[i+1] += cells[i]
+        offsets = array('I', [0])
+        for row in rows:
+            offsets.append(offsets[-1]+len(row[6]))
+        columns = [cells, array('f', (c for row in rows for c in row[1:4])), array('Q', (_[4] for _ in rows)),
+                   array('I', (_[5] for _ in rows)), offsets]
+        if sys.byteorder != 'little':
+            for column in columns:
+                column.byteswap()
+        with open(os.path.join(work, '{}_{}_{}.tile'.format(*key)), 'wb') as io:
+            io.write(HEADER.pack(b'CSNT', VERSION, len(rows)))
+            for column in columns:
+                io.write(column.tobytes())
+            io.write(b''.join(_[6] for _ in rows))
+
+        for i, row in enumerate(rows):
+            namekey = NameKey(row[6].decode('utf-8'))
+            indexes['names'][Bucket(namekey)].write(
+                ENTRY.pack(namekey, number, i))
+            indexes['id64'][Bucket(row[4])].write(
+                ENTRY.pack(row[4], number, i))
+
+    # Sort each index bucket and write them one after another, after a table of where each bucket starts
+    for index, buckets in indexes.items():
+        for io in buckets:
+            io.close()
+        with open(os.path.join(work, index+'.idx'), 'wb') as io:
+            io.write(b'\0'*8*(BUCKETS+1))
+            offsets = [0]
+            for b in range(BUCKETS):
+                with open(os.path.join(spool, f'{index}.{b}'), 'rb') as bucket:
+                    entries = sorted(ENTRY.iter_unpack(bucket.read()))
+                io.write(b''.join(ENTRY.pack(*_) for _ in entries))
+                offsets.append(offsets[-1]+len(entries))
+            io.seek(0)
+            io.write(struct.pack(f'<{BUCKETS+1}Q', *offsets))
+    shutil.rmtree(spool)
+
+    with open(os.path.join(work, 'tiles.json'), 'w') as io:
+        json.dump({'built': built, 'systems': total, 'tile': TILE, 'cell': CELL, 'version': VERSION,
+                   'tiles': list(list(key)+[counts[key]] for key in tiles)}, io)
+    if os.path.exists(folder):
+        shutil.rmtree(folder+'.old', ignore_errors=True)
+        os.replace(folder, folder+'.old')
+    os.replace(work, folder)
+    shutil.rmtree(folder+'.old', ignore_errors=True)
+    return total
@@ -1,7 +1,7 @@
 from cachetools import cached
-import requests
 import json
 from CSNSettings import CSNLog, RequestCount
+from CSNMetrics import Stage, Staged, HTTP, CacheHit
 from classes.Presense import Presence
 from classes.System import System
 from classes.State import State, Phase
@@ -14,6 +14,8 @@ import os
 
 _ELITEBGSURL = 'https://elitebgs.app/api/ebgs/v5/'
 DATADIR = '.\data'
+# Loaded once and kept for the life of the process
+_CACHE: dict = None
 
 
 def EBGSDateTime(datestring: str) -> datetime:
@@ -26,16 +28,23 @@ def EBGSDateTime(datestring: str) -> datetime:
 
 def EBGSCache_Save(cache) -> None:
     """ Saves systems as most recent version of EBGS data """
-    with open(os.path.join(DATADIR, 'EBGS_Cache.pickle'), 'wb') as io:
-        pickle.dump(cache, io)
+    global _CACHE
+    _CACHE = cache
+    with Stage('EBGS Cache Save', items=len(cache)):
+        with open(os.path.join(DATADIR, 'EBGS_Cache.pickle'), 'wb') as io:
+            pickle.dump(cache, io)
 
 
 def EBGSCache_Load() -> dict[System]:
     """ Load most recent versions systems according to EBGS - Pickle can be deleted with minimal impact """
+    global _CACHE
+    if _CACHE is not None:
+        return _CACHE
     answer = dict()
     if os.path.exists(os.path.join(DATADIR, 'EBGS_Cache.pickle')):
         with open(os.path.join(DATADIR, 'EBGS_Cache.pickle'), 'rb') as io:
             answer = pickle.load(io)
+    _CACHE = answer
     return answer
 
 
@@ -48,7 +57,7 @@ def EBGSLiveSystem(system: System, forced: bool = False, cached=None) -> System:
     try:
         url = f"{_ELITEBGSURL}systems"
         payload = {'name': system.name, 'factionDetails': 'true'}
-        resp = requests.get(url, params=payload)
+        resp = HTTP('EBGS systems', 'GET', url, params=payload)
         myload = json.loads(resp._content)["docs"][0]
         RequestCount()
         # CSNLog.info(f"EBGS Live Data for {system.name}")
@@ -63,7 +72,7 @@ def EBGSLiveSystem(system: System, forced: bool = False, cached=None) -> System:
     # Ensure EBGS data isnt stale
     if updated > system.updated or forced:
         system.source = 'EBGS'
-        system.updated = updated
+        system.updated = system.recorded = updated
         system.id = myload['eddb_id']
         system.controllingFaction = myload['controlling_minor_faction_cased']
         # # Dump for debugging
@@ -130,7 +139,7 @@ def EBGSFactionSystems(faction: str, page: int = 1) -> list:
     payload = {'name': faction, 'minimal': 'false',
                'systemDetails': 'false', 'page': page}
     try:
-        resp = requests.get(url, params=payload)
+        resp = HTTP('EBGS factions', 'GET', url, params=payload)
         content = json.loads(resp._content)
         myload = content["docs"][0]['faction_presence']
         RequestCount()
@@ -149,6 +158,7 @@ def EBGSFactionSystems(faction: str, page: int = 1) -> list:
     return answer
 
 
+@Staged('EBGS Refresh')
 def RefreshFaction(mySystems: list[System], myFaction: str) -> list[System]:
     """ Gets EBGS data for any systems with stale data or a conflict"""
     print(f"EBGS Refreshing systems for {myFaction}..")
@@ -167,13 +177,17 @@ def RefreshFaction(mySystems: list[System], myFaction: str) -> list[System]:
             if system.updated < updated or inconflict:
                 if cache.get(system.name) and cache[system.name].updated == updated:
                     # CSNLog.info(f"EBGS Cache {sys_name:30} : {updated:%c}")
+                    # The cached System was pickled without Stations, so it takes those of this dump
+                    cache[system.name].stationindex = system.stationindex
                     system = cache[system.name]
+                    CacheHit('EBGS', True)
                     print(
                         f" EBGS Cached  {system.name:30} : {updated:%c}")
                 else:
                     CSNLog.info(
                         f"EBGS Request {system.name:30} : {updated:%c}")
                     print(f" EBGS Request {system.name:30} : {updated:%c}")
+                    CacheHit('EBGS', False)
                     try:
                         system = EBGSLiveSystem(system, inconflict)
                         cache[system.name] = system
@@ -210,7 +224,7 @@ def EBGSPreviousVisitors(system_name, days=30, earliest=datetime(2017, 10, 8)):
         # There is no TRY Block as it might make the cache invalid and cause a total rebuild
         payload = {'name': system_name, 'timeMin': int(
             1000*time.mktime(minTime.timetuple())), 'timeMax': int(1000*time.mktime(maxTime.timetuple()))}
-        resp = requests.get(url, params=payload)
+        resp = HTTP('EBGS system history', 'GET', url, params=payload)
         myload = json.loads(resp._content)["docs"]
         RequestCount()
         if len(myload):  # Was getting nothing for a specific Detention Center
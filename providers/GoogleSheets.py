@@ -2,22 +2,34 @@
 import pickle
 import os.path
 import CSNSettings
+import CSNReplay
+from CSNMetrics import Staged, HTTP, Call
 
 from datetime import datetime
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
 
 # Traditional
-import requests
 import csv
+import json
 from contextlib import closing
 
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+# Built once and kept for the life of the process, credentials refresh themselves
+_SERVICE = None
 
 
 def GoogleSheetService():  # Authorise and Return a sheet object to work on
+    global _SERVICE
+    if _SERVICE:
+        return _SERVICE
+    # The Google API client is slow to import, so only once a sheet is needed
+    from googleapiclient.discovery import build
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+    if CSNReplay.Replaying():
+        # Requests are still built by the API client, but answered from the recording, so no credentials needed
+        _SERVICE = build('sheets', 'v4', developerKey='replay')
+        return _SERVICE
     creds = None
     if os.path.exists('token.pickle'):
         with open('token.pickle', 'rb') as token:
@@ -34,7 +46,16 @@ def GoogleSheetService():  # Authorise and Return a sheet object to work on
         with open('token.pickle', 'wb') as token:
             pickle.dump(creds, token)
 
-    return (build('sheets', 'v4', credentials=creds))
+    _SERVICE = build('sheets', 'v4', credentials=creds)
+    return (_SERVICE)
+
+
+def Execute(endpoint: str, request) -> dict:
+    """ Execute a Google API request, recording its metrics """
+    with Call(endpoint) as call:
+        result = CSNReplay.Execute(endpoint, request)
+        call['bytes'] = len(json.dumps(result))
+    return result
 
 
 def CSNOverRideReadSafe():  # Read without Google API
@@ -44,7 +65,7 @@ def CSNOverRideReadSafe():  # Read without Google API
         return (answer)
     readaction = f'export?format=csv&gid={CSNSettings.overide_sheet}'
     url = f'https://docs.google.com/spreadsheets/d/{CSNSettings.OVERRIDE_WORKBOOK}/{readaction}'
-    with closing(requests.get(url, stream=True)) as r:
+    with closing(HTTP('Google Sheets csv export', 'GET', url, stream=True)) as r:
         reader = csv.reader(r.content.decode(
             'utf-8').splitlines(), delimiter=',')
         next(reader)
@@ -70,8 +91,8 @@ def CSNOverRideRead():
     myrange = 'Overrides!A2:E'
     sheet = GoogleSheetService().spreadsheets()
 
-    result = sheet.values().get(spreadsheetId=CSNSettings.OVERRIDE_WORKBOOK,
-                                range=myrange).execute()
+    result = Execute('Google values.get', sheet.values().get(spreadsheetId=CSNSettings.OVERRIDE_WORKBOOK,
+                                                             range=myrange))
     values = result.get('values', [])
 
     if not values:
@@ -86,7 +107,9 @@ def CSNOverRideRead():
     return (answer)
 
 
-def CSNSchedule(now=datetime.utcnow().hour):
+def CSNSchedule(now: int = None):
+    if now is None:
+        now = datetime.utcnow().hour
     answer = []
     if CSNSettings.OVERRIDE_WORKBOOK:
         mysheet_id = CSNSettings.OVERRIDE_WORKBOOK
@@ -95,8 +118,8 @@ def CSNSchedule(now=datetime.utcnow().hour):
         myrange = 'Overrides!F2:G25'
         sheet = GoogleSheetService().spreadsheets()
 
-        result = sheet.values().get(spreadsheetId=mysheet_id,
-                                    range=myrange).execute()
+        result = Execute('Google values.get', sheet.values().get(spreadsheetId=mysheet_id,
+                                                                 range=myrange))
         values = result.get('values', [])
 
         if not values:
@@ -121,8 +144,8 @@ def CSNFleetCarrierRead():
     myrange = 'FC!A2:D'
     sheet = GoogleSheetService().spreadsheets()
 
-    result = sheet.values().get(spreadsheetId=mysheet_id,
-                                range=myrange).execute()
+    result = Execute('Google values.get', sheet.values().get(spreadsheetId=mysheet_id,
+                                                             range=myrange))
     values = result.get('values', [])
 
     if not values:
@@ -138,9 +161,84 @@ def CSNFleetCarrierRead():
     return (answer)
 
 
+def PatrolLoad() -> list | None:
+    """ Loads the Patrol rows last written to the Google Sheet. None if there is no record """
+    answer = None
+    try:
+        with open(f'data\\{CSNSettings.FACTION}CSNPatrol.pickle', 'rb') as io:
+            answer = pickle.load(io)
+    except:
+        pass
+    return answer
+
+
+def PatrolSave(patrol: list) -> None:
+    """ Saves the Patrol rows as written to the Google Sheet, for the next diff """
+    with open(f'data\\{CSNSettings.FACTION}CSNPatrol.pickle', 'wb') as io:
+        pickle.dump(patrol, io)
+
+
+def PatrolLayout(old: list, new: list) -> list:
+    """ Arrange the new Patrol rows so that any row already on the sheet keeps its position.\n
+        Rows are identified by System and Message. New rows fill the gaps left by old rows,
+        and rows past the end of the new Patrol are moved into any remaining gaps
+    """
+    slots: dict[tuple, list[int]] = {}
+    for i, row in enumerate(old):
+        slots.setdefault((row[0], row[6]), []).append(i)
+
+    layout: list = [None] * len(old)
+    pending: list = []
+    for row in new:
+        if slots.get((row[0], row[6])):
+            layout[slots[(row[0], row[6])].pop(0)] = row
+        else:
+            pending.append(row)
+
+    # New rows into gaps, then on the end
+    for i in range(len(layout)):
+        if not pending:
+            break
+        if layout[i] is None:
+            layout[i] = pending.pop(0)
+    layout.extend(pending)
+
+    # Fill any gaps within the new length from the end and truncate
+    for i in range(len(new)):
+        if layout[i] is None:
+            while layout[-1] is None:
+                layout.pop()
+            layout[i] = layout.pop()
+    del layout[len(new):]
+    return layout
+
+
+def PatrolRanges(mysheet: str, old: list, new: list) -> list[dict]:
+    """ Ranges of contiguous rows that differ between the old and new Patrol layout.\n
+        Rows no longer required are blanked
+    """
+    blank = [''] * 8
+    rows = list(new) + [blank] * (len(old) - len(new))
+    changed = [i for i, row in enumerate(rows)
+               if i >= len(old) or list(old[i]) != list(row)]
+
+    data: list[dict] = []
+    start = None
+    for n, i in enumerate(changed):
+        if start is None:
+            start = i
+        if n + 1 == len(changed) or changed[n + 1] != i + 1:
+            data.append({'range': f'{mysheet}!A{start+2}:H{i+2}',
+                         'values': [list(_) for _ in rows[start:i+1]]})
+            start = None
+    return data
+
+
+@Staged('Google Patrol Write')
 def CSNPatrolWrite(answer):
     """System, X, Y, Z, TI=0, Faction=Canonn, Message, Icon"""
     """Col 285 Sector KZ-C b14-1	-133.21875	79.1875	-64.84375	0	Canonn	Suggestion: Canonn Missions, Bounties, Trade and Data (gap to Nones Resistance is 27.1%)	:chart_with_downwards_trend: """
+    """ Only the rows that have changed since the last write are sent, in a single batch """
 
     CSNSettings.OVERRIDE_WORKBOOK
     if not CSNSettings.OVERRIDE_WORKBOOK:
@@ -149,30 +247,35 @@ def CSNPatrolWrite(answer):
     CSNSettings.CSNLog.info('Update Patrol on Google Sheet')
     mysheet = 'CSNPatrol'
     sheet = GoogleSheetService().spreadsheets()
-
-    # Datestamp my mayhem
-    myrange = f'{mysheet}!H1'
-    myvalue = [[datetime.now().ctime()]]
-    result = sheet.values().update(spreadsheetId=CSNSettings.OVERRIDE_WORKBOOK,
-                                   range=myrange,
-                                   valueInputOption='USER_ENTERED',
-                                   body={'values': myvalue}
-                                   ).execute()
-
-    # Clear in case the new patrol is shorted
-    myrange = f'{mysheet}!A2:H'
-    result = sheet.values().clear(spreadsheetId=CSNSettings.OVERRIDE_WORKBOOK,
-                                  range=myrange,
-                                  body={}).execute()
-
-    # Write the new patrol
-    result = sheet.values().update(spreadsheetId=CSNSettings.OVERRIDE_WORKBOOK,
-                                   valueInputOption='RAW',
-                                   range=myrange,
-                                   body=dict(majorDimension='ROWS',
-                                             values=answer)).execute()
-
-    return (result["updatedRows"])
+    answer = [list(_) for _ in answer]
+
+    old = PatrolLoad()
+    if old is None:
+        # No record of what is on the sheet, so clear and write the whole patrol
+        myrange = f'{mysheet}!A2:H'
+        Execute('Google values.clear', sheet.values().clear(spreadsheetId=CSNSettings.OVERRIDE_WORKBOOK,
+                                                            range=myrange,
+                                                            body={}))
+        old = []
+
+    patrol = PatrolLayout(old, answer)
+    data = PatrolRanges(mysheet, old, patrol)
+    # Datestamp my mayhem, USER_ENTERED so the sheet sees a date rather than text
+    Execute('Google values.update', sheet.values().update(spreadsheetId=CSNSettings.OVERRIDE_WORKBOOK,
+                                                           range=f'{mysheet}!H1',
+                                                           valueInputOption='USER_ENTERED',
+                                                           body={'values': [[datetime.now().ctime()]]}))
+
+    result = {}
+    if data:
+        result = Execute('Google values.batchUpdate', sheet.values().batchUpdate(spreadsheetId=CSNSettings.OVERRIDE_WORKBOOK,
+                                                                                 body={'valueInputOption': 'RAW',
+                                                                                       'data': data}))
+    PatrolSave(patrol)
+    CSNSettings.CSNLog.info(
+        f'Patrol {len(data)} ranges changed, {len(patrol)} rows')
+
+    return (result.get("totalUpdatedRows", 0))
 
 
 def CSNFactionname(faction_id, factions):
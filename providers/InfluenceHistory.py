@@ -0,0 +1,146 @@
+# Influence of every Faction in every System over time, for spotting trends the latest snapshot can't show
+from datetime import datetime
+from array import array
+import pickle
+import os
+import CSNSettings
+from CSNMetrics import Staged
+from classes.System import System
+
+HISTORYDIR = 'data\\InfluenceHistory'
+# One file per column, a record for each new snapshot of a (system, faction) series. time and influence are
+# the change since the series' previous record, so most fit small numbers
+COLUMNS = {'series': 'I', 'time': 'I', 'influence': 'h'}
+SCALE = 100  # Influence is kept in 1/100 %
+DAY = 24*60*60
+
+
+class InfluenceStore:
+    """ Append only columns of every (system, faction) influence snapshot, delta encoded per series.\n
+        The index holds the series keys, the last time and influence of each and how many records the columns hold.
+        It is written after the columns, so records of an append that never finished are dropped when next opened
+    """
+
+    def __init__(self, folder: str = HISTORYDIR) -> None:
+        self.folder = folder
+        self.keys: list[tuple[str, str]] = []  # (system, faction) by series number
+        self.last: list[tuple[int, int]] = []  # (time, scaled influence) by series number
+        self.count = 0
+        try:
+            with open(os.path.join(folder, 'index.pickle'), 'rb') as io:
+                self.keys, self.last, self.count = pickle.load(io)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+        self.numbers: dict[tuple[str, str], int] = {
+            _: n for n, _ in enumerate(self.keys)}
+
+    def File(self, column: str) -> str:
+        return os.path.join(self.folder, column+'.bin')
+
+    def Append(self, systems: list[System]) -> int:
+        """ Records every Faction of each System updated since its last record. Returns the number of records added """
+        added = {name: array(code) for name, code in COLUMNS.items()}
+        system: System
+        for system in systems:
+            time = int(system.updated.timestamp())
+            for faction in system.factions:
+                key = (system.name, faction.name)
+                if (n := self.numbers.get(key)) is None:
+                    n = self.numbers[key] = len(self.keys)
+                    self.keys.append(key)
+                    self.last.append((0, 0))
+                lasttime, lastinfluence = self.last[n]
+                if time <= lasttime:
+                    continue
+                influence = round(faction.influence*SCALE)
+                added['series'].append(n)
+                added['time'].append(time-lasttime)
+                added['influence'].append(influence-lastinfluence)
+                self.last[n] = (time, influence)
+        if not added['series']:
+            return 0
+
+        os.makedirs(self.folder, exist_ok=True)
+        for name, column in added.items():
+            with open(self.File(name), 'ab') as io:
+                # Drop anything past count, left by an append that failed before the index was saved
+                io.truncate(self.count*column.itemsize)
+                column.tofile(io)
+        self.count += len(added['series'])
+        with open(os.path.join(self.folder, 'index.pickle.tmp'), 'wb') as io:
+            pickle.dump((self.keys, self.last, self.count), io)
+        os.replace(os.path.join(self.folder, 'index.pickle.tmp'),
+                   os.path.join(self.folder, 'index.pickle'))
+        return len(added['series'])
+
+    def Columns(self) -> dict[str, array]:
+        """ The raw delta encoded columns """
+        columns = {name: array(code) for name, code in COLUMNS.items()}
+        if self.count:
+            for name, column in columns.items():
+                with open(self.File(name), 'rb') as io:
+                    column.fromfile(io, self.count)
+        return columns
+
+    def Series(self, system: str, faction: str) -> list[tuple[datetime, float]]:
+        """ Every recorded influence of a Faction in a System """
+        if (n := self.numbers.get((system, faction))) is None:
+            return []
+        answer: list[tuple[datetime, float]] = []
+        time = influence = 0
+        columns = self.Columns()
+        for s, t, i in zip(columns['series'], columns['time'], columns['influence']):
+            if s == n:
+                time, influence = time+t, influence+i
+                answer.append(
+                    (datetime.fromtimestamp(time), influence/SCALE))
+        return answer
+
+    def Trends(self, systems: set[str], days: float = 7, points: int = 3, now: datetime = None) -> dict[tuple[str, str], float]:
+        """ Influence change in % a day of every Faction in the Systems over the last days, by least squares.\n
+            Only series with at least points records in that time. The whole pass is numpy array operations, empty without numpy
+        """
+        try:
+            import numpy as np  # Only here, as it is slow to import
+        except ImportError:
+            return {}
+        if not self.count:
+            return {}
+        columns = self.Columns()
+        series = np.frombuffer(columns['series'], dtype=np.uint32)
+        deltas = np.frombuffer(columns['time'], dtype=np.uint32).astype(np.int64)
+        changes = np.frombuffer(columns['influence'], dtype=np.int16).astype(np.int64)
+
+        # Undo the delta encoding, a running total within each series
+        order = np.argsort(series, kind='stable')
+        series = series[order]
+        starts = np.flatnonzero(np.r_[True, series[1:] != series[:-1]])
+        lengths = np.diff(np.r_[starts, len(series)])
+        times = np.cumsum(deltas[order])
+        influences = np.cumsum(changes[order])
+        before = np.r_[0, times][starts]
+        times -= np.repeat(before, lengths)
+        before = np.r_[0, influences][starts]
+        influences -= np.repeat(before, lengths)
+
+        wanted = np.array(list(n for n, _ in enumerate(self.keys) if _[0] in systems), dtype=np.uint32)
+        x = (times-(now or datetime.now()).timestamp())/DAY
+        keep = np.isin(series, wanted) & (x >= -days)
+        s, x, y = series[keep], x[keep], influences[keep]/SCALE
+        size = len(self.keys)
+        n = np.bincount(s, minlength=size)
+        sx, sy = np.bincount(s, x, size), np.bincount(s, y, size)
+        sxx, sxy = np.bincount(s, x*x, size), np.bincount(s, x*y, size)
+        spread = n*sxx-sx*sx
+        found = np.flatnonzero((n >= points) & (spread > 1e-9))
+        slopes = (n*sxy-sx*sy)[found]/spread[found]
+        return {self.keys[i]: float(slope) for i, slope in zip(found, slopes)}
+
+
+@Staged('Influence Record')
+def RecordInfluence(systems: list[System], folder: str = HISTORYDIR) -> int:
+    """ Add the Systems' latest snapshots from EDSM or EBGS to the Influence History """
+    added = InfluenceStore(folder).Append(systems)
+    print(f'Influence History {added} new records')
+    CSNSettings.CSNLog.info(f'Influence History {added} new records')
+    return added
@@ -2,24 +2,37 @@
 import json
 
 STM = dict()
+_LOCATION = ['data\STM.json']  # Where STM was last loaded from, and is saved to
+_LOADED = [False]
+
+
+def STMFile(faction: str = '') -> str:
+    """ STM of a Faction other than the one in .env is kept separately """
+    return f'data\{faction}STM.json' if faction else 'data\STM.json'
 
 
 def LoadSTM(location: str = 'data\STM.json') -> None:
-    global STM
     print("Load STM")
+    _LOCATION[0] = location
+    _LOADED[0] = True
+    STM.clear()  # In place, as it is imported by name
     try:
         with open(location, 'r') as io:
-            STM = json.load(io)
+            STM.update(json.load(io))
     except:
         pass
 
 
-def SaveSTM(location: str = 'data\STM.json') -> None:
-    global STM
+def Memory() -> dict:
+    """ STM, loaded on first use rather than when imported """
+    if not _LOADED[0]:
+        LoadSTM(_LOCATION[0])
+    return STM
+
+
+def SaveSTM(location: str = None) -> None:
+    Memory()  # Never save over what hasn't been loaded
     print("Save STM")
-    with open(location, 'w', encoding='utf-8') as io:
+    with open(location or _LOCATION[0], 'w', encoding='utf-8') as io:
         json.dump(STM, io, indent=4)
 
-
-# Auto Init
-LoadSTM()
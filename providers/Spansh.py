@@ -0,0 +1,199 @@
+# Spansh's galaxy dump, the other bulk source of Systems for when EDSM is late or down
+import CSNSettings
+from classes.StationIndex import StationIndex, FLAGS
+from classes.State import State, Phase
+from classes.System import System
+from classes.Presense import Presence
+from providers.EDSM import DownloadDump, DumpDate, ReduceToFaction
+from providers.EDDBFactions import isPlayer
+from CSNMetrics import Staged
+import datetime
+import json
+import gzip
+import os
+
+SPANSHPOPULATED = "https://downloads.spansh.co.uk/galaxy_populated.json.gz"
+READ = 1024*1024  # Characters read from the dump at a time
+# Converted Systems kept between runs when warm, key is (faction, range), value is (dump date, systems)
+_WARM: dict[tuple, tuple] = {}
+
+
+def ClearSpanshWarm() -> None:
+    """ Forget any Systems kept warm between runs """
+    _WARM.clear()
+
+
+def SpanshCacheFile() -> str:
+    return os.environ.get('APPDATA')+"\\CSN_SpanshPopulated.json.gz"
+
+
+def SpanshRecords(file: str):
+    """ Each System record of a dump, parsed one at a time from a buffer of at most one record and READ more,
+        whatever the layout of the dump, so memory does not grow with its size
+    """
+    decoder = json.JSONDecoder()
+    with gzip.open(file, 'rt', encoding='utf-8') as io:
+        buffer, pos, more = '', 0, True
+        while True:
+            # Skip what is between records: the array's brackets, commas and white space
+            while pos < len(buffer) and buffer[pos] in '[], \t\r\n':
+                pos += 1
+            if pos < len(buffer):
+                try:
+                    record, pos = decoder.raw_decode(buffer, pos)
+                    yield record
+                    continue
+                except json.JSONDecodeError:  # Cut short by the end of the buffer
+                    if not more:
+                        raise
+            elif not more:
+                return
+            chunk = io.read(READ)
+            more = bool(chunk)
+            buffer, pos = buffer[pos:]+chunk, 0
+
+
+def SpanshDateTime(datestring: str) -> datetime.datetime:
+    """ Spansh dates are UTC, as 2024-03-02 12:00:00+00 """
+    return datetime.datetime.strptime(datestring[:19], '%Y-%m-%d %H:%M:%S')
+
+
+def SpanshStation(station: dict) -> dict:
+    """ A Spansh Station record as the EDSM one a StationIndex takes """
+    services = station.get('services', [])
+    owner = station.get('controllingFaction')
+    owner = owner.get('name') if isinstance(owner, dict) else owner
+    economies = list(station.get('economies', {}))
+    primary = station.get('primaryEconomy') or (economies[0] if economies else 'None')
+    return {'id': station.get('id', 0), 'type': station.get('type') or 'Unknown', 'name': station['name'],
+            'controllingFaction': {'name': owner or station.get('type') or 'Unknown'},
+            'economy': primary, 'secondEconomy': next((_ for _ in economies if _ != primary), None),
+            'haveMarket': 'Market' in services, 'haveShipyard': 'Shipyard' in services, 'haveOutfitting': 'Outfitting' in services,
+            'otherServices': list(_ for _ in services if _ not in FLAGS)}
+
+
+def SpanshStates(rf: dict) -> list[State]:
+    """ States of a Faction. Spansh has the one current state, and lists of states in newer dumps """
+    states: list[State] = []
+    for key, phase in (('activeStates', Phase.ACTIVE), ('pendingStates', Phase.PENDING), ('recoveringStates', Phase.RECOVERING)):
+        for rstate in rf.get(key) or []:
+            states.append(State(rstate['state'] if isinstance(
+                rstate, dict) else rstate, phase=phase))
+    if not states and rf.get('state') and rf['state'] != 'None':
+        states.append(State(rf['state'], phase=Phase.ACTIVE))
+    return states
+
+
+def SpanshSystem(rs: dict, updated: datetime.datetime, stations: StationIndex) -> System:
+    """ Convert one System record from the Spansh dump into a System Object, its Stations going into the StationIndex """
+    system = System('Spansh', id=0, id64=rs['id64'], name=rs['name'], x=rs['coords']['x'], y=rs['coords']['y'], z=rs['coords']['z'],
+                    allegiance=rs.get('allegiance') or '', government=rs.get('government') or '', economy=rs.get('primaryEconomy') or '',
+                    security=rs.get('security') or '', population=rs.get('population') or 0,
+                    controllingFaction=(rs.get('controllingFaction') or {}).get('name', ''), updated=SpanshDateTime(rs['date']) if rs.get('date') else updated,
+                    recorded=SpanshDateTime(rs['date']) if rs.get('date') else None)
+    for rf in rs.get('factions', []):
+        if rf['influence'] > 0:
+            f = Presence(0, rf['name'], allegiance=rf.get('allegiance', ''), government=rf.get('government', ''),
+                         influence=100*rf['influence'], isPlayer=isPlayer(rf['name']))
+            f.states = SpanshStates(rf)
+            system.addfaction(f)
+    # Surface Stations are listed under their Body
+    records = rs.get('stations', []) + list(station for body in rs.get('bodies', [])
+                                             for station in body.get('stations', []))
+    stations.Add(system.id64, list(SpanshStation(_) for _ in records))
+    system.stationindex = stations
+    return system
+
+
+@Staged('Spansh Refresh')
+def RefreshSpanshDump(spanshcache: str = '') -> datetime.datetime:
+    """ Downloads the dump if Spansh has a newer one. Returns the date of the dump we have """
+    spanshcache = spanshcache or SpanshCacheFile()
+    try:
+        DownloadDump('Spansh populated dump', SPANSHPOPULATED, spanshcache)
+    except Exception as e:
+        CSNSettings.CSNLog.info(f'Spansh Offline ! {e}')
+        print(f"Spansh Offline !")
+    return DumpDate(spanshcache)
+
+
+@Staged('Spansh Convert')
+def ConvertSpansh(file: str, updated: datetime.datetime) -> list[System]:
+    """ Every populated System of a Spansh dump, streamed so only the Systems kept are held.\n
+        Bodies and the unpopulated Systems of a whole galaxy dump are dropped as they are read. updated is for Systems with no date
+    """
+    stations = StationIndex()
+    return list(SpanshSystem(rs, updated, stations) for rs in SpanshRecords(file) if rs.get('population') and rs.get('factions'))
+
+
+def GetSystemsFromSpansh(faction: str | list[str], range=40, warm: bool = False, file: str = '') -> list[System]:
+    """ As GetSystemsFromEDSM, from the latest Spansh populated galaxy dump. Empty if there has never been one\n
+        file reads a dump that is already there, without refreshing it
+    """
+    if not file:
+        file = SpanshCacheFile()
+        lastmoddt = RefreshSpanshDump(file)
+    else:
+        lastmoddt = DumpDate(file)
+    if not os.path.exists(file):
+        return []
+    if isinstance(faction, list):
+        faction = tuple(faction)
+    if warm and (faction, range) in _WARM and _WARM[(faction, range)][0] == lastmoddt:
+        print('Spansh Unchanged, using warm Systems')
+        CSNSettings.CSNLog.info('Spansh Unchanged, using warm Systems')
+        return list(_WARM[(faction, range)][1])
+    _WARM.clear()
+
+    print('Spansh Converting to DataClass...')
+    CSNSettings.CSNLog.info('Spansh Converting to DataClass...')
+    systemlist = ConvertSpansh(file, lastmoddt)
+    if faction and (reduced := ReduceToFaction(systemlist, faction, range)) is not None:
+        systemlist = reduced
+    print(f'Spansh Converted to include {len(systemlist)} systems')
+    CSNSettings.CSNLog.info(
+        f'Spansh Converted to DataClass : {len(systemlist)} systems')
+    if warm:
+        _WARM[(faction, range)] = (lastmoddt, systemlist)
+        systemlist = list(systemlist)
+    return systemlist
+
+
+@Staged('Fresher')
+def Fresher(systems: list[System], others: list[System]) -> list[System]:
+    """ Each System from whichever list was recorded more recently, matched by id64.\n
+        In the order of systems, followed by any only in others. Compares when each source last had news of the System,
+        as an EDSM System is updated as of its dump however old its record. updated if that is not known
+    """
+    def Recorded(system: System) -> datetime.datetime:
+        return system.recorded or system.updated
+
+    newer = {_.id64: _ for _ in others}
+    answer: list[System] = []
+    replaced = 0
+    for system in systems:
+        if (other := newer.pop(system.id64, None)) and Recorded(other) > Recorded(system):
+            system = other
+            replaced += 1
+        answer.append(system)
+    answer.extend(newer.values())
+    source = others[0].source if others else ''
+    print(f'Fresher : {replaced} Systems replaced and {len(newer)} added from {source}')
+    CSNSettings.CSNLog.info(
+        f'Fresher : {replaced} Systems replaced and {len(newer)} added from {source}')
+    return answer
+
+
+if __name__ == '__main__':
+    """
+        python -m providers.Spansh [dump.json.gz]
+        Reads a local dump, or the cached one, and compares it with the EDSM Systems of the Faction
+    """
+    import sys
+    from providers.EDSM import GetSystemsFromEDSM
+    spansh = GetSystemsFromSpansh(CSNSettings.FACTION, file=sys.argv[1] if len(sys.argv) > 1 else '')
+    for system in spansh[:5]:
+        print(f"{system.updated} {system}")
+        for station in system.getstations()[:3]:
+            print(f"      {station.name} ({station.type}) {station.economy1} {station.economy2}")
+    Fresher(GetSystemsFromEDSM(CSNSettings.FACTION), spansh)
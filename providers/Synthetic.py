@@ -0,0 +1,149 @@
+# Synthetic Bubble - Deterministic EDSM dump shaped records for Benchmarks and playing offline
+import random
+from math import floor
+from dataclasses import dataclass
+
+# Real Bubble is roughly 20k populated systems within 250ly of Sol, flattened in the galactic plane
+BUBBLE_SYSTEMS = 20000
+BUBBLE_RADIUS = 250
+FLATTEN = 0.5  # y axis
+HOME_RANGE = 40  # Expanding factions are found within this cube of home
+
+ALLEGIANCES = ['Federation', 'Empire', 'Alliance', 'Independent']
+GOVERNMENTS = ['Democracy', 'Corporate', 'Patronage', 'Dictatorship',
+               'Confederacy', 'Cooperative', 'Feudal', 'Anarchy', 'Communism', 'Theocracy']
+ECONOMIES = ['Agriculture', 'Extraction', 'High Tech', 'Industrial',
+             'Military', 'Refinery', 'Service', 'Terraforming', 'Tourism', 'Colony']
+STATIONTYPES = ['Coriolis Starport', 'Orbis Starport', 'Ocellus Starport',
+                'Outpost', 'Planetary Outpost', 'Planetary Port', 'Odyssey Settlement']
+SERVICES = ['Black Market', 'Restock', 'Refuel', 'Repair', 'Contacts',
+            'Universal Cartographics', 'Missions', 'Crew Lounge', 'Tuning', 'Material Trader',
+            'Technology Broker', 'Interstellar Factors Contact', 'Search and Rescue']
+SUFFIXES = ['Crimson Hand', 'Gold Partnership', 'Purple Boys', 'Jet Council',
+            'Blue Dynamic Ltd', 'Liberals', 'Party', 'Regulatory State', 'Corporation', 'Brotherhood']
+STATES = ['Boom', 'Investment', 'Expansion', 'Outbreak', 'Drought', 'Famine',
+          'Bust', 'Civil unrest', 'Lockdown', 'Public holiday', 'Infrastructure failure']
+CONFLICTS = ['War', 'Civil war', 'Election']
+
+
+@dataclass
+class SyntheticFaction:
+    """ A generated Faction, so callers can register Player and Home System details as EDDB would """
+    id: int
+    name: str
+    homesystem: str
+    isPlayer: bool
+    allegiance: str
+    government: str
+
+
+def SyntheticBubble(n: int = BUBBLE_SYSTEMS, seed: int = 42, empire: str = '', empire_share: float = 0.005,
+                    player_share: float = 0.15, conflict_share: float = 0.06) -> tuple[list[dict], list[SyntheticFaction]]:
+    """ Generate n populated systems as EDSM systemsPopulated dump records, with the Factions they use.\n
+        Density matches the real Bubble, so the radius grows with n.
+        If empire is given, that Faction is spread through about empire_share of the systems near the centre
+    """
+    rnd = random.Random(seed)
+    radius = BUBBLE_RADIUS * (n / BUBBLE_SYSTEMS) ** (1/3)
+
+    # Coordinates, denser towards the centre like the real Bubble. EDSM coords are in 1/32 ly
+    coords: list[tuple[float, float, float]] = []
+    while len(coords) < n:
+        x, y, z = (rnd.uniform(-1, 1) for _ in range(3))
+        r2 = x*x+y*y+z*z
+        if r2 <= 1 and rnd.random() < 1.2 - 0.6*r2:
+            coords.append(tuple(round(radius*c*32)/32 for c in (x, y*FLATTEN, z)))
+
+    names = [f'Synth {i//26**2 % 26+65:c}{i//26 % 26+65:c}-{i % 26+65:c} {i}' for i in range(n)]
+
+    # Expanding (non native) factions, each with a home system
+    factions: list[SyntheticFaction] = []
+    homes: dict[tuple, list[SyntheticFaction]] = {}
+    for i in rnd.sample(range(n), max(1, n//6)):
+        isplayer = rnd.random() < player_share
+        f = SyntheticFaction(len(factions)+1, f"{names[i]} {rnd.choice(SUFFIXES)}" if not isplayer else f"Synthetic Player Group {len(factions)+1}",
+                             names[i].lower(), isplayer, rnd.choice(ALLEGIANCES), rnd.choice(GOVERNMENTS))
+        factions.append(f)
+        homes.setdefault(Cell(coords[i]), []).append(f)
+    if empire:
+        centre = min(range(n), key=lambda i: sum(c*c for c in coords[i]))
+        myfaction = SyntheticFaction(len(factions)+1, empire, names[centre].lower(), True, 'Independent', 'Cooperative')
+        factions.append(myfaction)
+        empirerange = radius * (empire_share ** (1/3)) * 2
+
+    records: list[dict] = []
+    nextid = len(factions) + 1
+    for i, (x, y, z) in enumerate(coords):
+        # Natives
+        presences = []
+        for _ in range(rnd.randint(2, 4)):
+            presences.append(SyntheticFaction(nextid, f"{names[i]} {rnd.choice(SUFFIXES)} {nextid}", names[i].lower(), False,
+                                              rnd.choice(ALLEGIANCES), rnd.choice(GOVERNMENTS)))
+            nextid += 1
+        # Expanded in from nearby homes
+        nearby = list(f for cell in Neighbours(Cell((x, y, z))) for f in homes.get(cell, []))
+        rnd.shuffle(nearby)
+        presences.extend(nearby[:rnd.choice((0, 1, 2, 3, 3, 4, 4, 5))])
+        if empire and max(abs(x-coords[centre][0]), abs(y-coords[centre][1]), abs(z-coords[centre][2])) < empirerange and rnd.random() < 0.6:
+            presences.append(myfaction)
+        presences = presences[:8 if rnd.random() < 0.02 else 7]
+
+        influences = sorted((rnd.expovariate(1) for _ in presences), reverse=True)
+        total = sum(influences)
+        influences = [round(_/total, 3) for _ in influences]
+        if empire and myfaction in presences[-1:] and rnd.random() < 0.7:
+            # Player factions tend to control where they are
+            presences.insert(0, presences.pop())
+
+        rfactions = []
+        for f, inf in zip(presences, influences):
+            rfactions.append({'id': f.id, 'name': f.name, 'allegiance': f.allegiance, 'government': f.government,
+                              'influence': inf, 'state': 'None', 'activeStates': [], 'pendingStates': [], 'recoveringStates': [],
+                              'happiness': 'Happy', 'isPlayer': f.isPlayer, 'lastUpdate': 1700000000})
+            if rnd.random() < 0.3:
+                state = {'state': rnd.choice(STATES)}
+                rfactions[-1]['activeStates'].append(state)
+                rfactions[-1]['state'] = state['state']
+            if inf < 0.025 and rnd.random() < 0.5:
+                rfactions[-1]['pendingStates'].append({'state': 'Retreat', 'trend': 0})
+
+        if len(rfactions) > 1 and rnd.random() < conflict_share:
+            # Conflict between two factions, normally for control
+            a, b = (0, 1) if rnd.random() < 0.6 else tuple(sorted(rnd.sample(range(len(rfactions)), 2)))
+            rfactions[b]['influence'] = rfactions[a]['influence']
+            conflict = rnd.choice(CONFLICTS if rfactions[a]['allegiance'] != rfactions[b]['allegiance'] else CONFLICTS[1:])
+            phase = rnd.choice(('activeStates', 'activeStates', 'pendingStates', 'recoveringStates'))
+            for c in (a, b):
+                rfactions[c][phase].append({'state': conflict})
+
+        controlling = rfactions[0]
+        stations = []
+        for s in range(rnd.choice((1, 1, 2, 2, 3, 4, 6))):
+            owner = rnd.choice(rfactions)
+            stations.append({'id': i*10+s, 'marketId': 3200000000+i*10+s, 'type': rnd.choice(STATIONTYPES), 'name': f"{names[i]} Port {s}",
+                             'distanceToArrival': rnd.randint(5, 5000), 'allegiance': owner['allegiance'], 'government': owner['government'],
+                             'economy': rnd.choice(ECONOMIES), 'secondEconomy': rnd.choice(ECONOMIES) if rnd.random() < 0.4 else None,
+                             'haveMarket': rnd.random() < 0.9, 'haveShipyard': rnd.random() < 0.4, 'haveOutfitting': rnd.random() < 0.5,
+                             'otherServices': rnd.sample(SERVICES, rnd.randint(2, 8)),
+                             'controllingFaction': {'id': owner['id'], 'name': owner['name']}})
+        records.append({'id': i+1, 'id64': 10000000000+i, 'name': names[i], 'coords': {'x': x, 'y': y, 'z': z},
+                        'allegiance': controlling['allegiance'], 'government': controlling['government'], 'state': controlling['state'],
+                        'economy': stations[0]['economy'], 'security': rnd.choice(('Low', 'Medium', 'High', 'Anarchy')),
+                        'population': int(10 ** rnd.uniform(3, 10)),
+                        'controllingFaction': {'id': controlling['id'], 'name': controlling['name'], 'allegiance': controlling['allegiance'], 'government': controlling['government']},
+                        'factions': rfactions, 'stations': stations, 'date': '2024-03-02 12:00:00'})
+    return records, factions
+
+
+def Cell(coords: tuple) -> tuple:
+    return tuple(floor(c/HOME_RANGE) for c in coords)
+
+
+def Neighbours(cell: tuple) -> list[tuple]:
+    return list((cell[0]+dx, cell[1]+dy, cell[2]+dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1))
+
+
+if __name__ == '__main__':
+    records, factions = SyntheticBubble(1000, empire='Canonn')
+    print(f"{len(records)} systems, {len(factions)} expanding factions")
+    print(records[0])
@@ -0,0 +1,80 @@
+# EDDN updates published through the local Stand In relay
+import unittest
+import json
+import time
+import os
+from datetime import datetime
+from classes.System import System
+from classes.Presense import Presence
+from providers.EDDN import EDDNListener, StandInPublisher
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+RELAY = 'tcp://127.0.0.1:9599'
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+@unittest.skipIf(zmq is None, 'needs pyzmq')
+class TestEDDN(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        """ Publish the fixtures once, through a relay bound for the whole class """
+        with open(os.path.join(FIXTURES, 'eddn_fsdjump.json'), 'r') as io:
+            messages = json.load(io)
+        cls.varati = System('EDSM', 1, 1, 'Varati', 0, 0, 0,
+                            population=1000, controllingFaction='Varati Crimson Hand', updated=datetime(2024, 3, 1))
+        cls.varati.addfaction(Presence(7, 'Canonn', influence=30))
+        cls.suhte = System('EDSM', 2, 2, 'Suhte', 0, 0, 0,
+                           population=50, controllingFaction='Canonn', updated=datetime(2024, 3, 1))
+        cls.suhte.addfaction(Presence(7, 'Canonn', influence=100))
+        cls.flushed: list[list[System]] = []
+        cls.listener = EDDNListener([cls.varati, cls.suhte], on_flush=cls.flushed.append, relay=RELAY)
+        publish = StandInPublisher(RELAY)
+
+        # Probe with an untracked System until the subscriber is connected, then send the fixtures and stop once received
+        thread = cls.listener.Start()
+        deadline = time.monotonic() + 10
+        while not cls.listener.received and time.monotonic() < deadline:
+            publish({'event': 'FSDJump', 'timestamp': '2024-03-05T00:00:00Z', 'StarSystem': 'Probe', 'SystemAddress': 99,
+                     'Factions': [{'Name': 'Probe', 'Influence': 1.0}]})
+            time.sleep(0.1)
+        start = cls.listener.received
+        for message in messages:
+            publish(message)
+        while cls.listener.received < start + len(messages) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        cls.listener.stop.set()
+        thread.join(5)
+
+    def test_applied(self) -> None:
+        self.assertEqual(self.varati.source, 'EDDN')
+        self.assertEqual(self.varati.updated, datetime(2024, 3, 5, 18, 30))
+        self.assertEqual(self.varati.controllingFaction, 'Canonn')
+        self.assertEqual(self.varati.population, 1500)
+        self.assertEqual([(_.name, _.influence) for _ in self.varati.factions],
+                         [('Canonn', 60), ('Varati Crimson Hand', 40)])
+        canonn, hand = self.varati.factions
+        self.assertEqual(canonn.id, 7)  # Kept from before the update
+        self.assertEqual(sorted((_.state, _.phase.name) for _ in canonn.states), [('Boom', 'PENDING'), ('War', 'ACTIVE')])
+        war = next(_ for _ in canonn.states if _.isConflict)
+        self.assertEqual((war.opponent, war.atstake, war.dayswon, war.dayslost, war.gain),
+                         ('Varati Crimson Hand', 'Alpha', 2, 1, 'Beta'))
+        self.assertIn(('Drought', 'RECOVERING'), list((_.state, _.phase.name) for _ in hand.states))
+
+    def test_older_ignored(self) -> None:
+        self.assertEqual(self.suhte.source, 'EDSM')
+        self.assertEqual(self.suhte.controllingFaction, 'Canonn')
+        self.assertEqual(self.suhte.population, 50)
+        self.assertEqual([_.name for _ in self.suhte.factions], ['Canonn'])
+
+    def test_on_flush(self) -> None:
+        self.assertEqual(self.flushed, [[self.varati]])
+        self.assertEqual(self.listener.applied, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
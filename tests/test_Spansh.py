@@ -0,0 +1,106 @@
+# Spansh dumps read from the local gzipped fixtures
+import unittest
+from unittest import mock
+import json
+import pickle
+import os
+from datetime import datetime, timezone
+import providers.Spansh as Spansh
+from providers.EDSM import ConvertEDSM, EDSMRecorded
+from providers.Synthetic import SyntheticBubble
+from classes.System import System
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+DUMPS = ('spansh_lines.json.gz', 'spansh_compact.json.gz', 'spansh_bodies.json.gz')
+UPDATED = datetime(2024, 3, 3)
+
+
+def Fixture(name: str) -> str:
+    return os.path.join(FIXTURES, name)
+
+
+class TestSpansh(unittest.TestCase):
+
+    def test_records(self) -> None:
+        """ Every record of each layout, whether a READ cuts records up or holds the whole dump """
+        for dump in DUMPS:
+            for read in (1, 7, 100, Spansh.READ):
+                with self.subTest(dump=dump, read=read), mock.patch.object(Spansh, 'READ', read):
+                    self.assertEqual(list(_['id64'] for _ in Spansh.SpanshRecords(Fixture(dump))), [1001, 1002, 1003])
+
+    def test_truncated(self) -> None:
+        for read in (7, Spansh.READ):
+            with self.subTest(read=read), mock.patch.object(Spansh, 'READ', read):
+                with self.assertRaises(json.JSONDecodeError):
+                    list(Spansh.SpanshRecords(Fixture('spansh_truncated.json.gz')))
+
+    def test_convert(self) -> None:
+        varati, suhte = Spansh.ConvertSpansh(Fixture('spansh_bodies.json.gz'), UPDATED)  # Empty Rock has no population
+        self.assertEqual((varati.source, varati.id64, varati.name, varati.controllingFaction, varati.population),
+                         ('Spansh', 1001, 'Varati', 'Canonn', 2500000))
+        self.assertEqual((varati.x, varati.y, varati.z), (-178.65625, 77.125, -87.125))
+        self.assertEqual(varati.updated, datetime(2024, 3, 2, 12))
+        self.assertEqual(suhte.updated, UPDATED)  # No date in the record
+
+        # Influence as a percentage, and no Presence for a Faction with none
+        self.assertEqual([(_.name, _.influence) for _ in varati.factions], [('Canonn', 60), ('Varati Crimson Hand', 40)])
+        self.assertTrue(all(_.source == 'Spansh' for _ in varati.factions))
+        canonn, hand = varati.factions
+        self.assertEqual(sorted((_.state, _.phase.name) for _ in canonn.states), [('Boom', 'ACTIVE'), ('War', 'PENDING')])
+        self.assertEqual([(_.state, _.phase.name) for _ in hand.states], [('Drought', 'RECOVERING')])
+        self.assertEqual([(_.state, _.phase.name) for _ in suhte.factions[0].states], [('Expansion', 'ACTIVE')])
+
+        # The orbital Station and the surface one listed under its Body
+        orbital, surface = varati.getstations()
+        self.assertEqual((orbital.id, orbital.name, orbital.type, orbital.faction, orbital.economy1, orbital.economy2),
+                         (128000001, 'Trailblazer Hub', 'Coriolis Starport', 'Canonn', 'Industrial', 'Extraction'))
+        self.assertEqual((orbital.hasmarket, orbital.hasshipyard, orbital.hasoutfitting), (True, True, False))
+        self.assertEqual(sorted(orbital.services), ['Refuel', 'Universal Cartographics'])
+        self.assertEqual((surface.name, surface.type, surface.faction, surface.economy1, surface.hasoutfitting),
+                         ('Canonn Surface Lab', 'Planetary Outpost', 'Varati Crimson Hand', 'High Tech', True))
+        self.assertEqual(varati.economysavailable, frozenset(('Industrial', 'Extraction', 'High Tech')))
+        self.assertEqual(suhte.getstations(), [])
+
+    def test_convert_layouts(self) -> None:
+        """ The same Systems whatever the layout, only the Stations under Bodies differ """
+        lines, compact = (Spansh.ConvertSpansh(Fixture(_), UPDATED) for _ in DUMPS[:2])
+        self.assertEqual(lines, compact)
+        self.assertEqual([_.name for _ in lines[0].getstations()], ['Trailblazer Hub'])
+
+    def test_pickle(self) -> None:
+        """ A System is pickled without the dump's StationIndex, so a cache of them doesn't keep copies of it """
+        varati, suhte = Spansh.ConvertSpansh(Fixture('spansh_bodies.json.gz'), UPDATED)
+        copy = pickle.loads(pickle.dumps(varati))
+        self.assertIsNone(copy.stationindex)
+        self.assertEqual(copy, varati)
+        self.assertNotIn(b'Trailblazer Hub', pickle.dumps([varati, suhte]))
+        self.assertEqual(len(varati.getstations()), 2)  # Still on the System pickled
+
+    def test_fresher(self) -> None:
+        def system(source: str, id64: int, day: int) -> System:
+            return System(source, 0, id64, f'System {id64}', 0, 0, 0, updated=datetime(2024, 3, day))
+        edsm = [system('EDSM', 1, 2), system('EDSM', 2, 2), system('EDSM', 3, 2)]
+        spansh = [system('Spansh', 4, 1), system('Spansh', 2, 3), system('Spansh', 1, 1)]
+        fresher = Spansh.Fresher(edsm, spansh)
+        self.assertEqual([(_.id64, _.source) for _ in fresher], [(1, 'EDSM'), (2, 'Spansh'), (3, 'EDSM'), (4, 'Spansh')])
+
+    def test_fresher_recorded(self) -> None:
+        """ A current EDSM dump holding an older record loses to a newer Spansh one """
+        varati, suhte = Spansh.ConvertSpansh(Fixture('spansh_bodies.json.gz'), UPDATED)
+        self.assertEqual((varati.recorded, suhte.recorded), (datetime(2024, 3, 2, 12), None))
+        records, factions = SyntheticBubble(2, seed=1)
+        records[0].update(id64=1001, date='2024-02-01 09:00:00')
+        records[1].update(id64=1003, date='2024-03-04 09:00:00')  # Newer than the Spansh dump, Suhte has no date
+        for rf in records[0]['factions']+records[1]['factions']:
+            rf['lastUpdate'] = int(datetime(2024, 1, 20, tzinfo=timezone.utc).timestamp())
+        edsm = ConvertEDSM(records, datetime(2024, 3, 5))  # The dump is newer than either Spansh record
+        self.assertEqual([_.recorded for _ in edsm], [datetime(2024, 2, 1, 9), datetime(2024, 3, 4, 9)])
+        records[0]['date'] = ''
+        self.assertEqual(EDSMRecorded(records[0]), datetime(2024, 1, 20))  # From the Factions
+
+        fresher = Spansh.Fresher(edsm, [varati, suhte])
+        self.assertEqual([(_.id64, _.source) for _ in fresher], [(1001, 'Spansh'), (1003, 'EDSM')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,24 @@
+# Cold start of the entry points, each imported in a fresh Python
+import unittest
+from CSNBenchmark import ImportTimes, ImportLines, IMPORTBUDGET, HEAVY
+
+
+class TestImports(unittest.TestCase):
+
+    def test_budget(self) -> None:
+        """ What a scheduled run with nothing to do imports stays under budget """
+        for module in ('CSNSchedule', 'CSNSettings'):
+            with self.subTest(module=module):
+                run = ImportTimes(module)
+                self.assertEqual(run.returncode, 0, run.stderr[-500:])
+                self.assertLess(sum(_[1] for _ in ImportLines(run))/1e6, IMPORTBUDGET)
+
+    def test_lazy(self) -> None:
+        """ CSN loads none of the heavy providers' dependencies until they are used """
+        run = ImportTimes('CSN')
+        self.assertEqual(run.returncode, 0, run.stderr[-500:])
+        self.assertEqual(run.stdout.split(), [], f'CSN imported some of {HEAVY}')
+
+
+if __name__ == '__main__':
+    unittest.main()